@@ -47,6 +47,7 @@ INSTALLED_APPS = [
     'django.contrib.postgres',
     'django.contrib.staticfiles',
     'django_auth_lti',
+    'django_rq',
     'fa_info',
     'icommons_common',
     'icommons_common.monitor',
@@ -65,6 +66,7 @@ MIDDLEWARE = [
     'django_auth_lti.middleware_patched.MultiLTILaunchAuthMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'manage_sections.middleware.CourseInstanceIdentityMapMiddleware',
 ]
 
 AUTHENTICATION_BACKENDS = [
@@ -162,6 +164,10 @@ _rq_redis_config = {
     'DEFAULT_TIMEOUT': SECURE_SETTINGS.get('default_rq_timeout_secs', 300),
 }
 
+RQ_QUEUES = {
+    'default': _rq_redis_config,
+}
+
 
 # Sessions
 
@@ -360,6 +366,26 @@ MANAGE_PEOPLE = {
         'library': 'LIBRARY',
         'other': 'OTHER',
     },
+    # upper bound on concurrent Canvas API calls made while serving a single
+    # manage_people request
+    'CANVAS_API_MAX_WORKERS': SECURE_SETTINGS.get('manage_people_canvas_api_max_workers', 5),
+    # how long each worker keeps its in-memory copy of the UserRole table
+    'USER_ROLE_INDEX_TTL_SECS': SECURE_SETTINGS.get('user_role_index_ttl_secs', 3600),
+    # how long badge role types are cached per univ_id, and how long ids not
+    # found in COURSEMANAGER are remembered as missing
+    'BADGE_CACHE_TIMEOUT_SECS': SECURE_SETTINGS.get('badge_cache_timeout_secs', 86400),
+    'BADGE_NEGATIVE_CACHE_TIMEOUT_SECS': SECURE_SETTINGS.get('badge_negative_cache_timeout_secs', 3600),
+    # add_users requests for more than this many users are handed off to an
+    # rq worker instead of being processed inside the web request
+    'ASYNC_ADD_USERS_THRESHOLD': SECURE_SETTINGS.get('async_add_users_threshold', 5),
+    # how long finished add_users jobs (and their per-user results) are kept
+    'ADD_USERS_JOB_RESULT_TTL_SECS': SECURE_SETTINGS.get('add_users_job_result_ttl_secs', 3600),
+    # user_form loads the enrollments added through the tool this many at a
+    # time, from a per-course list cached for ENROLLMENTS_CACHE_TIMEOUT_SECS
+    'USER_FORM_PAGE_SIZE': SECURE_SETTINGS.get('user_form_page_size', 100),
+    'ENROLLMENTS_CACHE_TIMEOUT_SECS': SECURE_SETTINGS.get('enrollments_cache_timeout_secs', 300),
+    # how long the per-course set of manually-added (non-feed) members is cached
+    'ELIGIBLE_MEMBERS_CACHE_TIMEOUT_SECS': SECURE_SETTINGS.get('eligible_members_cache_timeout_secs', 60),
     'MSGS': {
         'lti_request': 'There was a problem fulfilling your request. Please contact HUIT support.',
         'no_dir_member_chosen': 'You must choose at least one directory record.',
@@ -370,7 +396,30 @@ MANAGE_PEOPLE = {
 }
 
 MANAGE_SECTIONS = {
-    'TEST_STUDENT_ROLE': 'StudentViewEnrollment'
+    'TEST_STUDENT_ROLE': 'StudentViewEnrollment',
+    # upper bound on concurrent Canvas API calls made while serving a single
+    # manage_sections request
+    'CANVAS_API_MAX_WORKERS': SECURE_SETTINGS.get('manage_sections_canvas_api_max_workers', 5),
+    # concurrent enrollment deletes when emptying a section, and how often /
+    # how patiently to retry a delete that Canvas rate-limits (the backoff
+    # doubles on each retry)
+    'DELETE_ENROLLMENTS_MAX_WORKERS': SECURE_SETTINGS.get('delete_enrollments_max_workers', 5),
+    'CANVAS_RATE_LIMIT_RETRIES': SECURE_SETTINGS.get('canvas_rate_limit_retries', 3),
+    'CANVAS_RATE_LIMIT_BACKOFF_SECS': SECURE_SETTINGS.get('canvas_rate_limit_backoff_secs', 1),
+    # sections with more enrollments than this are removed by an rq worker
+    # rather than in the request, which is retried (resuming where it left
+    # off) up to REMOVE_SECTION_JOB_MAX_RETRIES times
+    'ASYNC_REMOVE_SECTION_THRESHOLD': SECURE_SETTINGS.get('async_remove_section_threshold', 50),
+    'REMOVE_SECTION_JOB_TIMEOUT_SECS': SECURE_SETTINGS.get('remove_section_job_timeout_secs', 1800),
+    'REMOVE_SECTION_JOB_RESULT_TTL_SECS': SECURE_SETTINGS.get('remove_section_job_result_ttl_secs', 3600),
+    'REMOVE_SECTION_JOB_MAX_RETRIES': SECURE_SETTINGS.get('remove_section_job_max_retries', 3),
+    # how long the course enrollments behind the section class list are
+    # cached; adds and removes patch the cached list in place
+    'COURSE_ENROLLMENTS_CACHE_TIMEOUT_SECS': SECURE_SETTINGS.get('course_enrollments_cache_timeout_secs', 300),
+    # how long each include variant of a course is cached for
+    'COURSE_CACHE_TIMEOUT_SECS': SECURE_SETTINGS.get('manage_sections_course_cache_timeout_secs', 300),
+    # default number of courses the sync_canvas_sections command syncs at once
+    'SYNC_CANVAS_SECTIONS_WORKERS': SECURE_SETTINGS.get('sync_canvas_sections_workers', 4),
 }
 
 ICOMMONS_REST_API_TOKEN = SECURE_SETTINGS.get('icommons_rest_api_token')
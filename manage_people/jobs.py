@@ -0,0 +1,59 @@
+import logging
+
+from rq import get_current_job
+
+from manage_people.views import (EnrollmentBatch, EnrollmentError,
+                                 add_member_to_course,
+                                 get_canvas_role_labels_by_user_role_id)
+
+logger = logging.getLogger(__name__)
+
+
+def add_users_to_course(users_to_add, course_instance_id, canvas_course_id):
+    """
+    Background version of the add_users view, run by an rq worker. Each
+    selected user is enrolled in turn, and the outcome for every user (rather
+    than just the first failure) is recorded in job.meta as it happens so the
+    confirmation page can poll for progress via the add_users_status view.
+    :param users_to_add: dict of user_id to user_role_id
+    :return: list of per-user result dicts (also stored in job.meta['results'])
+    """
+    job = get_current_job()
+    meta = job.meta if job else {}
+    meta.update({'total': len(users_to_add), 'completed': 0, 'results': []})
+    if job:
+        job.save_meta()
+
+    labels_by_user_role_id = get_canvas_role_labels_by_user_role_id()
+
+    with EnrollmentBatch(course_instance_id, canvas_course_id) as batch:
+        for user_id, user_role_id in list(users_to_add.items()):
+            result = {'user_id': user_id, 'existing': False, 'error': None}
+            try:
+                existing, person = add_member_to_course(
+                    user_id, int(user_role_id), course_instance_id,
+                    canvas_course_id, batch=batch)
+                result.update({
+                    'existing': existing,
+                    'name_first': person.name_first,
+                    'name_last': person.name_last,
+                    'email_address': person.email_address,
+                    'badge_label': person.badge_label,
+                    'role_id': person.role_id,
+                    'canvas_role_label': labels_by_user_role_id.get(
+                        person.role_id, 'Unknown'),
+                })
+            except EnrollmentError as e:
+                result['error'] = f"[User: {e.user_id or user_id}]: {e.message}"
+            except Exception as e:
+                logger.exception(
+                    'Unexpected error adding user %s to course_instance_id %s',
+                    user_id, course_instance_id)
+                result['error'] = f"[User: {user_id}]: {str(e)}"
+
+            meta['results'].append(result)
+            meta['completed'] += 1
+            if job:
+                job.save_meta()
+
+    return meta['results']
@@ -0,0 +1,58 @@
+$(document).ready(function(){
+    var pollIntervalMs = 2000;
+    var renderedResults = 0;
+
+    function renderResult(result) {
+        if (result.error) {
+            $('<li>').addClass('text-danger').text(result.error)
+                .appendTo('#enrollment_errors');
+            return;
+        }
+        var badgeLabel = result.badge_label != 'XID' ? result.badge_label : 'Harvard Guest';
+        var $status = $('<span>').addClass('text-strong');
+        if (result.existing) {
+            $status.text(' Already enrolled as a ' + result.canvas_role_label);
+        } else {
+            $status.addClass('text-success')
+                .text(' Enrolled as a ' + result.canvas_role_label);
+        }
+        $status.prepend($('<i>').addClass('fa fa-check'));
+        $('<li>')
+            .append(document.createTextNode(result.email_address + ' '))
+            .append($('<span>').addClass('label').text(badgeLabel))
+            .append($('<div>').addClass('float-right').append($status))
+            .appendTo('#enrollment_confirmations');
+    }
+
+    function pollStatus() {
+        $.ajax({
+            url: addUsersStatusURL,
+            type: 'GET',
+            dataType: 'json',
+            success: function (json) {
+                $('#add-users-completed').text(json.completed);
+                $('#add-users-total').text(json.total);
+                // results are append-only, so only render the new ones
+                $.each(json.results.slice(renderedResults), function (i, result) {
+                    renderResult(result);
+                });
+                renderedResults = json.results.length;
+
+                if (json.status == 'finished') {
+                    $('#add-users-progress').addClass('hidden');
+                } else if (json.status == 'failed' || json.status == 'stopped' || json.status == 'canceled') {
+                    $('#add-users-progress').addClass('hidden');
+                    $('#add-users-job-failed').removeClass('hidden');
+                } else {
+                    setTimeout(pollStatus, pollIntervalMs);
+                }
+            },
+            error: function (xhr) {
+                $('#add-users-progress').addClass('hidden');
+                $('#add-users-job-failed').removeClass('hidden');
+            }
+        });
+    }
+
+    pollStatus();
+});
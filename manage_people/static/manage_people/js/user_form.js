@@ -1,11 +1,62 @@
 $(document).ready(function(){
-    if (!$("#people-added li").length) {
-        $('#no-users-added').removeClass('hidden');
-    } else {
-        $('#people-added').removeClass('hidden');
+    var rowCount = 0;
+
+    function renderEnrollment(enrollee) {
+        rowCount++;
+        var $row = $('<li>')
+            .attr('id', 'user-index-' + rowCount)
+            .addClass('rosterUser al-hover-container')
+            .attr('data-sisID', enrollee.sis_user_id)
+            .attr('data-role-id', enrollee.role_id)
+            .attr('data-user-role-id', enrollee.user_role_id)
+            .attr('data-canvas-role-label', enrollee.canvas_role_label);
+
+        if (enrollee.can_be_deleted) {
+            $('<a class="deleteMenu delete-icon" href="#"><i class="fa fa-trash"></i></a>')
+                .on('click', handleDeleteClick)
+                .appendTo($row);
+        } else {
+            $('<a class="delete-icon-disabled-tooltip" href="#" data-toggle="tooltip"><i class="fa fa-trash"></i></a>')
+                .attr('title', "This enrollment can only be deleted by an admin due to the user's role.")
+                .tooltip({placement: 'top'})
+                .appendTo($row);
+        }
+
+        var badgeLabel = enrollee.badge_label_name != 'XID' ? enrollee.badge_label_name : 'Harvard Guest';
+        $row.append(' ', $('<span class="roster_user_name">').text(enrollee.sortable_name))
+            .append(' ', $('<span class="label">').text(badgeLabel || ''))
+            .append(' ', $('<span class="float-right text-strong">').text(enrollee.canvas_role_label));
+        return $row;
+    }
+
+    // fetch the enrollments a page at a time, rendering each page as it
+    // arrives so the first rows show up without waiting for the whole list
+    function loadEnrollments(cursor) {
+        $.ajax({
+            url: userFormEnrollmentsURL,
+            type: 'GET',
+            dataType: 'json',
+            data: cursor ? {'cursor': cursor} : {},
+            success: function (json) {
+                $('#people-added').append($.map(json.enrollments, renderEnrollment));
+                if (json.next_cursor) {
+                    loadEnrollments(json.next_cursor);
+                    return;
+                }
+                $('#people-added-loading').addClass('hidden');
+                if (!rowCount) {
+                    $('#people-added').addClass('hidden');
+                    $('#no-users-added').removeClass('hidden');
+                }
+            },
+            error: function (xhr) {
+                $('#people-added-loading').addClass('hidden');
+                $('#people-added-failed').removeClass('hidden');
+            }
+        });
     }
 
-    $('.deleteMenu').on('click', handleDeleteClick);
+    loadEnrollments(null);
 
     function handleDeleteClick(e) {
         var $deleteBtn = $(this);
@@ -0,0 +1,59 @@
+from django.test import TestCase
+from mock import MagicMock, Mock, patch
+
+from manage_people.jobs import add_users_to_course
+from manage_people.views import EnrollmentError
+
+
+@patch('manage_people.jobs.get_canvas_role_labels_by_user_role_id',
+       Mock(return_value={10: 'Guest'}))
+@patch('manage_people.jobs.EnrollmentBatch', MagicMock())
+@patch('manage_people.jobs.add_member_to_course')
+@patch('manage_people.jobs.get_current_job')
+class AddUsersToCourseTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.course_instance_id = 123
+        self.canvas_course_id = 456
+
+    def get_person(self, user_id):
+        return Mock(name_first='Jane', name_last=user_id,
+                    email_address=f'{user_id}@example.edu',
+                    badge_label='HUID', role_id=10)
+
+    def test_progress_saved_per_user(self, mock_get_current_job,
+                                     mock_add_member):
+        job = mock_get_current_job.return_value
+        job.meta = {}
+        mock_add_member.side_effect = \
+            lambda user_id, *args: (False, self.get_person(user_id))
+
+        results = add_users_to_course({'1': '10', '2': '10'},
+                                      self.course_instance_id,
+                                      self.canvas_course_id)
+
+        self.assertEqual([r['user_id'] for r in results], ['1', '2'])
+        self.assertEqual(results[0]['canvas_role_label'], 'Guest')
+        self.assertEqual(job.meta['completed'], 2)
+        self.assertEqual(job.meta['total'], 2)
+        # once up front, then once per user
+        self.assertEqual(job.save_meta.call_count, 3)
+
+    def test_failure_recorded_and_remaining_users_added(
+            self, mock_get_current_job, mock_add_member):
+        mock_get_current_job.return_value.meta = {}
+
+        def add_member(user_id, *args):
+            if user_id == '1':
+                raise EnrollmentError('already enrolled', user_id)
+            return False, self.get_person(user_id)
+        mock_add_member.side_effect = add_member
+
+        results = add_users_to_course({'1': '10', '2': '10'},
+                                      self.course_instance_id,
+                                      self.canvas_course_id)
+
+        self.assertEqual(results[0]['error'], '[User: 1]: already enrolled')
+        self.assertIsNone(results[1]['error'])
+        self.assertEqual(mock_add_member.call_count, 2)
@@ -1,3 +1,4 @@
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
 from django.core.exceptions import ObjectDoesNotExist
 from mock import Mock, patch
@@ -7,11 +8,15 @@ from icommons_common.models import (
     CourseGuest,
     CourseEnrollee,
     CourseStaff,
+    UserRole,
 )
 
 from manage_people.utils import (
+    PEOPLE_LOOKUP_CHUNK_SIZES,
+    UserRoleIndex,
     get_available_roles,
     get_course_member_class,
+    get_role_types_for_univ_ids,
 )
 
 
@@ -91,3 +96,132 @@ class GetCourseMemberClassTest(TestCase):
         mock_role = Mock(guest="0", staff="0", student="0")
         with self.assertRaises(RuntimeError):
             get_course_member_class(mock_role)
+
+
+class UserRoleIndexTest(TestCase):
+    fixtures = ['user_role.json']
+    longMessage = True
+
+    def setUp(self):
+        self.index = UserRoleIndex(ttl=3600)
+
+    def test_lookups_served_from_memory_after_first_load(self):
+        """
+        Only the first lookup should hit the database.
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(self.index.get(10).role_id, 10)
+            self.assertEqual(self.index.first_by_canvas_role_id(9).role_id, 10)
+            self.assertIsNone(self.index.get(99999))
+            self.assertEqual(len(self.index.all()), UserRole.objects.count())
+
+    def test_invalidate_reloads(self):
+        self.index.get(10)
+        self.index.invalidate()
+        with self.assertNumQueries(1):
+            self.index.get(10)
+
+    def test_derived_values_rebuilt_on_reload(self):
+        build = Mock(side_effect=['first', 'second'])
+        self.assertEqual(self.index.derived('key', build), 'first')
+        self.assertEqual(self.index.derived('key', build), 'first')
+        self.assertEqual(build.call_count, 1)
+        self.index.invalidate()
+        self.assertEqual(self.index.derived('key', build), 'second')
+        self.assertEqual(build.call_count, 2)
+
+    def test_ttl_expiry_reloads(self):
+        index = UserRoleIndex(ttl=0)
+        index.get(10)
+        with self.assertNumQueries(1):
+            index.get(10)
+
+    def test_get_by_canvas_role_id_matches_orm_get_semantics(self):
+        self.assertEqual(self.index.get_by_canvas_role_id(9).role_id, 10)
+        with self.assertRaises(UserRole.DoesNotExist):
+            self.index.get_by_canvas_role_id(99999)
+
+
+@patch('manage_people.utils.connections')
+class GetRoleTypesForUnivIdsTest(TestCase):
+    longMessage = True
+
+    def get_cursor(self, mock_connections):
+        return mock_connections.__getitem__.return_value.cursor.return_value\
+            .__enter__.return_value
+
+    def test_no_query_for_empty_input(self, mock_connections):
+        self.assertEqual(get_role_types_for_univ_ids([None, '']), {})
+        self.assertFalse(mock_connections.__getitem__.called)
+
+    def test_ids_sent_as_bind_variables(self, mock_connections):
+        cursor = self.get_cursor(mock_connections)
+        cursor.fetchall.return_value = [('12345678', 'STUDENT')]
+        result = get_role_types_for_univ_ids(
+            ['12345678', "1'); drop table x; --", '12345678'])
+        self.assertEqual(result, {'12345678': 'STUDENT'})
+        self.assertEqual(cursor.execute.call_count, 1)
+        query, params = cursor.execute.call_args[0]
+        self.assertNotIn('12345678', query)
+        self.assertNotIn('*', query)
+        # de-duplicated, over-long id dropped, padded to the smallest size
+        self.assertEqual(params, ['12345678'])
+
+    def test_statement_shapes_limited_to_chunk_sizes(self, mock_connections):
+        cursor = self.get_cursor(mock_connections)
+        cursor.fetchall.return_value = []
+        for roster_size in (2, 37, 101, 998, 1000, 2500):
+            cursor.execute.reset_mock()
+            univ_ids = [str(10000000 + i) for i in range(roster_size)]
+            get_role_types_for_univ_ids(univ_ids)
+            sent = set()
+            for (query, params), _ in cursor.execute.call_args_list:
+                self.assertIn(len(params), PEOPLE_LOOKUP_CHUNK_SIZES,
+                              f'roster of {roster_size}')
+                self.assertEqual(query.count('%s'), len(params))
+                sent.update(params)
+            self.assertEqual(sent, set(univ_ids))
+
+
+@patch('manage_people.utils._query_role_types_for_univ_ids')
+class GetRoleTypesForUnivIdsCacheTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.cache = LocMemCache('role-types', {})
+        patcher = patch('manage_people.utils.cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_warm_lookup_issues_no_query(self, mock_query):
+        mock_query.return_value = {'12345678': 'STUDENT'}
+        get_role_types_for_univ_ids(['12345678'])
+        mock_query.reset_mock()
+        result = get_role_types_for_univ_ids(['12345678'])
+        self.assertEqual(result, {'12345678': 'STUDENT'})
+        self.assertFalse(mock_query.called)
+
+    def test_only_misses_are_queried(self, mock_query):
+        mock_query.return_value = {'12345678': 'STUDENT'}
+        get_role_types_for_univ_ids(['12345678'])
+        mock_query.return_value = {'87654321': 'EMPLOYEE'}
+        result = get_role_types_for_univ_ids(['12345678', '87654321'])
+        mock_query.assert_called_with({'87654321'})
+        self.assertEqual(result, {'12345678': 'STUDENT',
+                                  '87654321': 'EMPLOYEE'})
+
+    def test_ids_not_found_are_negatively_cached(self, mock_query):
+        mock_query.return_value = {}
+        self.assertEqual(get_role_types_for_univ_ids(['12345678']), {})
+        mock_query.reset_mock()
+        self.assertEqual(get_role_types_for_univ_ids(['12345678']), {})
+        self.assertFalse(mock_query.called)
+
+    def test_empty_role_types_not_mistaken_for_not_found(self, mock_query):
+        mock_query.return_value = {'12345678': '', '87654321': None}
+        expected = {'12345678': '', '87654321': None}
+        self.assertEqual(get_role_types_for_univ_ids(['12345678', '87654321']), expected)
+        mock_query.reset_mock()
+        # served from the cache, and still found
+        self.assertEqual(get_role_types_for_univ_ids(['12345678', '87654321']), expected)
+        self.assertFalse(mock_query.called)
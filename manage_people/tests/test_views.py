@@ -1,9 +1,13 @@
 import random
+import threading
 import uuid
 
-from django.test import RequestFactory, TestCase
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory, TestCase, override_settings
 from mock import patch, Mock, ANY, call
 
+from canvas_sdk.exceptions import CanvasAPIError
 from canvas_sdk.methods import enrollments
 from icommons_common.models import (
     CourseEnrollee,
@@ -12,10 +16,14 @@ from icommons_common.models import (
 )
 
 from manage_people.views import (
+    EnrollmentBatch,
     add_member_to_course,
     get_badge_info_for_users,
     get_badge_label_name,
     get_enrollments_added_through_tool,
+    get_eligible_course_members,
+    get_enrollments_added_through_tool_page,
+    get_enrolled_roles_for_user_ids,
     remove_user
 )
 
@@ -52,14 +60,14 @@ class RemoveUserTests(TestCase):
         }
 
     @patch('manage_people.views.get_course_member_class')
-    @patch('manage_people.views.UserRole.objects.get')
     @patch('manage_people.views.enrollments.conclude_enrollment')
     @patch('manage_people.views.get_all_list_data')
     @patch('manage_people.views.get_user_role_if_permitted')
     def test_canvas_enrollments_removed(
             self, mock_user_role, mock_sdk_get_all, mock_conclude_enrollment,
-            mock_ur_get, mock_get_member_class, *args, **kwargs):
-        # get_all_list_data(CTX, enrollments.list_enrollments_users, user_id)
+            mock_get_member_class, *args, **kwargs):
+        # get_all_list_data(CTX, enrollments.list_enrollments_courses,
+        #                   canvas_course_id, user_id=user_id)
         mock_sdk_get_all.return_value = [
             {'id': 1, 'course_id': self.canvas_course_id,
                 'role_id': self.role_id_to_remove},
@@ -73,6 +81,11 @@ class RemoveUserTests(TestCase):
         # call the view
         response = remove_user(self.request)
 
+        # only the test course's enrollments should have been listed
+        mock_sdk_get_all.assert_called_once_with(
+            ANY, enrollments.list_enrollments_courses, self.canvas_course_id,
+            user_id='sis_user_id:%s' % self.user_id)
+
         # we should only be removing role 10 from the test course
         self.assertEqual(mock_conclude_enrollment.call_count, 1)
 
@@ -84,13 +97,71 @@ class RemoveUserTests(TestCase):
         self.assertEqual(response.status_code, 200)
 
     @patch('manage_people.views.get_course_member_class')
-    @patch('manage_people.views.UserRole.objects.get')
+    @patch('manage_people.views.enrollments.conclude_enrollment')
+    @patch('manage_people.views.get_all_list_data')
+    @patch('manage_people.views.get_user_role_if_permitted')
+    def test_only_course_enrollments_listed(
+            self, mock_user_role, mock_sdk_get_all, mock_conclude_enrollment,
+            mock_get_member_class, *args, **kwargs):
+        """
+        The user's enrollments are listed through the course's endpoint, in
+        a single call, however many sections of the course they're in; the
+        user's enrollments in every other course are never listed.
+        """
+        mock_sdk_get_all.return_value = [
+            {'id': enrollment_id, 'course_id': self.canvas_course_id,
+                'role_id': self.role_id_to_remove}
+            for enrollment_id in (1, 2, 3)
+        ]
+        mock_user_role.return_value = Mock(
+            canvas_role_id=self.role_id_to_remove)
+
+        response = remove_user(self.request)
+
+        self.assertEqual(mock_sdk_get_all.call_count, 1)
+        (_, method, canvas_course_id), _ = mock_sdk_get_all.call_args
+        self.assertIs(method, enrollments.list_enrollments_courses)
+        self.assertEqual(canvas_course_id, self.canvas_course_id)
+        # one conclude per section enrollment in the course
+        self.assertEqual(mock_conclude_enrollment.call_count, 3)
+        self.assertEqual(response.status_code, 200)
+
+    @patch('manage_people.views.get_course_member_class')
+    @patch('manage_people.views.enrollments.conclude_enrollment')
+    @patch('manage_people.views.get_all_list_data')
+    @patch('manage_people.views.get_user_role_if_permitted')
+    def test_failed_canvas_removal_returns_error(
+            self, mock_user_role, mock_sdk_get_all, mock_conclude_enrollment,
+            mock_get_member_class, *args, **kwargs):
+        mock_sdk_get_all.return_value = [
+            {'id': enrollment_id, 'course_id': self.canvas_course_id,
+                'role_id': self.role_id_to_remove}
+            for enrollment_id in (1, 2, 3)
+        ]
+        mock_user_role.return_value = Mock(
+            canvas_role_id=self.role_id_to_remove)
+
+        def conclude(ctx, course_id, enrollment_id, task):
+            if enrollment_id == 2:
+                raise CanvasAPIError()
+        mock_conclude_enrollment.side_effect = conclude
+
+        response = remove_user(self.request)
+
+        # every section enrollment is attempted, but the coursemanager
+        # membership is left in place
+        self.assertEqual(mock_conclude_enrollment.call_count, 3)
+        self.assertFalse(
+            mock_get_member_class.return_value.objects.get.called)
+        self.assertEqual(response.status_code, 500)
+
+    @patch('manage_people.views.get_course_member_class')
     @patch('manage_people.views.enrollments.conclude_enrollment')
     @patch('manage_people.views.get_all_list_data')
     @patch('manage_people.views.get_user_role_if_permitted')
     def test_coursemanger_membership_removed(
             self, mock_user_role, mock_sdk_get_all, mock_conclude_enrollment,
-            mock_ur_get, mock_get_member_class, *args, **kwargs):
+            mock_get_member_class, *args, **kwargs):
         mock_user_role.return_value = Mock(
             canvas_role_id=self.role_id_to_remove)
         response = remove_user(self.request)
@@ -129,7 +200,7 @@ class AddMemberToCourseTests(TestCase):
     @patch('manage_people.views.add_canvas_course_enrollee')
     @patch('manage_people.views.get_canvas_course_section',
             return_value=None)
-    @patch('manage_people.views.Person.objects.filter')
+    @patch('manage_people.views.get_role_types_for_univ_ids')
     def test_add_member_to_course(self, mock_person_filter,
                                   mock_get_canvas_course_section,
                                   mock_add_canvas_course_enrollee,
@@ -182,7 +253,7 @@ class AddMemberToCourseTests(TestCase):
     @patch('manage_people.views.get_user_role_if_permitted')
     @patch('manage_people.views.add_canvas_course_enrollee')
     @patch('manage_people.views.get_course_member_class')
-    @patch('manage_people.views.Person.objects.filter')
+    @patch('manage_people.views.get_role_types_for_univ_ids')
     def test_add_member_to_course_existing_enrollment(self,
             mock_person_filter, mock_get_course_member_class,
             mock_add_canvas_course_enrollee, mock_user_role):
@@ -232,6 +303,41 @@ class AddMemberToCourseTests(TestCase):
             mock_person_filter.reset_mock()
 
 
+    @patch('manage_people.views.canvas_api_helper_sections.delete_cache')
+    @patch('manage_people.views.canvas_api_helper_enrollments.delete_cache')
+    @patch('manage_people.views.canvas_api_helper_courses.delete_cache')
+    @patch('manage_people.views.add_canvas_section_enrollee',
+           Mock(return_value={'id': 1}))
+    @patch('manage_people.views.get_user_role_to_canvas_role_map',
+           Mock(return_value={10: {'role': 'GuestEnrollment'}}))
+    @patch('manage_people.views.get_canvas_course_section',
+           Mock(return_value={'id': 99}))
+    @patch('manage_people.views.Person', Mock())
+    @patch('manage_people.views.get_course_member_class', Mock())
+    @patch('manage_people.views.get_user_role_if_permitted',
+           Mock(return_value=Mock(role_id=10, role_name='Guest',
+                                  canvas_role_id=9)))
+    def test_batch_resolves_lookups_and_deletes_caches_once(
+            self, *mock_delete_caches):
+        """
+        The section and role map lookups, and the cache deletes, behind a
+        batch of additions are paid once per batch, not once per user.
+        """
+        import manage_people.views as views
+        counters = (views.get_canvas_course_section,
+                    views.get_user_role_to_canvas_role_map) + mock_delete_caches
+        canvas_course_id = random.randint(1, SQLITE_MAXINT)
+        course_instance_id = random.randint(1, SQLITE_MAXINT)
+
+        with EnrollmentBatch(course_instance_id, canvas_course_id) as batch:
+            for i in range(10):
+                add_member_to_course(str(10000000 + i), 10, course_instance_id,
+                                     canvas_course_id, batch=batch)
+
+        self.assertEqual(views.add_canvas_section_enrollee.call_count, 10)
+        for counter in counters:
+            self.assertEqual(counter.call_count, 1, counter)
+
 # TODO: add test for "not registrar-fed" query logic.  maybe split out?
 @patch('manage_people.views.get_roles_for_account_id')
 @patch('manage_people.views.get_all_list_data')
@@ -249,20 +355,16 @@ class GetEnrollmentsAddedThroughTool(TestCase):
             {'user': {'sis_user_id': user_id, 'sortable_name': 'Burn, Acid'},
              'role': 'Guest', 'role_id': 9},
         ]
-        course_enrollees = [  # result of query for non-feed enrollments
-            (user_id, 10),  # Guest
+        course_enrollees = [  # result of the course member query
+            (user_id, 10, 'managecrs'),  # Guest
         ]
 
         # set up the mocks
         mock_get_all_list_data.return_value = canvas_enrollments
-        mock_course_member = Mock(**{
-            'objects.filter.return_value.values_list.return_value':
-                course_enrollees,
-        })
-        # since we're prepping the mock_course_member here, we have to resort
+        # since we're prepping the course members here, we have to resort
         # to the patch().start() syntax here, instead of decorating it
-        patch('manage_people.views.COURSE_MEMBER_CLASSES',
-              [mock_course_member]).start()
+        patch('manage_people.views._query_course_members',
+              Mock(return_value=course_enrollees)).start()
 
         # run it
         result = get_enrollments_added_through_tool(course_instance_id)
@@ -287,18 +389,16 @@ class GetEnrollmentsAddedThroughTool(TestCase):
             {'user': {'sis_user_id': user_id, 'sortable_name': 'Burn, Acid'},
              'role': 'Guest', 'role_id': 9},
         ]
-        course_enrollees = []  # result of query for non-feed enrollments
+        course_enrollees = [  # result of the course member query
+            (user_id, 10, 'fasfeed'),  # Guest, from the registrar feed
+        ]
 
         # set up the mocks
         mock_get_all_list_data.return_value = canvas_enrollments
-        mock_course_member = Mock(**{
-            'objects.filter.return_value.values_list.return_value':
-                course_enrollees,
-        })
-        # since we're prepping the mock_course_member here, we have to resort
+        # since we're prepping the course members here, we have to resort
         # to the patch().start() syntax here, instead of decorating it
-        patch('manage_people.views.COURSE_MEMBER_CLASSES',
-              [mock_course_member]).start()
+        patch('manage_people.views._query_course_members',
+              Mock(return_value=course_enrollees)).start()
 
         # run it
         result = get_enrollments_added_through_tool(course_instance_id)
@@ -327,20 +427,16 @@ class GetEnrollmentsAddedThroughTool(TestCase):
             {'user': {'sis_user_id': user_id, 'sortable_name': 'Burn, Acid'},
              'role': 'ObserverEnrollment', 'role_id': 7},
         ]
-        course_enrollees = [  # result of query for non-feed enrollments
-            (user_id, 10),  # Guest
+        course_enrollees = [  # result of the course member query
+            (user_id, 10, 'managecrs'),  # Guest
         ]
 
         # set up the mocks
         mock_get_all_list_data.return_value = canvas_enrollments
-        mock_course_member = Mock(**{
-            'objects.filter.return_value.values_list.return_value':
-                course_enrollees,
-        })
-        # since we're prepping the mock_course_member here, we have to resort
+        # since we're prepping the course members here, we have to resort
         # to the patch().start() syntax here, instead of decorating it
-        patch('manage_people.views.COURSE_MEMBER_CLASSES',
-              [mock_course_member]).start()
+        patch('manage_people.views._query_course_members',
+              Mock(return_value=course_enrollees)).start()
 
         # run it
         result = get_enrollments_added_through_tool(course_instance_id)
@@ -356,6 +452,36 @@ class GetEnrollmentsAddedThroughTool(TestCase):
         self.assertDictContainsSubset(canvas_enrollments[0], result[0])
 
 
+    @patch('manage_people.views.get_badge_info_for_users', Mock(return_value={}))
+    @patch('manage_people.views.get_canvas_to_user_role_id_map',
+           Mock(return_value={9: 10}))
+    @patch('manage_people.utils.get_available_roles')
+    def test_permitted_roles_resolved_once_per_course(
+            self, mock_get_available_roles, mock_get_all_list_data,
+            mock_role_map):
+        """
+        The roles the user may manage are looked up once for the course, not
+        once per enrollment.
+        """
+        course_instance_id = uuid.uuid4().int
+        user_ids = [str(10000000 + i) for i in range(100)]
+        mock_get_available_roles.return_value = [{'role_id': 10}]
+        mock_get_all_list_data.return_value = [
+            {'user': {'sis_user_id': user_id,
+                      'sortable_name': f'User, {user_id}'},
+             'role': 'Guest', 'role_id': 9}
+            for user_id in user_ids
+        ]
+        course_members = [(user_id, 10, 'managecrs') for user_id in user_ids]
+
+        with patch('manage_people.views._query_course_members',
+                   Mock(return_value=course_members)):
+            result = get_enrollments_added_through_tool(course_instance_id)
+
+        self.assertEqual(len(result), len(user_ids))
+        self.assertTrue(all(e['can_be_deleted'] for e in result))
+        self.assertEqual(mock_get_available_roles.call_count, 1)
+
 class GetBadgeInfoForUsersTests(TestCase):
     longMessage = True
 
@@ -386,35 +512,200 @@ class GetBadgeInfoForUsersTests(TestCase):
         self.assertDictEqual(result_for_empty_list, {})
 
     @patch('manage_people.views.logger.warn')
-    @patch('manage_people.views.Person.objects.filter')
+    @patch('manage_people.views.get_role_types_for_univ_ids')
     def test_non_matching_input(self, mock_person, mock_logger_warn):
         """
         If input list contains info that doesn't match the Person lookup,
         the function should return all user_ids in the input list, returning a default
         badge label for any user_ids that do not have a role_type_cd, and log a warning.
         """
-        mock_person.return_value.values_list.return_value = self.person_object_values
+        mock_person.return_value = dict(self.person_object_values)
         result = get_badge_info_for_users(self.bad_input)
         self.assertDictEqual(result, self.expected_results_for_bad_input)
         self.assertTrue(mock_logger_warn.called)
 
     @patch('manage_people.views.logger.warn')
-    @patch('manage_people.views.Person.objects.filter')
+    @patch('manage_people.views.get_role_types_for_univ_ids')
     def test_matching_input(self, mock_person, mock_logger_warn):
         """
         If input list contains one-to-one matches for Person lookup,
         the function should return a comprehensive mapping of input IDs to badge labels.
         """
-        mock_person.return_value.values_list.return_value = self.person_object_values
+        mock_person.return_value = dict(self.person_object_values)
         result = get_badge_info_for_users(self.user_id_input_list)
         self.assertDictEqual(result, self.expected_results)
         self.assertFalse(mock_logger_warn.called)
 
-    @patch('manage_people.views.Person.objects.filter')
+    @patch('manage_people.views.get_role_types_for_univ_ids')
     def test_db_error_raises_exception(self, mock_person):
         """
         If Person lookup fails due to database issue, the function will raise the exception up the stack.
         """
-        mock_person.return_value.values_list.side_effect = Exception
+        mock_person.side_effect = Exception
         with self.assertRaises(Exception):
             result = get_badge_info_for_users(self.user_id_input_list)
+
+
+@patch('manage_people.views._annotate_enrollments_added_through_tool', Mock())
+@patch('manage_people.views._list_enrollments_added_through_tool')
+class GetEnrollmentsAddedThroughToolPageTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.course_instance_id = 123456
+        # includes two enrollments with the same sortable_name
+        self.enrollments = [
+            {'user': {'sis_user_id': str(i), 'sortable_name': name},
+             'role_id': 9}
+            for i, name in enumerate(['Alpha, A', 'Beta, B', 'Beta, B',
+                                      'Delta, D', 'Gamma, G'])
+        ]
+
+    def test_pages_cover_every_enrollment_once(self, mock_list):
+        mock_list.return_value = self.enrollments
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = get_enrollments_added_through_tool_page(
+                self.course_instance_id, cursor=cursor, page_size=2)
+            seen.extend(e['user']['sis_user_id'] for e in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['0', '1', '2', '3', '4'])
+
+    def test_cursor_survives_removal_of_earlier_rows(self, mock_list):
+        mock_list.return_value = self.enrollments
+        _, cursor = get_enrollments_added_through_tool_page(
+            self.course_instance_id, page_size=2)
+        # someone on the first page is removed before the next page is fetched
+        mock_list.return_value = self.enrollments[1:]
+        page, _ = get_enrollments_added_through_tool_page(
+            self.course_instance_id, cursor=cursor, page_size=2)
+        self.assertEqual([e['user']['sis_user_id'] for e in page], ['2', '3'])
+
+    def test_invalid_cursor(self, mock_list):
+        mock_list.return_value = self.enrollments
+        with self.assertRaises(ValueError):
+            get_enrollments_added_through_tool_page(
+                self.course_instance_id, cursor='not-a-cursor')
+
+
+
+@patch('manage_people.views.get_permitted_role_ids', Mock(return_value={10}))
+@patch('manage_people.views.get_badge_info_for_users')
+@patch('manage_people.views._list_enrollments_added_through_tool')
+class GetEnrollmentsAddedThroughToolPageBadgeTests(TestCase):
+    longMessage = True
+    course_instance_id = 123456
+
+    def test_badges_looked_up_for_page_rows_only(self, mock_list,
+                                                 mock_get_badge_info):
+        """
+        A page only pays for the badge lookups of the rows it returns, not
+        for every enrollment in the course.
+        """
+        mock_get_badge_info.side_effect = \
+            lambda user_ids: {user_id: 'HUID' for user_id in user_ids}
+        mock_list.return_value = [
+            {'user': {'sis_user_id': str(10000000 + i),
+                      'sortable_name': f'User, {10000000 + i}'},
+             'role_id': 9, 'user_role_id': 10}
+            for i in range(1000)
+        ]
+
+        with patch('manage_people.views.cache',
+                   LocMemCache('enrollments', {})):
+            page, next_cursor = get_enrollments_added_through_tool_page(
+                self.course_instance_id, page_size=100)
+
+        self.assertEqual(len(page), 100)
+        self.assertIsNotNone(next_cursor)
+        looked_up = [user_id for (user_ids,), _ in
+                     mock_get_badge_info.call_args_list
+                     for user_id in user_ids]
+        self.assertEqual(sorted(looked_up),
+                         sorted(e['user']['sis_user_id'] for e in page))
+
+@patch('manage_people.views._query_course_members')
+class GetEligibleCourseMembersTests(TestCase):
+    longMessage = True
+
+    def test_registrar_fed_members_excluded(self, mock_query):
+        mock_query.return_value = [
+            ('1', 10, 'managecrs'),
+            ('2', 10, None),
+            ('3', 10, 'xmlfeed'),
+            ('4', 10, 'ICFEED'),
+            ('5', 10, 'xreg_map'),
+            ('1', 0, 'fasfeed'),
+        ]
+        self.assertEqual(get_eligible_course_members(123456),
+                         {('1', 10), ('2', 10)})
+        mock_query.assert_called_once_with(123456)
+
+    def test_query_error_returns_empty_set(self, mock_query):
+        mock_query.side_effect = RuntimeError('ORA-03113')
+        self.assertEqual(get_eligible_course_members(123456), set())
+
+
+@patch('manage_people.views.get_roles_for_account_id', Mock(return_value={}))
+@patch('manage_people.views.user_role_index')
+@patch('manage_people.views.get_all_list_data')
+class GetEnrolledRolesForUserIdsTests(TestCase):
+    longMessage = True
+    canvas_course_id = 1234
+
+    def setUp(self):
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+    def fake_list_enrollments(self, barrier=None):
+        def list_enrollments(ctx, method, canvas_course_id, user_id=None,
+                             **kwargs):
+            with self.lock:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                if barrier:
+                    # only gets through once every lookup is in flight
+                    barrier.wait()
+                sis_user_id = user_id.split(':', 1)[1]
+                return [{'user': {'sis_user_id': sis_user_id}, 'role_id': 9}]
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+        return list_enrollments
+
+    @override_settings(MANAGE_PEOPLE=dict(settings.MANAGE_PEOPLE,
+                                          CANVAS_API_MAX_WORKERS=10))
+    def test_user_lookups_run_concurrently(self, mock_get_all_list_data,
+                                           mock_user_role_index):
+        user_ids = [str(10000000 + i) for i in range(4)]
+        mock_get_all_list_data.side_effect = self.fake_list_enrollments(
+            threading.Barrier(len(user_ids), timeout=5))
+        mock_user_role_index.first_by_canvas_role_id.return_value = Mock(
+            role_name='Guest')
+
+        found_ids, _ = get_enrolled_roles_for_user_ids(self.canvas_course_id,
+                                                       user_ids)
+
+        # serial lookups would break the barrier, and come back empty
+        self.assertEqual(sorted(found_ids.keys()), user_ids)
+        self.assertEqual(mock_get_all_list_data.call_count, len(user_ids))
+        self.assertEqual(self.peak_in_flight, len(user_ids))
+
+    @override_settings(MANAGE_PEOPLE=dict(settings.MANAGE_PEOPLE,
+                                          CANVAS_API_MAX_WORKERS=2))
+    def test_user_lookups_bounded_by_max_workers(self, mock_get_all_list_data,
+                                                 mock_user_role_index):
+        user_ids = [str(10000000 + i) for i in range(6)]
+        mock_get_all_list_data.side_effect = self.fake_list_enrollments()
+        mock_user_role_index.first_by_canvas_role_id.return_value = Mock(
+            role_name='Guest')
+
+        found_ids, _ = get_enrolled_roles_for_user_ids(self.canvas_course_id,
+                                                       user_ids)
+
+        self.assertEqual(sorted(found_ids.keys()), user_ids)
+        self.assertLessEqual(self.peak_in_flight, 2)
@@ -4,8 +4,10 @@ from manage_people import views
 
 urlpatterns = [
     path('user_form', views.user_form, name='user_form'),
+    path('user_form_enrollments', views.user_form_enrollments, name='user_form_enrollments'),
     path('results_list', views.results_list, name='results_list'),
     path('add_users', views.add_users, name='add_users'),
+    path('add_users_status/<str:job_id>', views.add_users_status, name='add_users_status'),
     path('remove_user', views.remove_user, name='remove_user'),
     path('find_user', views.find_user, name='find_user'),
 ]
@@ -1,10 +1,13 @@
 import json
 import logging
 import re
+import threading
+import time
 
 from django.conf import settings
 from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections, router
 from django.http import HttpResponse
 from django.shortcuts import render
 from django.utils.safestring import mark_safe
@@ -16,6 +19,7 @@ from icommons_common.models import (
     CourseGuest,
     CourseInstance,
     CourseStaff,
+    Person,
     UserRole,
 )
 
@@ -26,12 +30,133 @@ from manage_people.models import (
 
 
 cache = caches['shared']
-CACHE_KEY_CANVAS_ROLES_BY_USER_ROLE_ID_FOR_ACCOUNT = "canvas-roles-by-user-role-id-for-account-{}"
-CACHE_KEY_USER_ROLE_BY_ID = "user-role-by-id-{}"
+CACHE_KEY_PERSON_ROLE_TYPE = "person-role-type-v2-{}"
+# cached in place of a role type for univ_ids that are not in the people view.
+# It has to be something no role_type_cd can be, since people in the view can
+# have an empty or null role type (and still get a badge).
+PERSON_NOT_FOUND = '<person not found>'
 logger = logging.getLogger(__name__)
 IS_XID_RE = re.compile('[a-z]', re.IGNORECASE)
 SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
 
+PEOPLE_ROLE_TYPE_QUERY = ('select univ_id, role_type_cd '
+                          'from people.v_huid_and_xid_people '
+                          'where univ_id in ({})')
+# Every IN list sent to the people view is padded up to one of these sizes, so
+# the database only ever sees a handful of distinct statements and can keep
+# reusing their cursors instead of hard-parsing one per roster size. The
+# largest size stays under Oracle's 1000-item IN list limit.
+PEOPLE_LOOKUP_CHUNK_SIZES = (1, 10, 50, 100, 250, 500, 999)
+
+
+class UserRoleIndex:
+    """
+    In-process index of the UserRole table, keyed by role_id and by
+    canvas_role_id.
+
+    UserRole rows almost never change, so each worker loads the whole table
+    once and answers lookups from memory until the TTL expires or
+    invalidate() is called. Values derived from the table (e.g. the user role
+    to Canvas role map) are kept alongside it by derived(), and are dropped
+    whenever it's reloaded.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expires_at = 0
+        self._by_role_id = {}
+        self._by_canvas_role_id = {}
+        self._derived = {}
+
+    def _refresh_if_stale(self):
+        if time.monotonic() < self._expires_at:
+            return
+        with self._lock:
+            # another thread may have reloaded while we waited for the lock
+            if time.monotonic() < self._expires_at:
+                return
+            by_role_id = {}
+            by_canvas_role_id = {}
+            for user_role in UserRole.objects.order_by('role_id'):
+                by_role_id[int(user_role.role_id)] = user_role
+                if user_role.canvas_role_id is not None:
+                    by_canvas_role_id.setdefault(
+                        int(user_role.canvas_role_id), []).append(user_role)
+            self._by_role_id = by_role_id
+            self._by_canvas_role_id = by_canvas_role_id
+            self._derived = {}
+            self._expires_at = time.monotonic() + self.ttl
+            logger.debug('loaded %d UserRole records into the user role '
+                         'index', len(by_role_id))
+
+    def invalidate(self):
+        """
+        Forces the next lookup to reload the index from the database.
+        """
+        with self._lock:
+            self._expires_at = 0
+
+    def derived(self, key, build):
+        """
+        :return: the value build() returns, computed once per load of the
+        index and per key
+        """
+        self._refresh_if_stale()
+        # hold on to this load's values, so a reload while build() runs
+        # doesn't get the old load's value stored in it
+        derived = self._derived
+        if key not in derived:
+            derived[key] = build()
+        return derived[key]
+
+    def all(self):
+        """
+        :return: list of every UserRole, ordered by role_id
+        """
+        self._refresh_if_stale()
+        return list(self._by_role_id.values())
+
+    def get(self, role_id):
+        """
+        :return: the UserRole with the given role_id, or None
+        """
+        self._refresh_if_stale()
+        return self._by_role_id.get(int(role_id))
+
+    def filter_by_canvas_role_id(self, canvas_role_id):
+        """
+        :return: list of UserRoles mapped to the given Canvas role id, ordered
+        by role_id. Several UserRoles can share a Canvas role (e.g. Student).
+        """
+        self._refresh_if_stale()
+        return list(self._by_canvas_role_id.get(int(canvas_role_id), []))
+
+    def first_by_canvas_role_id(self, canvas_role_id):
+        """
+        Equivalent of UserRole.objects.filter(canvas_role_id=...).first()
+        """
+        user_roles = self.filter_by_canvas_role_id(canvas_role_id)
+        return user_roles[0] if user_roles else None
+
+    def get_by_canvas_role_id(self, canvas_role_id):
+        """
+        Equivalent of UserRole.objects.get(canvas_role_id=...); raises
+        UserRole.DoesNotExist or UserRole.MultipleObjectsReturned accordingly.
+        """
+        user_roles = self.filter_by_canvas_role_id(canvas_role_id)
+        if not user_roles:
+            raise UserRole.DoesNotExist(
+                f'No UserRole found for canvas_role_id {canvas_role_id}')
+        if len(user_roles) > 1:
+            raise UserRole.MultipleObjectsReturned(
+                f'{len(user_roles)} UserRoles found for canvas_role_id '
+                f'{canvas_role_id}')
+        return user_roles[0]
+
+
+user_role_index = UserRoleIndex(
+    ttl=settings.MANAGE_PEOPLE.get('USER_ROLE_INDEX_TTL_SECS', 3600))
+
 
 
 def context_error(request):
@@ -179,28 +304,35 @@ def get_user_role_if_permitted(course_instance_id, user_role_id):
     """
     user_role = None
 
-    available_roles = get_available_roles(course_instance_id)
-
-    if int(user_role_id) in [int(role['role_id']) for role in available_roles]:
-        try:
-            cache_key = CACHE_KEY_USER_ROLE_BY_ID.format(user_role_id)
-            user_role = cache.get(cache_key)
-            if user_role is None:
-                user_role = UserRole.objects.get(role_id=user_role_id)
-                cache.set(cache_key, user_role, 3600)
-        except UserRole.DoesNotExist:
-            logger.exception(
+    permitted_role_ids = get_permitted_role_ids(course_instance_id)
+
+    if int(user_role_id) in permitted_role_ids:
+        user_role = user_role_index.get(user_role_id)
+        if user_role is None:
+            logger.error(
                 'user_role_id %s does not map to a valid user_role record.',
                 user_role_id)
     else:
         logger.warning(
             'user_role_id %s does not map to a permitted user_role record for '
             'course %s. Permitted roles: %s', user_role_id, course_instance_id,
-            sorted([role['role_id'] for role in available_roles]))
+            sorted(permitted_role_ids))
 
     return user_role
 
 
+def get_permitted_role_ids(course_instance_id):
+    """
+    Returns the set of UserRole.role_ids permitted for the course by the
+    SchoolAllowedRole rules (or ManagePeopleRole defaults). Callers checking
+    many enrollments against the same course should compute this once and
+    test membership against it rather than calling
+    get_user_role_if_permitted per enrollment.
+    """
+    return {int(role['role_id'])
+            for role in get_available_roles(course_instance_id)}
+
+
 def get_canvas_role_name(user_role_id):
     """
     Provides the Canvas role name (the 'role' value of a role object as defined
@@ -219,27 +351,24 @@ def get_user_role_to_canvas_role_map(account_id='self'):
     :param account_id: Canvas account ID to fetch Canvas role list for. Defaults
     to self because for the time being roles are only defined at the root
     account in Canvas.
+    The map is kept in the (per-process) user role index, so it's rebuilt
+    whenever the index reloads the UserRole table.
     """
-    cache_key = CACHE_KEY_CANVAS_ROLES_BY_USER_ROLE_ID_FOR_ACCOUNT.format(
-        account_id)
-    role_map = cache.get(cache_key)
-    if role_map is not None:
+    def build_role_map():
+        canvas_roles_by_canvas_role_id = get_roles_for_account_id(account_id)
+        role_map = {
+            role.role_id: canvas_roles_by_canvas_role_id[role.canvas_role_id]
+            for role in user_role_index.all()
+            if role.canvas_role_id
+            and canvas_roles_by_canvas_role_id.get(role.canvas_role_id)
+        }
+        logger.debug(
+            "Built user_role_id:Canvas role map for Canvas account %s: %s",
+            account_id, json.dumps(str(role_map)).replace("'", '"'))
         return role_map
 
-    canvas_roles_by_canvas_role_id = get_roles_for_account_id(account_id)
-    user_roles = list(UserRole.objects.values())
-    role_map = {
-        role["role_id"]: canvas_roles_by_canvas_role_id[role["canvas_role_id"]]
-        for role in user_roles
-        if role.get("canvas_role_id")
-        and canvas_roles_by_canvas_role_id.get(role["canvas_role_id"])
-    }
-
-    logger.debug(
-        "Caching user_role_id:Canvas role map for Canvas account %s: %s",
-        account_id, json.dumps(str(role_map)).replace("'", '"'))
-    cache.set(cache_key, role_map)
-    return role_map
+    return user_role_index.derived(('canvas-roles-by-user-role-id', account_id),
+                                   build_role_map)
 
 
 def get_canvas_to_user_role_id_map():
@@ -249,7 +378,82 @@ def get_canvas_to_user_role_id_map():
 
     # todo: this will not accurately work for any roles that have many:one maps
     # (such as the Canvas student role) - see TLT-2766 (raise a ticket)
-    return {int(canvas_role_id): int(user_role_id)
-            for canvas_role_id, user_role_id
-            in UserRole.objects.filter(canvas_role_id__isnull=False)\
-                .values_list('canvas_role_id', 'role_id')}
+    return {int(role.canvas_role_id): int(role.role_id)
+            for role in user_role_index.all()
+            if role.canvas_role_id is not None}
+
+
+def get_role_types_for_univ_ids(univ_ids):
+    """
+    Bulk lookup of Person role types (used to derive badge labels), served
+    from the shared cache where possible. Cache misses are fetched from the
+    people.v_huid_and_xid_people view in one bulk query and written back, and
+    ids the view doesn't know about are negatively cached so they aren't
+    queried again on every render.
+    :param univ_ids: iterable of univ_ids; ids that are empty or too long to
+    be a univ_id are skipped
+    :return: dict of univ_id to role_type_cd for the ids that were found
+    """
+    clean_univ_ids = {univ_id for univ_id in univ_ids
+                      if univ_id and len(univ_id) <= 10}
+    if not clean_univ_ids:
+        return {}
+
+    cache_keys = {CACHE_KEY_PERSON_ROLE_TYPE.format(univ_id): univ_id
+                  for univ_id in clean_univ_ids}
+    cached = cache.get_many(list(cache_keys.keys()))
+    role_types = {cache_keys[key]: role_type
+                  for key, role_type in cached.items()}
+    missing_univ_ids = clean_univ_ids - set(role_types.keys())
+    logger.debug('person role type cache hits=%d misses=%d',
+                 len(role_types), len(missing_univ_ids))
+
+    if missing_univ_ids:
+        found = _query_role_types_for_univ_ids(missing_univ_ids)
+        cache.set_many(
+            {CACHE_KEY_PERSON_ROLE_TYPE.format(univ_id): role_type
+             for univ_id, role_type in found.items()},
+            settings.MANAGE_PEOPLE.get('BADGE_CACHE_TIMEOUT_SECS', 86400))
+        not_found = missing_univ_ids - set(found.keys())
+        if not_found:
+            cache.set_many(
+                {CACHE_KEY_PERSON_ROLE_TYPE.format(univ_id): PERSON_NOT_FOUND
+                 for univ_id in not_found},
+                settings.MANAGE_PEOPLE.get(
+                    'BADGE_NEGATIVE_CACHE_TIMEOUT_SECS', 3600))
+        role_types.update(found)
+
+    return {univ_id: role_type for univ_id, role_type in role_types.items()
+            if role_type != PERSON_NOT_FOUND}
+
+
+def _query_role_types_for_univ_ids(univ_ids):
+    """
+    Fetches role types from the people.v_huid_and_xid_people view. Ids are
+    sent as bind variables in fixed-size chunks (see
+    PEOPLE_LOOKUP_CHUNK_SIZES), and only the univ_id and role_type_cd columns
+    are selected.
+    :return: dict of univ_id to role_type_cd for the ids that were found
+    """
+    role_types = {}
+    connection = connections[router.db_for_read(Person)]
+    with connection.cursor() as cursor:
+        for chunk in _chunk_for_people_lookup(sorted(univ_ids)):
+            query = PEOPLE_ROLE_TYPE_QUERY.format(','.join(['%s'] * len(chunk)))
+            cursor.execute(query, chunk)
+            role_types.update(cursor.fetchall())
+    return role_types
+
+
+def _chunk_for_people_lookup(univ_ids):
+    """
+    Splits univ_ids into chunks no larger than the biggest entry in
+    PEOPLE_LOOKUP_CHUNK_SIZES, padding each chunk (by repeating its last id)
+    up to the smallest size that fits it.
+    """
+    max_size = PEOPLE_LOOKUP_CHUNK_SIZES[-1]
+    for start in range(0, len(univ_ids), max_size):
+        chunk = univ_ids[start:start + max_size]
+        size = next(size for size in PEOPLE_LOOKUP_CHUNK_SIZES
+                    if size >= len(chunk))
+        yield chunk + [chunk[-1]] * (size - len(chunk))
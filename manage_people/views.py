@@ -1,22 +1,27 @@
+import base64
+import bisect
+import functools
 import json
 import logging
 import pprint
-import re
 import time
 import urllib.error
 import urllib.parse
 import urllib.request
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+import django_rq
 from canvas_sdk.exceptions import CanvasAPIError
 from canvas_sdk.methods import enrollments
 from canvas_sdk.utils import get_all_list_data
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.cache import caches
 from django.db import IntegrityError
-from django.db.models import Q
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import (HttpResponseBadRequest, HttpResponseRedirect,
+                         JsonResponse)
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.decorators.http import require_http_methods
@@ -32,19 +37,28 @@ from icommons_common.canvas_utils import (SessionInactivityExpirationRC,
                                           add_canvas_section_enrollee,
                                           get_canvas_course_section)
 from icommons_common.models import (CourseEnrollee, CourseGuest,
-                                    CourseInstance, CourseStaff, Person,
-                                    UserRole)
+                                    CourseInstance, CourseStaff, Person)
 from lti_school_permissions.decorators import lti_permission_required
 
 from manage_people.utils import (get_available_roles, get_canvas_role_name,
                                  get_canvas_to_user_role_id_map,
                                  get_course_member_class,
-                                 get_user_role_if_permitted)
+                                 get_permitted_role_ids,
+                                 get_role_types_for_univ_ids,
+                                 get_user_role_if_permitted,
+                                 get_user_role_to_canvas_role_map,
+                                 user_role_index)
+from manage_sections.utils import (invalidate_course,
+                                   invalidate_course_enrollments)
 
 SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
 
 COURSE_MEMBER_CLASSES = (CourseEnrollee, CourseGuest, CourseStaff)
 
+CACHE_KEY_ELIGIBLE_COURSE_MEMBERS = 'manage-people-eligible-course-members-{}'
+CACHE_KEY_ENROLLMENTS_ADDED_THROUGH_TOOL = 'manage-people-enrollments-added-through-tool-{}'
+
+cache = caches['default']
 logger = logging.getLogger(__name__)
 audit_logger = logging.getLogger('manage_people_audit_log')
 pp = pprint.PrettyPrinter(indent=4)
@@ -57,6 +71,44 @@ class EnrollmentError(Exception):
         super().__init__(self.message)
 
 
+class EnrollmentBatch(object):
+    """
+    Canvas lookups shared by every enrollment made in one add_users request.
+    The course's primary section and the role map are resolved once up front,
+    and the Canvas API caches dirtied by the new enrollments are flushed once
+    when the batch exits, instead of once per enrolled user.
+
+        with EnrollmentBatch(course_instance_id, canvas_course_id) as batch:
+            for user_id, user_role_id in ...:
+                add_member_to_course(..., batch=batch)
+    """
+    def __init__(self, course_instance_id, canvas_course_id):
+        self.course_instance_id = course_instance_id
+        self.canvas_course_id = canvas_course_id
+        self.canvas_section = get_canvas_course_section(course_instance_id)
+        self.role_map = get_user_role_to_canvas_role_map()
+        self.enrolled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # flush even if the batch was cut short, so enrollments made before
+        # the error show up
+        if self.enrolled:
+            flush_canvas_course_caches(self.canvas_course_id)
+            invalidate_enrollments_added_through_tool(self.course_instance_id)
+        return False
+
+
+def flush_canvas_course_caches(canvas_course_id):
+    canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
+    canvas_api_helper_enrollments.delete_cache(canvas_course_id)
+    canvas_api_helper_sections.delete_cache(canvas_course_id)
+    invalidate_course(canvas_course_id)
+    invalidate_course_enrollments(canvas_course_id)
+
+
 @login_required
 @require_http_methods(['GET'])
 def find_user(request):
@@ -82,17 +134,49 @@ def user_form(request):
             'not_found': True,
         })
 
-    # get section users added through the tool(filter out the users added via
-    # sis import feed)
-    filtered_enrollments = get_enrollments_added_through_tool(course_instance_id)
+    # the section users added through the tool are fetched a page at a time
+    # by user_form.js from user_form_enrollments
     return render(request, 'manage_people/user_form.html', {
         'canvas_course_id': canvas_course_id,
         'canvas_host': canvas_host,
-        'filtered_enrollments': filtered_enrollments,
         'lbl_message': 'good',
     })
 
 
+@login_required
+@lti_permission_required('manage_people')
+@require_http_methods(['GET'])
+def user_form_enrollments(request):
+    """
+    Returns one page of the enrollments shown on user_form, sorted by
+    sortable_name. The response's next_cursor is passed back as the cursor
+    param to get the following page; it's null on the last page.
+    """
+    try:
+        course_instance_id = request.LTI['lis_course_offering_sourcedid']
+    except KeyError as e:
+        return lti_key_error_response(request, e)
+
+    try:
+        page, next_cursor = get_enrollments_added_through_tool_page(
+            course_instance_id, cursor=request.GET.get('cursor'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid cursor')
+
+    return JsonResponse({
+        'enrollments': [{
+            'sis_user_id': enrollment['user'].get('sis_user_id'),
+            'sortable_name': enrollment['user'].get('sortable_name'),
+            'role_id': enrollment['role_id'],
+            'user_role_id': enrollment['user_role_id'],
+            'canvas_role_label': enrollment['canvas_role_label'],
+            'badge_label_name': enrollment.get('badge_label_name'),
+            'can_be_deleted': enrollment['can_be_deleted'],
+        } for enrollment in page],
+        'next_cursor': next_cursor,
+    })
+
+
 @login_required
 @lti_permission_required('manage_people')
 @require_http_methods(['GET'])
@@ -194,13 +278,18 @@ def get_enrolled_roles_for_user_ids(canvas_course_id, search_results_user_ids):
     t0 = time.perf_counter()
     logger.debug(f'search_results_user_ids: {search_results_user_ids}')
     canvas_enrollments = []
-    for user_id in search_results_user_ids:
-        try:
-            canvas_enrollments.extend(
-                get_all_list_data(SDK_CONTEXT, enrollments.list_enrollments_courses, canvas_course_id, user_id=f'sis_user_id:{user_id}', per_page=100)
-            )
-        except:
-            logger.warning(f'Canvas API returned an error when searching for enrollments for {user_id}. That user may not exist in Canvas at all.')
+    if search_results_user_ids:
+        # fan the per-user lookups out over a bounded pool so an email search
+        # that matches several Person records costs roughly one Canvas round
+        # trip instead of one per match
+        max_workers = min(len(search_results_user_ids),
+                          settings.MANAGE_PEOPLE.get('CANVAS_API_MAX_WORKERS', 5))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for user_enrollments in executor.map(
+                    functools.partial(_get_course_enrollments_for_user,
+                                      canvas_course_id),
+                    search_results_user_ids):
+                canvas_enrollments.extend(user_enrollments)
     t1 = time.perf_counter()
     logger.debug(f'canvas_enrollments: {canvas_enrollments}')
     logger.debug(f'*** TIMING list_enrollments_courses took {t1 - t0} seconds')
@@ -213,7 +302,7 @@ def get_enrolled_roles_for_user_ids(canvas_course_id, search_results_user_ids):
 
     found_ids = defaultdict(list)
     for enrollment in canvas_enrollments:
-        enrollment_role = UserRole.objects.filter(canvas_role_id=enrollment['role_id']).first()
+        enrollment_role = user_role_index.first_by_canvas_role_id(enrollment['role_id'])
 
         sis_user_id = enrollment['user']['sis_user_id']
         if sis_user_id in search_results_user_ids:
@@ -233,6 +322,18 @@ def get_enrolled_roles_for_user_ids(canvas_course_id, search_results_user_ids):
     return found_ids, error_messages
 
 
+def _get_course_enrollments_for_user(canvas_course_id, user_id):
+    """
+    Returns the Canvas enrollments in the given course for a single sis user
+    id, or an empty list if Canvas can't find the user.
+    """
+    try:
+        return get_all_list_data(SDK_CONTEXT, enrollments.list_enrollments_courses, canvas_course_id, user_id=f'sis_user_id:{user_id}', per_page=100)
+    except:
+        logger.warning(f'Canvas API returned an error when searching for enrollments for {user_id}. That user may not exist in Canvas at all.')
+        return []
+
+
 def find_person(search_term):
     t0 = time.perf_counter()
     if "@" in search_term:
@@ -267,10 +368,7 @@ def get_badge_info_for_users(user_id_list=None):
     if not user_id_list:
         return {}
 
-    people = Person.objects.raw(_get_people_in_list_query(user_id_list))
-    person_id_badge_mapping = {
-        p.univ_id: p.role_type_cd for p in people
-    }
+    person_id_badge_mapping = get_role_types_for_univ_ids(user_id_list)
 
     logger.debug("IDs found and their role types: %s", person_id_badge_mapping)
 
@@ -321,39 +419,46 @@ def add_users(request):
     course = canvas_api_helper_courses.get_course(canvas_course_instance_id)
     workflow_state = course['workflow_state']
 
+    # large batches are handed off to an rq worker so they can't tie up (or
+    # time out) a web worker; the confirmation page polls add_users_status
+    # for per-user results
+    if len(users_to_add) > settings.MANAGE_PEOPLE.get('ASYNC_ADD_USERS_THRESHOLD', 5):
+        job = django_rq.get_queue('default').enqueue(
+            'manage_people.jobs.add_users_to_course',
+            users_to_add, course_instance_id, canvas_course_instance_id,
+            meta={'canvas_course_id': str(canvas_course_instance_id),
+                  'total': len(users_to_add), 'completed': 0, 'results': []},
+            result_ttl=settings.MANAGE_PEOPLE.get('ADD_USERS_JOB_RESULT_TTL_SECS', 3600),
+        )
+        logger.info('Queued job %s to add %d users to course_instance_id %s',
+                    job.id, len(users_to_add), course_instance_id)
+        return render(request, 'manage_people/add_user_confirmation.html', {
+            'workflow_state': workflow_state,
+            'job_id': job.id,
+        })
+
     # For each selected user id, attempt to create an enrollment
     enrollment_results = []
-    for user_id, user_role_id in list(users_to_add.items()):
-        # Add the returned (existing_enrollment, person) tuple to the results
-        # list
-        try:
-            existing, person = add_member_to_course(
-                user_id, int(user_role_id), course_instance_id, canvas_course_instance_id
-            )
-            person.error_message = None
-            enrollment_results.append((existing, person))
-        except EnrollmentError as e:
-            messages.error(
-                request,
-                f"[User: {e.user_id or user_id}]: {e.message}"
-            )
-            return HttpResponseRedirect(reverse('manage_people:find_user'))
-
-    # get the updated (or cached) Canvas role list so we can show the right
-    # role labels for these enrollments
-    canvas_roles_by_role_id = get_roles_for_account_id('self')
-    user_roles = list(UserRole.objects.values())
-    labels_by_user_role_id = {
-        role['role_id']: canvas_roles_by_role_id[
-            int(role['canvas_role_id'])]['label']
-        for role in user_roles
-        if role.get('canvas_role_id')
-        and canvas_roles_by_role_id.get(
-            int(role['canvas_role_id'])
-        )
-    }
+    with EnrollmentBatch(course_instance_id, canvas_course_instance_id) as batch:
+        for user_id, user_role_id in list(users_to_add.items()):
+            # Add the returned (existing_enrollment, person) tuple to the results
+            # list
+            try:
+                existing, person = add_member_to_course(
+                    user_id, int(user_role_id), course_instance_id,
+                    canvas_course_instance_id, batch=batch
+                )
+                person.error_message = None
+                enrollment_results.append((existing, person))
+            except EnrollmentError as e:
+                messages.error(
+                    request,
+                    f"[User: {e.user_id or user_id}]: {e.message}"
+                )
+                return HttpResponseRedirect(reverse('manage_people:find_user'))
 
     # annotate enrollments with the Canvas role label
+    labels_by_user_role_id = get_canvas_role_labels_by_user_role_id()
     for (_, person) in enrollment_results:
         person.canvas_role_label = labels_by_user_role_id.get(person.role_id, 'Unknown')
 
@@ -364,11 +469,53 @@ def add_users(request):
     })
 
 
+@login_required
+@lti_permission_required('manage_people')
+@require_http_methods(['GET'])
+def add_users_status(request, job_id):
+    """
+    Returns the progress and per-user results of a queued add_users job
+    """
+    try:
+        canvas_course_id = request.LTI['custom_canvas_course_id']
+    except KeyError as e:
+        return lti_key_error_response(request, e)
+
+    job = django_rq.get_queue('default').fetch_job(job_id)
+    # only report on jobs that were queued for the course in this LTI session
+    if job is None or job.meta.get('canvas_course_id') != str(canvas_course_id):
+        return JsonResponse({'error': 'Job not found'}, status=404)
+
+    return JsonResponse({
+        'status': job.get_status(),
+        'total': job.meta.get('total', 0),
+        'completed': job.meta.get('completed', 0),
+        'results': job.meta.get('results', []),
+    })
+
+
+def get_canvas_role_labels_by_user_role_id():
+    """
+    Returns a dict of user_role_id to the label of its Canvas role, used to
+    show the right role labels for new enrollments
+    """
+    # get the updated (or cached) Canvas role list
+    canvas_roles_by_role_id = get_roles_for_account_id('self')
+    return {
+        role.role_id: canvas_roles_by_role_id[int(role.canvas_role_id)]['label']
+        for role in user_role_index.all()
+        if role.canvas_role_id
+        and canvas_roles_by_role_id.get(int(role.canvas_role_id))
+    }
+
+
 def add_member_to_course(user_id, user_role_id, course_instance_id,
-                         canvas_course_id):
+                         canvas_course_id, batch=None):
     """
     Returns a (existing_enrollment, person) tuple, existing_enrollment is true
-    if there was already an existing enrollment for the given user/role
+    if there was already an existing enrollment for the given user/role.
+    When called as part of an EnrollmentBatch, the batch's section and role
+    lookups are used and the Canvas API caches are left for the batch to flush.
     """
     error_message = None
     existing_enrollment = False
@@ -392,6 +539,7 @@ def add_member_to_course(user_id, user_role_id, course_instance_id,
 
     try:
         enrollment.save()
+        invalidate_eligible_course_members(course_instance_id)
         logger.info(f"Created enrollment for user {user_id} in course_instance_id {course_instance_id} as role_id {user_role_id}")
     except IntegrityError:
         existing_enrollment = True
@@ -436,8 +584,12 @@ def add_member_to_course(user_id, user_role_id, course_instance_id,
         #       release. Those helpers are used elsewhere, as well, so there are
         #       refactoring implications. We could use the SDK or the REST API
         #       in the future.
-        canvas_role_name = get_canvas_role_name(user_role_id)
-        canvas_section = get_canvas_course_section(course_instance_id)
+        if batch is not None:
+            canvas_role_name = batch.role_map[user_role_id]['role']
+            canvas_section = batch.canvas_section
+        else:
+            canvas_role_name = get_canvas_role_name(user_role_id)
+            canvas_section = get_canvas_course_section(course_instance_id)
         try:
             if canvas_section:
                 canvas_enrollment = add_canvas_section_enrollee(
@@ -448,9 +600,12 @@ def add_member_to_course(user_id, user_role_id, course_instance_id,
 
             if canvas_enrollment:
                 # flush the canvas api caches on successful enrollment
-                canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
-                canvas_api_helper_enrollments.delete_cache(canvas_course_id)
-                canvas_api_helper_sections.delete_cache(canvas_course_id)
+                if batch is not None:
+                    batch.enrolled = True
+                else:
+                    flush_canvas_course_caches(canvas_course_id)
+                    invalidate_enrollments_added_through_tool(
+                        course_instance_id)
             else:
                 error_message = f"Failed to enroll user {user_id} in Canvas with role ID {user_role.canvas_role_id}."
                 logger.warning(
@@ -482,6 +637,137 @@ def get_enrollments_added_through_tool(sis_course_id):
     then filters out the course enrollees that are fed via sis import feed
     process or cross-registration.
     """
+    filtered_enrollments = _list_enrollments_added_through_tool(sis_course_id)
+    _annotate_enrollments_added_through_tool(sis_course_id,
+                                             filtered_enrollments)
+    return filtered_enrollments
+
+
+def get_enrollments_added_through_tool_page(sis_course_id, cursor=None,
+                                            page_size=None):
+    """
+    Paginated version of get_enrollments_added_through_tool. The filtered and
+    sorted enrollment list is cached briefly per course, so only the first
+    page needs to go to Canvas; badge and permission lookups are done just for
+    the enrollments on the requested page.
+    :param cursor: opaque cursor returned with the previous page, or None for
+    the first page. Raises ValueError if it can't be decoded.
+    :return: (enrollments, next_cursor) tuple; next_cursor is None on the last
+    page
+    """
+    if page_size is None:
+        page_size = settings.MANAGE_PEOPLE.get('USER_FORM_PAGE_SIZE', 100)
+
+    cache_key = CACHE_KEY_ENROLLMENTS_ADDED_THROUGH_TOOL.format(sis_course_id)
+    filtered_enrollments = cache.get(cache_key)
+    if filtered_enrollments is None:
+        filtered_enrollments = _list_enrollments_added_through_tool(
+            sis_course_id)
+        cache.set(cache_key, filtered_enrollments,
+                  settings.MANAGE_PEOPLE.get('ENROLLMENTS_CACHE_TIMEOUT_SECS', 300))
+
+    # keyset pagination: the cursor is the sort key of the last enrollment
+    # sent, so removals between page requests don't skip or repeat anyone
+    start = 0
+    if cursor:
+        sort_keys = [_enrollment_sort_key(e) for e in filtered_enrollments]
+        start = bisect.bisect_right(sort_keys, _decode_cursor(cursor))
+    page = filtered_enrollments[start:start + page_size]
+    _annotate_enrollments_added_through_tool(sis_course_id, page)
+
+    next_cursor = None
+    if start + page_size < len(filtered_enrollments):
+        next_cursor = _encode_cursor(_enrollment_sort_key(page[-1]))
+    return page, next_cursor
+
+
+def invalidate_enrollments_added_through_tool(sis_course_id):
+    cache.delete(CACHE_KEY_ENROLLMENTS_ADDED_THROUGH_TOOL.format(sis_course_id))
+
+
+def _enrollment_sort_key(enrollment):
+    # sortable_name first, with the ids as tie-breakers so the order is total
+    return (enrollment['user'].get('sortable_name') or '',
+            enrollment['user'].get('sis_user_id') or '',
+            int(enrollment['role_id']))
+
+
+def _encode_cursor(sort_key):
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        sortable_name, sis_user_id, role_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+        return str(sortable_name), str(sis_user_id), int(role_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor {cursor!r}') from e
+
+
+def get_eligible_course_members(course_instance_id):
+    """
+    Returns the set of (user_id, role_id) tuples for the course's members
+    across COURSE_MEMBER_CLASSES that were added manually rather than fed
+    from the registrar or xreg. The set is cached briefly per course;
+    add_member_to_course and remove_user invalidate it.
+    """
+    cache_key = CACHE_KEY_ELIGIBLE_COURSE_MEMBERS.format(course_instance_id)
+    eligible_ids = cache.get(cache_key)
+    if eligible_ids is not None:
+        return eligible_ids
+
+    try:
+        members = _query_course_members(course_instance_id)
+    except Exception as e:
+        logger.exception('unable to look up course members for '
+                         'course_instance_id %s: %s', course_instance_id, e)
+        return set()
+
+    eligible_ids = {(user_id, role_id) for user_id, role_id, source in members
+                    if not _is_registrar_fed(source)}
+    cache.set(cache_key, eligible_ids,
+              settings.MANAGE_PEOPLE.get('ELIGIBLE_MEMBERS_CACHE_TIMEOUT_SECS', 60))
+    return eligible_ids
+
+
+def invalidate_eligible_course_members(course_instance_id):
+    cache.delete(CACHE_KEY_ELIGIBLE_COURSE_MEMBERS.format(course_instance_id))
+
+
+def _query_course_members(course_instance_id):
+    """
+    Fetches (user_id, role_id, source) for every member of the course in one
+    UNION ALL across the COURSE_MEMBER_CLASSES tables. Only the indexed
+    course_instance_id is filtered on in the database; the source check
+    (which can't use an index) is done by the caller.
+    """
+    querysets = [
+        model.objects.filter(course_instance_id=course_instance_id)
+                     .values_list('user_id', 'role_id', 'source')
+        for model in COURSE_MEMBER_CLASSES
+    ]
+    return list(querysets[0].union(*querysets[1:], all=True))
+
+
+def _is_registrar_fed(source):
+    """
+    Users with sources like 'xmlfeed', 'fasfeed', 'icfeed' or 'xreg_map' were
+    fed from the registrar feed or xreg. Any source containing 'feed' is
+    treated as a feed source.
+    """
+    if not source:
+        return False
+    return 'feed' in source.lower() or source == 'xreg_map'
+
+
+def _list_enrollments_added_through_tool(sis_course_id):
+    """
+    Returns the primary section enrollments that were added through the tool,
+    annotated with their user_role_id and Canvas role label and sorted by
+    sortable_name, but without the per-user badge and permission details
+    added by _annotate_enrollments_added_through_tool.
+    """
     t0 = time.perf_counter()
     logger.debug('*** TIMING get_enrollments_added_through_tool(course_instance_id=%s)',
                  sis_course_id)
@@ -500,30 +786,9 @@ def get_enrollments_added_through_tool(sis_course_id):
     t1 = time.perf_counter()
     logger.debug(f'*** TIMING list_enrollments_sections took {t1 - t0} seconds')
     # get the list of enrolles from Course Manager DB, who are eligible to be
-    # deleted via this tool.  This is achieved by using a filter to exclude
-    # users with values equal to e.g. 'xmlfeed','fasfeed', or 'xreg_map' in the
-    # 'SOURCE' column, which indicates that these users were fed from the
-    # registrar feed or xreg.  Note: The code is excluding any source containing
-    # 'feed' to capture various feed sources like 'xmlfeed','fasfeed','icfeed'
-    # etc.
-
-    eligible_ids = set()
-    query = (Q(course_instance_id=sis_course_id) &
-             (Q(source__isnull=True) |
-              ~(Q(source__icontains='feed') | Q(source='xreg_map'))))
-    for model in COURSE_MEMBER_CLASSES:
-        ids = None
-        try:
-            ids = list(model.objects.filter(query).values_list('user_id',
-                                                               'role_id'))
-        except Exception as e:
-            logger.exception('unable to look up course members in %s: %s',
-                             model._meta.db_table, e)
-        else:
-            logger.debug('eligible %s members = %s',
-                         model._meta.db_table, ids)
-        if ids:
-            eligible_ids.update(ids)
+    # deleted via this tool (i.e. those who weren't fed from the registrar
+    # feed or xreg)
+    eligible_ids = get_eligible_course_members(sis_course_id)
     logger.debug('full set of eligible user/role ids: %s', eligible_ids)
     t2 = time.perf_counter()
     logger.debug(f'*** TIMING looking up eligible course members took {t2 - t1} seconds')
@@ -589,11 +854,19 @@ def get_enrollments_added_through_tool(sis_course_id):
     logger.debug(f'*** TIMING filtering enrollments took {t5 - t4} seconds')
 
     # Sort the users by sortable_name
-    filtered_enrollments.sort(key=lambda x: x['user']['sortable_name'])
+    filtered_enrollments.sort(key=_enrollment_sort_key)
     logger.debug('size of filtered and sorted enrollments= %s',
                  len(filtered_enrollments))
-    t6 = time.perf_counter()
+    return filtered_enrollments
+
 
+def _annotate_enrollments_added_through_tool(sis_course_id,
+                                             filtered_enrollments):
+    """
+    Adds the badge label and can_be_deleted flag to each of the given
+    enrollments (in place)
+    """
+    t6 = time.perf_counter()
     # add custom display badge information for enrollees to the filtered
     # Canvas enrollment objects badge information is used on user_form to
     # identify different university ID types and distinguish  multiple IDs
@@ -603,21 +876,20 @@ def get_enrollments_added_through_tool(sis_course_id):
     user_badge_info_mapping = get_badge_info_for_users(user_id_list)
     t7 = time.perf_counter()
     logger.debug(f'*** TIMING getting badge info for users took {t7 - t6} seconds')
-    # user_badge_info_mapping = {}
+
+    # the permitted roles are the same for every enrollment in the course, so
+    # look them up once instead of once per enrollment
+    permitted_role_ids = get_permitted_role_ids(sis_course_id)
     for enrollment in filtered_enrollments:
         user_id = enrollment['user'].get('sis_user_id')
         if user_id and user_id in user_badge_info_mapping:
             enrollment['badge_label_name'] = user_badge_info_mapping[user_id]
         # Check if the given enrollment can be deleted in the current tool
         # If it can not, we want to disable the delete option in the template
-        t6_1 = time.perf_counter()
-        user_role = get_user_role_if_permitted(sis_course_id, enrollment['user_role_id'])
-        t6_2 = time.perf_counter()
-        logger.debug(f'*** TIMING get_user_role_if_permitted {t6_2 - t6_1} seconds')
-        enrollment['can_be_deleted'] = True if user_role is not None else False
+        enrollment['can_be_deleted'] = \
+            int(enrollment['user_role_id']) in permitted_role_ids
     t8 = time.perf_counter()
     logger.debug(f'*** TIMING getting can_be_deleted took {t8 - t7} seconds')
-    return filtered_enrollments
 
 
 @login_required
@@ -652,15 +924,16 @@ def remove_user(request):
                  .format(canvas_role_id)},
             status=500)
 
-    # start by getting all the enrollments for this user
+    # start by getting this user's enrollments in the course
     user_id = 'sis_user_id:%s' % sis_user_id
     try:
         user_enrollments = get_all_list_data(
-                SDK_CONTEXT, enrollments.list_enrollments_users, user_id)
+                SDK_CONTEXT, enrollments.list_enrollments_courses,
+                canvas_course_id, user_id=user_id)
     except CanvasAPIError as api_error:
         logger.exception(
-            "CanvasAPIError trying to get enrollments for user %s",
-            sis_user_id, api_error)
+            "CanvasAPIError trying to get enrollments for user %s in course "
+            "%s: %s", sis_user_id, canvas_course_id, api_error)
         return JsonResponse(
             {'result': 'failure',
              'message': 'Error: There was a problem getting enrollments for '
@@ -674,26 +947,34 @@ def remove_user(request):
                 if (int(enrollment['course_id']) == int(canvas_course_id)
                     and int(enrollment['role_id']) == int(canvas_role_id))]
 
-    # Remove the user from all Canvas sections in course
-    for enrollment_id in user_enrollments_to_remove:
-        try:
-            enrollments.conclude_enrollment(SDK_CONTEXT, canvas_course_id,
-                                            enrollment_id, task='delete')
-        except CanvasAPIError as api_error:
-            logger.exception(
-                'Canvas API Error trying to delete user %s with enrollment id '
-                '%s from course instance %s: %s',
-                sis_user_id, enrollment_id, course_instance_id, api_error
-            )
-            return JsonResponse(
-                {'result': 'failure',
-                 'message': 'Error: There was a problem in deleting the user'},
-                status=500)
-
-    # update canvas api caches
-    canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
-    canvas_api_helper_enrollments.delete_cache(canvas_course_id)
-    canvas_api_helper_sections.delete_cache(canvas_course_id)
+    # Remove the user from all Canvas sections in course; each section
+    # enrollment is concluded independently, so do them concurrently
+    failed_enrollment_ids = []
+    if user_enrollments_to_remove:
+        max_workers = min(len(user_enrollments_to_remove),
+                          settings.MANAGE_PEOPLE.get('CANVAS_API_MAX_WORKERS', 5))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            concluded = executor.map(
+                functools.partial(_conclude_enrollment, canvas_course_id),
+                user_enrollments_to_remove)
+            failed_enrollment_ids = [
+                enrollment_id for enrollment_id, ok
+                in zip(user_enrollments_to_remove, concluded) if not ok]
+
+    # update canvas api caches; some enrollments may have been removed even
+    # if others failed
+    flush_canvas_course_caches(canvas_course_id)
+    invalidate_enrollments_added_through_tool(course_instance_id)
+
+    if failed_enrollment_ids:
+        logger.error(
+            'Failed to delete user %s with enrollment ids %s from course '
+            'instance %s', sis_user_id, failed_enrollment_ids,
+            course_instance_id)
+        return JsonResponse(
+            {'result': 'failure',
+             'message': 'Error: There was a problem in deleting the user'},
+            status=500)
 
     logger.debug(
         'Now removing user with user_id=%s from course_instance_id=%s in '
@@ -728,6 +1009,7 @@ def remove_user(request):
             {'result': 'failure',
              'message': 'Error: There was a problem in deleting the user'},
             status=500)
+    invalidate_eligible_course_members(course_instance_id)
 
     # Record the delete in the audit log
     audit_logger.info(
@@ -741,6 +1023,22 @@ def remove_user(request):
     return JsonResponse(response_data)
 
 
+def _conclude_enrollment(canvas_course_id, enrollment_id):
+    """
+    Deletes a single Canvas enrollment, returning False (after logging) if
+    the API call fails
+    """
+    try:
+        enrollments.conclude_enrollment(SDK_CONTEXT, canvas_course_id,
+                                        enrollment_id, task='delete')
+    except CanvasAPIError as api_error:
+        logger.exception(
+            'Canvas API Error trying to delete enrollment id %s from canvas '
+            'course %s: %s', enrollment_id, canvas_course_id, api_error)
+        return False
+    return True
+
+
 def get_badge_label_name(role_type_cd):
     return settings.MANAGE_PEOPLE['BADGE_LABELS'][get_role_type(role_type_cd)]
 
@@ -762,19 +1060,3 @@ def lti_key_error_response(request, key_error_exception):
     return render(request, 'manage_people/error.html',
                   context={'message': user_error_message}, status=400)
 
-
-def _get_people_in_list_query(user_id_list=[]):
-    pat = re.compile(r'[^\w-]+', re.UNICODE)
-    clean_user_ids = ["'{}'".format(pat.sub('', i)) for i in user_id_list if len(pat.sub('', i)) <= 10]
-    if clean_user_ids:
-        # split clean_user_ids into chunks of 999 (https://www.geeksforgeeks.org/break-list-chunks-size-n-python/)
-        n = 999
-        chunks = [clean_user_ids[i * n:(i + 1) * n] for i in range((len(clean_user_ids) + n - 1) // n)]
-
-        # create the raw query with one of the chunks
-        raw_person_query = 'select * from people.v_huid_and_xid_people where univ_id in ({})'.format(','.join(chunks.pop()))
-        # if there are remaining chunks, add them to the where clause
-        for chunk in chunks:
-            raw_person_query += ' or univ_id in ({})'.format(','.join(chunk))
-        logger.debug(raw_person_query)
-        return raw_person_query
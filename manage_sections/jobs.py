@@ -0,0 +1,101 @@
+import logging
+
+from canvas_api.helpers import sections as canvas_api_helper_sections
+from canvas_sdk.methods import enrollments as canvas_api_enrollments
+from canvas_sdk.utils import get_all_list_data
+from icommons_common.models import CourseEnrollee, CourseGuest, CourseStaff
+from rq import get_current_job
+
+from .utils import SDK_CONTEXT, delete_enrollments, get_course_instance
+
+logger = logging.getLogger(__name__)
+
+# the steps of removing a section, in order. Each one is safe to re-run, and
+# the job records the step it's on in job.meta['stage'], so a job that's
+# requeued after a worker dies (or a step fails) picks up where it left off.
+REMOVE_SECTION_STAGES = (
+    'soft_delete',
+    'delete_db_enrollments',
+    'delete_canvas_enrollments',
+    'delete_canvas_section',
+    'done',
+)
+
+
+class RemoveSectionError(Exception):
+    """Raised when a step of removing a section fails."""
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def remove_section(canvas_course_id, sis_section_id, section_id):
+    """
+    Removes a section: soft-deletes its CourseInstance, deletes its DB
+    enrollments, deletes every one of its Canvas enrollments (all pages) and
+    finally deletes the Canvas section. Runs either in an rq worker or inline
+    (for small sections), in which case there's no job to record progress on.
+    :return: the deleted Canvas section
+    :raises RemoveSectionError: if a step fails
+    """
+    job = get_current_job()
+    meta = job.meta if job else {}
+    meta.setdefault('stage', REMOVE_SECTION_STAGES[0])
+    meta.setdefault('deleted_enrollments', 0)
+
+    def advance(stage):
+        meta['stage'] = stage
+        if job:
+            job.save_meta()
+
+    if meta['stage'] != REMOVE_SECTION_STAGES[0]:
+        logger.info(f'Resuming removal of section {section_id} from course '
+                    f'{canvas_course_id} at stage {meta["stage"]}')
+
+    if meta['stage'] == 'soft_delete':
+        try:
+            db_section = get_course_instance(sis_section_id)
+            db_section.deleted = 1
+            db_section.sync_to_canvas = 0
+            db_section.save()
+        except Exception as e:
+            logger.exception(f'Error retrieving section {sis_section_id} for deletion: {e}')
+            raise RemoveSectionError(f'Error retrieving section {sis_section_id} for deletion: {e}')
+        advance('delete_db_enrollments')
+
+    if meta['stage'] == 'delete_db_enrollments':
+        for table in (CourseEnrollee, CourseGuest, CourseStaff):
+            try:
+                table.objects.filter(course_instance_id=sis_section_id).delete()
+            except Exception as e:
+                message = f'Error retrieving enrollments for section {sis_section_id} for deletion: {e}'
+                logger.error(message)
+                raise RemoveSectionError(message)
+        advance('delete_canvas_enrollments')
+
+    if meta['stage'] == 'delete_canvas_enrollments':
+        # a resumed job only sees the enrollments that are left
+        enrollments = get_all_list_data(
+            SDK_CONTEXT, canvas_api_enrollments.list_enrollments_sections,
+            section_id)
+        if enrollments:
+            # delete enrollments before deleting section
+            responses, is_empty = delete_enrollments(enrollments, canvas_course_id)
+            meta['deleted_enrollments'] += len(responses)
+            if job:
+                job.save_meta()
+            if not is_empty:
+                raise RemoveSectionError(
+                    f'Issue clearing enrollments prior to deletion. Unable to '
+                    f'delete section {section_id} from course {canvas_course_id}')
+        advance('delete_canvas_section')
+
+    if meta['stage'] == 'delete_canvas_section':
+        canvas_section = canvas_api_helper_sections.delete_section(canvas_course_id, section_id)
+        if not canvas_section:
+            raise RemoveSectionError(
+                f'Unable to delete section {section_id} from course {canvas_course_id}')
+        meta['section'] = canvas_section
+        advance('done')
+
+    return meta.get('section')
@@ -1,117 +1,297 @@
+import hashlib
+import json
 import logging
+import time
+from collections import defaultdict
+from concurrent.futures import (ALL_COMPLETED, FIRST_COMPLETED,
+                                ProcessPoolExecutor, ThreadPoolExecutor, wait)
 
+from canvas_sdk import client
 from canvas_sdk.methods import (accounts, sections, enrollments)
 from canvas_sdk.utils import get_all_list_data
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import BaseCommand
+from django.db import connections
 from django.utils.encoding import smart_text
 from icommons_common.canvas_utils import SessionInactivityExpirationRC
 from icommons_common.models import (Section, SectionMember, CourseInstance)
 
+from manage_sections.models import SectionSyncWatermark
+
 SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
 
 logger = logging.getLogger(__name__)
 
+# the largest page of enrollments Canvas will return
+CANVAS_PAGE_SIZE = 100
+
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
 
-class Command(NoArgsCommand):
+
+class Command(BaseCommand):
     """
     sync canvas sections and section members to the coursemanager.section 
     and coursemanager.section_member tables
     """
     help = ('sync canvas sections and section members to the coursemanager.section'
             'and coursemanager.section_member tables')
-    
-    def handle_noargs(self, **options):
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int,
+            default=settings.MANAGE_SECTIONS.get('SYNC_CANVAS_SECTIONS_WORKERS', 4),
+            help='Number of courses to sync at the same time')
+        parser.add_argument(
+            '--executor', choices=sorted(EXECUTORS), default='thread',
+            help='Sync courses in a pool of threads or of processes')
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Sync every course, even those unchanged since their last sync')
+
+    def handle(self, **options):
         """
         sync canvas sections and section members to the coursemanager.section 
         and coursemanager.section_member tables. Note this process works by
         getting all active courses for the given account_id. The method 
         get_account_list_from_canvas get a list of all the sub-accounts of 
         the ROOT_ACCOUNT.
+
+        The courses are enumerated here and synced independently (see
+        sync_course) by a pool of --workers threads or processes, each of
+        which uses its own DB connections. Worker processes also build their
+        own Canvas request context (see init_process_worker), since the one
+        they inherit holds the parent's open HTTP connections. Courses that
+        haven't changed since their last sync are skipped, unless --full is
+        given.
         """
-        account_list = get_account_list_from_canvas()
-        for account_id in account_list:
-            course_list = get_course_list_from_canvas(account_id)    
-
-            for course in course_list:
-                sis_course_id = course.get('sis_course_id')
-                canvas_course_id = course.get('id')
-                
-                if sis_course_id and sis_course_id.isdigit() and canvas_course_id: 
-                    
+        workers = max(1, options.get('workers') or 1)
+        executor_class = EXECUTORS[options.get('executor') or 'thread']
+        full = options.get('full', False)
+        stats = SyncStats()
+
+        executor_kwargs = {}
+        if executor_class is ProcessPoolExecutor:
+            # forked workers mustn't share the parent's DB connections, nor
+            # the keep-alive sockets of its Canvas session
+            connections.close_all()
+            executor_kwargs['initializer'] = init_process_worker
+
+        with executor_class(max_workers=workers, **executor_kwargs) as executor:
+            pending = {}
+
+            def collect(return_when):
+                done, _ = wait(pending, return_when=return_when)
+                for future in done:
+                    account_id, canvas_course_id = pending.pop(future)
                     try:
-                        ci = CourseInstance.objects.get(pk=sis_course_id)
-                    except ObjectDoesNotExist:
-                        """
-                        if the course instance id in canvas does not exists in the coursemanager
-                        course_instance table. This is ok as some of the early canvas courses don't have
-                        course instance records in the coursemanager db, log the exception and continue
-                        """
-                        ci = None
-                        logger.info('course_instance {} does not exist for canvas_course_id {}'.format(sis_course_id,
-                                                                                                   canvas_course_id))
-                        continue
-
-                    """
-                    get the list of sections associated with the canvas_course_id
-                    """
-                    canvas_course_sections_set = set(get_canvas_sections_list(canvas_course_id))
-                    
-                    """
-                    get the list of sections associated with the course_instance
-                    """
-                    cm_section_set = set(get_cm_sections_list(ci))
-
-                    """
-                    convert the lists to sets so we can perform set operations:
-                             a = set('1','2','3')
-                             b = set('2','3','4')
-                             c = a - b = ('1') items in a but not in b
-                             d = b - a = ('4') items in b but not in a
-
-                    this tells us what sections we need to add and remove
-                    """
-                    sections_to_remove = cm_section_set - canvas_course_sections_set
-                  
-                    """
-                    If a section was deleted from Canvas we want to also delete the
-                    section from the section table. 
-                    """
-                    remove_sections_from_cm(sections_to_remove, sis_course_id)
-                   
-                    """
-                    Now process the sections that need to be created or updated. 
-                    """
-                    for canvas_section_id in canvas_course_sections_set:
-                        section = get_canvas_section(canvas_section_id)
-                        section_name = section.get('name')
-                        if section_name:
-                            cm_section_id = create_or_update_section(ci, sis_course_id, canvas_section_id,
-                                                                     smart_text(section_name))
-                        
-                            """
-                            get the list of sis_user_id's of the section from canvas
-                            """       
-                            canvas_section_member_set = set(get_enrollments_from_canvas_section(canvas_section_id))
-                            
-                            """
-                            get the list of user_id's from the section_member table 
-                            """
-                            cm_section_member_set = set(get_enrollments_from_cm_section(cm_section_id))
-                            
-                            add_user_set = canvas_section_member_set - cm_section_member_set
-                            remove_user_set = cm_section_member_set - canvas_section_member_set
-     
-                            if len(remove_user_set) > 0:
-                                remove_user_list_from_section(remove_user_set, cm_section_id)
-
-                            if len(add_user_set) > 0:
-                                add_user_list_to_section(add_user_set, cm_section_id)
-
+                        result = future.result()
+                    except Exception:
+                        logger.exception('sync failed for canvas_course_id {} in account {}'.format(
+                            canvas_course_id, account_id))
+                        result = 'failed'
+                    stats.course_finished(account_id, result)
+
+            account_list = get_account_list_from_canvas()
+            for account_id in account_list:
+                course_list = get_course_list_from_canvas(account_id)
+                stats.account_started(account_id)
+
+                for course in course_list:
+                    # keep the queue short, so that the producer doesn't get
+                    # far ahead of the workers
+                    if len(pending) >= workers * 2:
+                        collect(FIRST_COMPLETED)
+                    future = executor.submit(sync_course_task, course, full=full)
+                    pending[future] = (account_id, course.get('id'))
+
+            if pending:
+                collect(ALL_COMPLETED)
+
+        for line in stats.report():
+            self.stdout.write(line)
         logger.info('process complete')
 
 
+class SyncStats:
+    """
+    Tracks the outcome of each course sync, per account, for the throughput
+    report at the end of the run
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.account_start = {}
+        self.account_end = {}
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def account_started(self, account_id):
+        self.account_start[account_id] = time.monotonic()
+
+    def course_finished(self, account_id, result):
+        self.counts[account_id][result] += 1
+        self.account_end[account_id] = time.monotonic()
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        totals = defaultdict(int)
+        lines = []
+        for account_id in sorted(self.counts):
+            counts = self.counts[account_id]
+            for result, count in counts.items():
+                totals[result] += count
+            courses = sum(counts.values())
+            account_elapsed = max(self.account_end[account_id] - self.account_start[account_id], 1e-6)
+            lines.append('account {}: {} courses in {:.1f}s ({:.2f} courses/s); {}'.format(
+                account_id, courses, account_elapsed, courses / account_elapsed,
+                _format_counts(counts)))
+        courses = sum(totals.values())
+        lines.append('total: {} courses in {:.1f}s ({:.2f} courses/s); {}'.format(
+            courses, elapsed, courses / max(elapsed, 1e-6), _format_counts(totals)))
+        return lines
+
+
+def _format_counts(counts):
+    return ', '.join('{} {}'.format(count, result) for result, count in sorted(counts.items()))
+
+
+def init_process_worker():
+    """
+    Runs once in each worker process of a --executor process pool. A forked
+    worker inherits the parent's SDK_CONTEXT, whose requests session has
+    keep-alive connections to Canvas that the parent already used; if
+    several processes read from the same sockets their responses can be
+    interleaved, so each worker replaces it with a session of its own.
+    """
+    global SDK_CONTEXT
+    SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
+    connections.close_all()
+
+
+def sync_course_task(course, full=False):
+    """
+    Runs sync_course in a pool worker, closing the worker's DB connections
+    afterwards (they're opened per thread or process, and a broken
+    connection shouldn't outlive the course that broke it)
+    """
+    try:
+        return sync_course(course, full=full)
+    finally:
+        connections.close_all()
+
+
+def sync_course(course, full=False):
+    """
+    sync the sections and section members of a single Canvas course to the
+    coursemanager tables. Returns 'synced', 'skipped' if the course doesn't
+    have a course instance to sync to, or 'unchanged' if the course's Canvas
+    sections and section members match the fingerprint recorded by the last
+    successful sync (unless full is set), in which case the coursemanager
+    tables aren't touched.
+    """
+    sis_course_id = course.get('sis_course_id')
+    canvas_course_id = course.get('id')
+
+    if not (sis_course_id and sis_course_id.isdigit() and canvas_course_id):
+        return 'skipped'
+
+    try:
+        ci = CourseInstance.objects.get(pk=sis_course_id)
+    except ObjectDoesNotExist:
+        """
+        if the course instance id in canvas does not exists in the coursemanager
+        course_instance table. This is ok as some of the early canvas courses don't have
+        course instance records in the coursemanager db, log the exception and continue
+        """
+        logger.info('course_instance {} does not exist for canvas_course_id {}'.format(sis_course_id,
+                                                                                   canvas_course_id))
+        return 'skipped'
+
+    """
+    get the sections associated with the canvas_course_id, and the list of
+    sis_user_id's of each section, from canvas
+    """
+    canvas_section_names = get_canvas_sections_list(canvas_course_id)
+    canvas_course_sections_set = set(canvas_section_names)
+    canvas_section_members = get_enrollments_from_canvas_course(canvas_course_id)
+    canvas_sections = {}
+    for canvas_section_id, section_name in canvas_section_names.items():
+        canvas_sections[canvas_section_id] = (
+            smart_text(section_name),
+            canvas_section_members.get(canvas_section_id, set()))
+
+    fingerprint = get_course_fingerprint(canvas_sections)
+    if not full and SectionSyncWatermark.objects.filter(
+            canvas_course_id=canvas_course_id, fingerprint=fingerprint).exists():
+        logger.debug('canvas_course_id {} unchanged since last sync'.format(canvas_course_id))
+        return 'unchanged'
+
+    """
+    get the list of sections associated with the course_instance
+    """
+    cm_section_set = set(get_cm_sections_list(ci))
+
+    """
+    convert the lists to sets so we can perform set operations:
+             a = set('1','2','3')
+             b = set('2','3','4')
+             c = a - b = ('1') items in a but not in b
+             d = b - a = ('4') items in b but not in a
+
+    this tells us what sections we need to add and remove
+    """
+    sections_to_remove = cm_section_set - canvas_course_sections_set
+
+    """
+    If a section was deleted from Canvas we want to also delete the
+    section from the section table. 
+    """
+    remove_sections_from_cm(sections_to_remove, sis_course_id)
+
+    """
+    Now process the sections that need to be created or updated. 
+    """
+    cm_section_ids = create_or_update_sections(
+        ci, sis_course_id,
+        {canvas_section_id: section_name for canvas_section_id, (section_name, _) in canvas_sections.items()})
+    for canvas_section_id, (section_name, canvas_section_member_set) in canvas_sections.items():
+        cm_section_id = cm_section_ids[canvas_section_id]
+
+        """
+        get the list of user_id's from the section_member table 
+        """
+        cm_section_member_set = set(get_enrollments_from_cm_section(cm_section_id))
+
+        add_user_set = canvas_section_member_set - cm_section_member_set
+        remove_user_set = cm_section_member_set - canvas_section_member_set
+
+        if len(remove_user_set) > 0:
+            remove_user_list_from_section(remove_user_set, cm_section_id)
+
+        if len(add_user_set) > 0:
+            add_user_list_to_section(add_user_set, cm_section_id)
+
+    SectionSyncWatermark.objects.update_or_create(
+        canvas_course_id=canvas_course_id, defaults={'fingerprint': fingerprint})
+    return 'synced'
+
+
+def get_course_fingerprint(canvas_sections):
+    """
+    Returns a hash of everything the sync writes for a course: the id and
+    name of each section, and the sis_user_id's of its members
+    """
+    fingerprint = hashlib.sha1()
+    for canvas_section_id in sorted(canvas_sections, key=str):
+        section_name, member_set = canvas_sections[canvas_section_id]
+        fingerprint.update(json.dumps(
+            [str(canvas_section_id), section_name, sorted(map(str, member_set))]
+        ).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
 def remove_user_list_from_section(users, section_id):
     """
     remove all users in the users list from the section
@@ -136,45 +316,50 @@ def add_user_list_to_section(users, section_id):
     SectionMember.objects.bulk_create(members)
 
 
-def create_or_update_section(course_instance, sis_course_id, canvas_section_id, section_name):
+def create_or_update_sections(course_instance, sis_course_id, section_names):
     """
-    create or update a section in the coursemanager database. The method
-    checks to see if a section already exists with the canvas_section_id.
-    If one does exist, it will update the section name if needed. If one
-    does not exist, it will create a new section.
+    create or update the sections of a course in the coursemanager database.
+    section_names is a dict of canvas_section_id to section name. The existing
+    sections with those canvas_section_id's are fetched in one query, the
+    renamed ones are updated in one bulk_update and the missing ones are
+    created in one bulk_create. Returns a dict of canvas_section_id to the
+    coursemanager section_id.
     """
-    try:
-        """
-        get will throw an ObjectDoesNotExist exception if a record does not
-        exist for the current section. In that case we catch it and do an 
-        insert vs an update. Since we are manually creating the primary key
-        for the section, we can't use the nicer django method update_or_create
+    # sections are matched on canvas_section_id alone, as before, not on
+    # course_instance, so a section that moves between course instances is
+    # updated in place rather than duplicated
+    cm_sections = {s.canvas_section_id: s for s in
+                   Section.objects.filter(canvas_section_id__in=list(section_names))}
+
+    renamed_sections = []
+    for canvas_section_id, cm_section in cm_sections.items():
+        if cm_section.name != section_names[canvas_section_id]:
+            cm_section.name = section_names[canvas_section_id]
+            renamed_sections.append(cm_section)
+    if renamed_sections:
+        Section.objects.bulk_update(renamed_sections, ['name'])
+
+    new_sections = [Section(course_instance=course_instance, name=section_name, canvas_section_id=canvas_section_id)
+                    for canvas_section_id, section_name in section_names.items()
+                    if canvas_section_id not in cm_sections]
+    if new_sections:
         """
-        cm_section = Section.objects.get(canvas_section_id=canvas_section_id)
-        cm_section_id = cm_section.section_id
-        
+        Django can only read back the generated primary keys of a bulk insert
+        on backends that support it (not Oracle, which would need a MERGE or
+        RETURNING per row), so otherwise the new sections are re-selected in
+        a single query
         """
-        update the section name if it is different
-        """
-        if cm_section.name != section_name:
-            cm_section.name = section_name
-            cm_section.save()
+        Section.objects.bulk_create(new_sections)
+        if any(s.section_id is None for s in new_sections):
+            new_sections = Section.objects.filter(
+                canvas_section_id__in=[s.canvas_section_id for s in new_sections])
+        for cm_section in new_sections:
+            cm_sections[cm_section.canvas_section_id] = cm_section
+            logger.info('created new section \'{}\' in course {} with section_id {}'.format(cm_section.name,
+                                                                                            sis_course_id,
+                                                                                            cm_section.section_id))
 
-    except ObjectDoesNotExist:
-        """
-        the section did not exist in the coursemanager section table so
-        we create a new section.
-        """        
-        cm_section = Section(course_instance=course_instance, name=section_name, canvas_section_id=canvas_section_id)
-        new_section_list = [cm_section]
-        Section.objects.bulk_create(new_section_list)
-        cm_section = Section.objects.get(canvas_section_id=canvas_section_id)
-        cm_section_id = cm_section.section_id
-        logger.info('created new section \'{}\' in course {} with section_id {}'.format(section_name,
-                                                                                        sis_course_id,
-                                                                                        cm_section_id))
-
-    return cm_section_id
+    return {canvas_section_id: cm_section.section_id for canvas_section_id, cm_section in cm_sections.items()}
 
 
 def remove_sections_from_cm(sections_to_remove, sis_course_id):
@@ -207,25 +392,34 @@ def get_enrollments_from_cm_section(section_id):
     return section_members
 
 
-def get_enrollments_from_canvas_section(canvas_section_id):
+def get_enrollments_from_canvas_course(canvas_course_id):
     """
-    get the list of enrollments for the canvas section
+    get the sis_user_id's of the members of each section of the canvas
+    course, as a dict of canvas section id to set of sis_user_id's. The
+    course's enrollments are streamed a page at a time, so only the
+    sis_user_id's are held in memory rather than every enrollment.
     """
-    enrollment_list = get_all_list_data(SDK_CONTEXT, enrollments.list_enrollments_sections, canvas_section_id)
-    sis_user_id_list = []
-    for enrollment in enrollment_list:
-        sis_user_id = enrollment['user'].get('sis_user_id')
+    section_members = defaultdict(set)
+    for enrollment in iter_canvas_list_data(enrollments.list_enrollments_courses, canvas_course_id,
+                                            per_page=CANVAS_PAGE_SIZE):
+        sis_user_id = (enrollment.get('user') or {}).get('sis_user_id')
         if sis_user_id:
-            sis_user_id_list.append(sis_user_id)
-    return sis_user_id_list
+            section_members[enrollment.get('course_section_id')].add(sis_user_id)
+    return section_members
 
 
-def get_canvas_section(section_id):
+def iter_canvas_list_data(function, *args, **kwargs):
     """
-    Get a single canvas section from the given section_id
+    Like canvas_sdk.utils.get_all_list_data, but yields the items of each
+    page as it arrives instead of building a list of all of them
     """
-    section = sections.get_section_information_sections(SDK_CONTEXT, section_id).json()
-    return section
+    response = function(SDK_CONTEXT, *args, **kwargs)
+    while True:
+        yield from response.json()
+        next_page = response.links.get('next')
+        if not next_page:
+            break
+        response = client.get(SDK_CONTEXT, next_page['url'])
 
 
 def get_cm_sections_list(course_instance):
@@ -240,21 +434,22 @@ def get_cm_sections_list(course_instance):
 
 def get_canvas_sections_list(canvas_course_id):
     """
-    Get a list of the sections exluding the primary section for the given canvas_course_id. 
+    Get a dict of section id to section name of the sections, exluding the
+    primary section, for the given canvas_course_id.
     We don't want primary sections. Primary sections are ones where the
     there exists an sis_section_id that the same as the sis_course_id. We 
     also don't want sections with no name.  
     """
     canvas_course_sections = get_all_list_data(SDK_CONTEXT, sections.list_course_sections, canvas_course_id)
-    canvas_course_sections_list = []
+    canvas_course_sections_names = {}
     for canvas_section in canvas_course_sections:
         canvas_section_id = canvas_section.get('id')
         canvas_section_name = canvas_section.get('name')
         sis_course_id = canvas_section.get('sis_course_id')
         sis_section_id = canvas_section.get('sis_section_id')
         if canvas_section_id and (sis_course_id != sis_section_id) and canvas_section_name:
-            canvas_course_sections_list.append(canvas_section_id)
-    return canvas_course_sections_list
+            canvas_course_sections_names[canvas_section_id] = canvas_section_name
+    return canvas_course_sections_names
 
 
 def get_course_list_from_canvas(account_id):
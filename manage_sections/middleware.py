@@ -0,0 +1,29 @@
+import logging
+
+from .utils import CourseInstanceIdentityMap, _course_instance_identity_map
+
+logger = logging.getLogger(__name__)
+
+
+class CourseInstanceIdentityMapMiddleware(object):
+    """
+    Gives each request its own CourseInstance identity map (see
+    manage_sections.utils.CourseInstanceIdentityMap), so every CourseInstance
+    row is read at most once per request, and logs how many duplicate
+    lookups that saved.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        identity_map = CourseInstanceIdentityMap()
+        token = _course_instance_identity_map.set(identity_map)
+        try:
+            return self.get_response(request)
+        finally:
+            _course_instance_identity_map.reset(token)
+            if identity_map.duplicates_avoided:
+                logger.debug(
+                    'CourseInstance identity map for %s: %d rows loaded, %d '
+                    'duplicate lookups avoided', request.path,
+                    len(identity_map), identity_map.duplicates_avoided)
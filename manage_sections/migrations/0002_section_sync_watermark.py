@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_sections', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SectionSyncWatermark',
+            fields=[
+                ('canvas_course_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'manage_sections_sync_watermark',
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import models
+
+
+class SectionSyncWatermark(models.Model):
+    '''
+    Records the last successful sync_canvas_sections run for a Canvas course,
+    along with a fingerprint of the sections and section members it synced,
+    so that later runs can skip courses that haven't changed since.
+    '''
+    canvas_course_id = models.IntegerField(primary_key=True)
+    fingerprint = models.CharField(max_length=40)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'manage_sections'
+        db_table = 'manage_sections_sync_watermark'
+
+    def __str__(self):
+        return 'canvas course id:{}, synced at:{}'.format(
+            self.canvas_course_id, self.synced_at)
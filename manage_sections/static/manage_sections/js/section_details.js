@@ -35,18 +35,180 @@ $(document).ready(function() {
         $('.selection_count_pluralize').text(selectedUserCount == 1 ? '' : 's');
     }
 
+    // Client-side copy of a roster served by section_user_list_data or
+    // section_class_list_data. Each reload sends the ETag and the hashes of
+    // the letter range buckets it already has, so the server only sends the
+    // buckets that changed, and only those are re-rendered.
+    function Roster(options) {
+        this.url = options.url;
+        this.$container = options.$container;
+        this.listId = options.listId;
+        this.msgId = options.msgId;
+        this.emptyText = options.emptyText;
+        this.mode = options.mode;
+        this.allowEdit = false;
+        this.etag = null;
+        this.buckets = {};
+    }
+
+    Roster.prototype.load = function() {
+        var roster = this;
+        var have = $.map(roster.buckets, function(bucket, range) {
+            return range + ':' + bucket.hash;
+        });
+        return $.ajax({
+            url: roster.url,
+            data: have.length ? {have: have.join(',')} : {},
+            dataType: 'json',
+            headers: roster.etag ? {'If-None-Match': roster.etag} : {}
+        })
+        .done(function(data, textStatus, xhr) {
+            if (xhr.status == 304) {
+                return;
+            }
+            roster.etag = xhr.getResponseHeader('ETag');
+            roster.render(data);
+        });
+    };
+
+    Roster.prototype.render = function(data) {
+        var roster = this;
+        var $list = $('#' + roster.listId);
+        if (!data.count) {
+            roster.buckets = {};
+            roster.$container.html($('<div class="jumbotron jumbotron-lti-emptySection">')
+                .append($('<h4>').text(roster.emptyText)));
+            return;
+        }
+        if (!$list.length) {
+            // first render (or the list was empty); no buckets to reuse
+            roster.buckets = {};
+            $list = $('<ul class="list-group list-section">').attr('id', roster.listId)
+                .append($('<li class="list-group-item pagination-lti">'))
+                .append($('<li class="message-holder list-group-item hidden">').attr('id', roster.msgId));
+            roster.$container.empty().append($list);
+        }
+
+        roster.allowEdit = data.allow_edit;
+        var $after = $list.children('#' + roster.msgId);
+        var firstName = null, lastName = null;
+        $.each(data.buckets, function(i, bucket) {
+            var cached = roster.buckets[bucket.range];
+            if (bucket.enrollments) {
+                $list.children('li.list-student').filter(function() {
+                    return $(this).data('bucket') === bucket.range;
+                }).remove();
+                var $items = $.map(bucket.enrollments, function(enrollee) {
+                    return roster.renderEnrollee(enrollee, bucket.range)[0];
+                });
+                $after.after($items);
+                cached = roster.buckets[bucket.range] = {
+                    hash: bucket.hash, enrollments: bucket.enrollments
+                };
+            }
+            if (cached && cached.enrollments.length) {
+                $after = $list.children('li.list-student').filter(function() {
+                    return $(this).data('bucket') === bucket.range;
+                }).last();
+                firstName = firstName || cached.enrollments[0].user.sortable_name;
+                lastName = cached.enrollments[cached.enrollments.length - 1].user.sortable_name;
+            }
+        });
+
+        $list.children('li.pagination-lti').replaceWith(
+            roster.renderPagination(data.letter_ranges, firstName, lastName));
+        $list.alphabetPagination();
+    };
+
+    Roster.prototype.renderPagination = function(letterRanges, firstName, lastName) {
+        var roster = this;
+        var $pills = $('<ul class="nav nav-pills nav-section-pagination">')
+            .append('<li class="active"><a class="viewAll" href="#">All</a></li>');
+        $.each(letterRanges, function(i, range) {
+            var bucket = roster.buckets[range];
+            $pills.append($('<li>')
+                .toggleClass('disabled', !(bucket && bucket.enrollments.length))
+                .append($('<a href="#">').addClass(range.toLowerCase()).text(range.replace('-', ' - '))));
+        });
+        var lname = function(sortableName) {
+            return (sortableName || '').split(',')[0];
+        };
+        return $('<li class="list-group-item pagination-lti">')
+            .append('<span class="pagination-lti-label pagination-lti-view">View: </span>')
+            .append($pills)
+            .append($('<span class="pagination-lti-label pagination-lti-range">')
+                .text(lname(firstName) + ' - ' + lname(lastName)));
+    };
+
+    Roster.prototype.renderEnrollee = function(enrollee, range) {
+        var user = enrollee.user;
+        var $li = $('<li class="list-group-item list-student">')
+            .addClass((range || 'none').toLowerCase())
+            .data('bucket', range);
+        if (this.allowEdit && this.mode == 'add') {
+            $li.append($('<input type="checkbox" class="add-user" data-toggle="tooltip">').attr({
+                'id': user.id,
+                'data-course_id': enrollee.course_id,
+                'data-course_section_id': enrollee.course_section_id,
+                'data-sis_course_id': enrollee.sis_course_id,
+                'data-user_id': user.id,
+                'data-enrollment_role': enrollee.role,
+                'data-enrollment_role_id': enrollee.role_id,
+                'data-enrollment_role_label': enrollee.role_label,
+                'data-section': $('main').data('section_id'),
+                'data-enrollment_type': enrollee.type,
+                'title': 'Add ' + user.name + ' to this section',
+                'data-original-title': 'Add ' + user.name + ' to this section'
+            }));
+        }
+        if (this.allowEdit && this.mode == 'delete') {
+            $li.append($('<a href="#" class="remover icon-removeUser" data-toggle="tooltip">').attr({
+                'id': enrollee.id,
+                'data-user_id': user.id,
+                'data-enrollee-id': enrollee.id,
+                'data-enrollment_role_id': enrollee.role_id,
+                'data-enrollment_role_label': enrollee.role_label,
+                'data-user_name': user.name,
+                'data-to_section': $('main').data('section_id'),
+                'title': 'Remove ' + user.name + ' from this section',
+                'data-original-title': 'Remove ' + user.name + ' from this section'
+            }).append('<i class="fa fa-trash-o"></i><span class="sr-only"> Remove student from section</span>'));
+        }
+        var badge = enrollee.badge_label_name || '';
+        $li.append($('<span class="studentRole">').text(enrollee.role_label))
+            .append(' ')
+            .append($('<span class="studentName">').text(user.name))
+            .append(' ')
+            .append($('<span class="label">').addClass('label-' + badge.toLowerCase())
+                .text(badge != 'XID' ? badge.toUpperCase() : 'Harvard Guest'));
+        return $li;
+    };
+
+    var sectionUsers = new Roster({
+        url: userlistURL,
+        $container: $('#sectionUsers'),
+        listId: 'people-list',
+        msgId: 'message-sectionUsers',
+        emptyText: 'This section is empty.',
+        mode: 'delete'
+    });
+
+    var sectionClassList = new Roster({
+        url: classlistURL,
+        $container: $('#fullClassList'),
+        listId: 'people-in-course',
+        msgId: 'message-fullClassList',
+        emptyText: 'Everyone has been added to this section.',
+        mode: 'add'
+    });
+
     function loadSectionUsers(msgEleId, msgCSS, msgTxt) {
-        $.get(userlistURL, function( data ) {
-            $('#sectionUsers').html( data );
+        sectionUsers.load()
+        .done(function(){
             updateSectionUserCountDisplay();
-            //call the pagination plugin after the data has been added
-            $('#people-list').alphabetPagination();
             paneHeight();
             // Tooltip message for when removing a user
             $(".icon-removeUser").tooltip();
-            $("#people-list").on('click', '.icon-removeUser', removeUser);
-        })
-        .done(function(){
             //checking for msgCSS and msgTxt controls the displaying from showing when successfully
             //removing users from a section
             if ( !(typeof msgEleId === 'undefined' || typeof msgCSS === 'undefined' || typeof msgTxt === 'undefined') ) {
@@ -56,21 +218,14 @@ $(document).ready(function() {
     }
 
     function loadSectionClassList(msgEleId, msgCSS, msgTxt) {
-        $.get(classlistURL, function( data ) {
-            $('#fullClassList').html( data );
+        sectionClassList.load()
+        .done(function(){
             // Reset selection count
+            $getSelectedUsers().prop('checked', false);
             updateSelectionCountDisplay();
             $('.btn.add-selected-users').prop('disabled', true);
-            // Call the pagination plugin after the data has been added
-            $('#people-in-course').alphabetPagination();
             paneHeight();
 
-            $('#fullClassList input.add-user').on('click', function(){
-                updateSelectionCountDisplay();
-                $('.btn.add-selected-users').prop('disabled', getSelectedUserCount() <= 0);
-            });
-        })
-        .done(function(){
             //checking for msgCSS and msgTxt controls the displaying from showing when successfully
             //removing users from a section
             if ( !(typeof msgEleId === 'undefined' || typeof msgCSS === 'undefined' || typeof msgTxt === 'undefined') )
@@ -273,6 +428,11 @@ $(document).ready(function() {
     }
 
     $('#addUsers').on('click', showAddUsersPanel);
+    $('#sectionUsers').on('click', '.icon-removeUser', removeUser);
+    $('#fullClassList').on('click', 'input.add-user', function(){
+        updateSelectionCountDisplay();
+        $('.btn.add-selected-users').prop('disabled', getSelectedUserCount() <= 0);
+    });
     $('.btn.add-selected-users').on('click', addSelectedUsers);
 
     // Populate the left pane with section members
@@ -1,9 +1,40 @@
+import functools
+from operator import itemgetter
+
 from django import template
 from django.template.defaultfilters import stringfilter
 
 register = template.Library()
 
 
+@functools.lru_cache(maxsize=32)
+def letter_range_bucketer(args):
+    """
+    Compiles a comma separated string of letter ranges (see to_letter_range)
+    into a function that returns the range a name falls in. The ranges are
+    parsed once per distinct string, into a table of first letter to range,
+    so bucketing a name is a single lookup.
+    """
+    letter_ranges = [arg.strip().upper() for arg in args.split(',')]
+    table = {}
+    # names that aren't in any range get None, unless they reach an empty
+    # range first, in which case they get an empty string
+    default = None
+    for letter_range in letter_ranges:
+        if not letter_range:
+            default = ''
+            break
+        for ord_val in range(ord(letter_range[0]), ord(letter_range[-1]) + 1):
+            # the first range a letter falls in wins
+            table.setdefault(chr(ord_val), letter_range)
+
+    def bucket(name):
+        if not name:
+            return ''
+        return table.get(name[0].upper(), default)
+    return bucket
+
+
 @register.filter(is_safe=True)
 @stringfilter
 def to_letter_range(name, args):
@@ -11,18 +42,9 @@ def to_letter_range(name, args):
     Return the letter range for a given string where the range is given as a comma separated string.  For
     example, passing 'Doe, John' to the filter with arguments of 'A-C,D-F,G-Z' would return
     'D-F'.  Ranges can either be in the form 'A-D' or can be single letters like 'S'.
+    Either an empty name or an empty range gets an empty string.
     """
-    try:
-        ord_val = ord(name[0].upper())
-        letter_ranges = [arg.strip().upper() for arg in args.split(',')]
-        for letter_range in letter_ranges:
-            range_len = len(letter_range)
-            if ord(letter_range[0]) <= ord_val <= ord(letter_range[range_len - 1]):
-                return letter_range
-    except IndexError:
-        # Either the name passed in was empty, or one of the ranges was passed in as an empty string, so
-        # just return an empty string in this case.
-        return ''
+    return letter_range_bucketer(args)(name)
 
 
 @register.filter
@@ -30,8 +52,7 @@ def list_comp(lst):
     """
     Build a list comprehension by iterating over the GroupedResult list
     """
-    comp = [x[0] for x in lst]
-    return comp
+    return list(map(itemgetter(0), lst))
 
 
 @register.filter(is_safe=True)
@@ -0,0 +1,133 @@
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from manage_sections import jobs
+
+
+@patch('manage_sections.jobs.CourseStaff')
+@patch('manage_sections.jobs.CourseGuest')
+@patch('manage_sections.jobs.CourseEnrollee')
+@patch('manage_sections.jobs.get_course_instance')
+@patch('manage_sections.jobs.canvas_api_helper_sections.delete_section')
+@patch('manage_sections.jobs.delete_enrollments')
+@patch('manage_sections.jobs.get_all_list_data')
+@patch('manage_sections.jobs.get_current_job')
+class RemoveSectionJobTest(TestCase):
+    longMessage = True
+    canvas_course_id = '111'
+    sis_section_id = '123'
+    section_id = 371
+
+    def setUp(self):
+        self.section = {'id': self.section_id, 'name': 'Test Name'}
+        self.enrollments = [{'id': i, 'course_section_id': self.section_id}
+                            for i in range(250)]
+
+    def run_job(self, mock_get_current_job, meta=None):
+        job = MagicMock(meta={} if meta is None else meta)
+        mock_get_current_job.return_value = job
+        return job, jobs.remove_section(
+            self.canvas_course_id, self.sis_section_id, self.section_id)
+
+    def test_removes_section_and_all_enrollment_pages(
+            self, mock_get_current_job, mock_get_all_list_data,
+            mock_delete_enrollments, mock_delete_section,
+            mock_get_course_instance, *mock_tables):
+        mock_get_all_list_data.return_value = self.enrollments
+        mock_delete_enrollments.return_value = (self.enrollments, True)
+        mock_delete_section.return_value = self.section
+
+        job, section = self.run_job(mock_get_current_job)
+
+        self.assertEqual(section, self.section)
+        self.assertEqual(mock_get_course_instance.return_value.deleted, 1)
+        for table in mock_tables:
+            table.objects.filter.assert_called_once_with(
+                course_instance_id=self.sis_section_id)
+        # every page of enrollments is deleted, not just the first
+        mock_delete_enrollments.assert_called_once_with(
+            self.enrollments, self.canvas_course_id)
+        self.assertEqual(job.meta['stage'], 'done')
+        self.assertEqual(job.meta['deleted_enrollments'], 250)
+        self.assertEqual(job.meta['section'], self.section)
+
+    def test_resumes_at_recorded_stage(
+            self, mock_get_current_job, mock_get_all_list_data,
+            mock_delete_enrollments, mock_delete_section,
+            mock_get_course_instance, *mock_tables):
+        """ A requeued job should not redo the steps it already finished """
+        mock_get_all_list_data.return_value = self.enrollments[200:]
+        mock_delete_enrollments.return_value = (self.enrollments[200:], True)
+        mock_delete_section.return_value = self.section
+
+        job, section = self.run_job(
+            mock_get_current_job,
+            meta={'stage': 'delete_canvas_enrollments',
+                  'deleted_enrollments': 200})
+
+        self.assertEqual(section, self.section)
+        mock_get_course_instance.assert_not_called()
+        for table in mock_tables:
+            table.objects.filter.assert_not_called()
+        self.assertEqual(job.meta['deleted_enrollments'], 250)
+        self.assertEqual(job.meta['stage'], 'done')
+
+    def test_failed_enrollment_delete_stops_before_section_delete(
+            self, mock_get_current_job, mock_get_all_list_data,
+            mock_delete_enrollments, mock_delete_section,
+            mock_get_course_instance, *mock_tables):
+        mock_get_all_list_data.return_value = self.enrollments
+        mock_delete_enrollments.return_value = (self.enrollments[:100], False)
+
+        with self.assertRaises(jobs.RemoveSectionError):
+            self.run_job(mock_get_current_job)
+
+        job = mock_get_current_job.return_value
+        mock_delete_section.assert_not_called()
+        # so a retry starts again with whatever enrollments are left
+        self.assertEqual(job.meta['stage'], 'delete_canvas_enrollments')
+        self.assertEqual(job.meta['deleted_enrollments'], 100)
+
+    def test_restarted_job_finishes_from_recorded_stage(
+            self, mock_get_current_job, mock_get_all_list_data,
+            mock_delete_enrollments, mock_delete_section,
+            mock_get_course_instance, *mock_tables):
+        """
+        A job that fails partway through and is run again with the same meta
+        (as a retried or requeued rq job is) finishes without redoing the
+        steps it got through the first time
+        """
+        mock_get_all_list_data.side_effect = [self.enrollments,
+                                              self.enrollments[100:]]
+        mock_delete_enrollments.side_effect = [
+            (self.enrollments[:100], False), (self.enrollments[100:], True)]
+        mock_delete_section.return_value = self.section
+
+        with self.assertRaises(jobs.RemoveSectionError):
+            self.run_job(mock_get_current_job)
+        job = mock_get_current_job.return_value
+        job, section = self.run_job(mock_get_current_job, meta=job.meta)
+
+        self.assertEqual(section, self.section)
+        self.assertEqual(mock_get_course_instance.call_count, 1)
+        for table in mock_tables:
+            self.assertEqual(table.objects.filter.call_count, 1)
+        mock_delete_section.assert_called_once_with(
+            self.canvas_course_id, self.section_id)
+        self.assertEqual(job.meta['stage'], 'done')
+        self.assertEqual(job.meta['deleted_enrollments'], 250)
+
+    def test_runs_inline_without_a_job(
+            self, mock_get_current_job, mock_get_all_list_data,
+            mock_delete_enrollments, mock_delete_section,
+            mock_get_course_instance, *mock_tables):
+        mock_get_current_job.return_value = None
+        mock_get_all_list_data.return_value = []
+        mock_delete_section.return_value = self.section
+
+        section = jobs.remove_section(
+            self.canvas_course_id, self.sis_section_id, self.section_id)
+
+        self.assertEqual(section, self.section)
+        mock_delete_enrollments.assert_not_called()
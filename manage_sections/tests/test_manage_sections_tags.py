@@ -1,7 +1,22 @@
+import random
+import string
 from unittest import TestCase
 from manage_sections.templatetags import manage_sections_tags
 
 
+def legacy_to_letter_range(name, args):
+    """ The to_letter_range filter as it was, re-parsing the ranges per name """
+    try:
+        ord_val = ord(name[0].upper())
+        letter_ranges = [arg.strip().upper() for arg in args.split(',')]
+        for letter_range in letter_ranges:
+            range_len = len(letter_range)
+            if ord(letter_range[0]) <= ord_val <= ord(letter_range[range_len - 1]):
+                return letter_range
+    except IndexError:
+        return ''
+
+
 class ManageSectionsTagsTest(TestCase):
     longMessage = True
 
@@ -97,3 +112,50 @@ class ManageSectionsTagsTest(TestCase):
         """
         res = manage_sections_tags.enrollment_lname({})
         self.assertEqual(res, '', 'Result should be an empty string')
+
+    def test_to_letter_range_no_match(self):
+        """
+        Test that a name outside of every range isn't put in one
+        """
+        res = manage_sections_tags.to_letter_range('Zed, Foo', 'A-D,E-F')
+        self.assertIsNone(res, 'Result should not match any range')
+
+    def test_to_letter_range_empty_range(self):
+        """
+        Test that an empty range gives an empty string for names that aren't
+        in an earlier range, as it did when the ranges were parsed per name
+        """
+        self.assertEqual(manage_sections_tags.to_letter_range('Bar, Foo', 'A-D,,E-F'), 'A-D')
+        self.assertEqual(manage_sections_tags.to_letter_range('Foo, Bar', 'A-D,,E-F'), '')
+
+    def test_to_letter_range_first_matching_range_wins(self):
+        """
+        Test that a name in overlapping ranges gets the first of them
+        """
+        res = manage_sections_tags.to_letter_range('Dee, Foo', 'A-D,C-F')
+        self.assertEqual(res, 'A-D', 'Result should match the first range')
+
+    def test_letter_range_bucketer_compiled_once_per_spec(self):
+        """
+        Test that the ranges are compiled once and reused for every name
+        """
+        bucketer = manage_sections_tags.letter_range_bucketer('A-D,E-H')
+        self.assertIs(manage_sections_tags.letter_range_bucketer('A-D,E-H'), bucketer)
+        self.assertEqual(bucketer('Ed'), 'E-H')
+
+    def test_to_letter_range_matches_legacy_for_roster(self):
+        """
+        Test that the compiled ranges bucket a generated roster exactly as the
+        per-name parsing did, including names that start with a digit or
+        punctuation, empty names and an empty range
+        """
+        rand = random.Random(5000)
+        alphabet = string.ascii_letters + string.digits + string.punctuation
+        names = [''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 8)))
+                 for _ in range(2000)]
+        for letter_ranges in ('A-D,E-H,I-L,M-P,Q-S,T-Z', 'a-d, e-h', 'A-D,,E-F', 'C-F,A-D'):
+            bucketer = manage_sections_tags.letter_range_bucketer(letter_ranges)
+            expected = [legacy_to_letter_range(name, letter_ranges) for name in names]
+            self.assertEqual([manage_sections_tags.to_letter_range(name, letter_ranges) for name in names],
+                             expected, letter_ranges)
+            self.assertEqual([bucketer(name) for name in names], expected, letter_ranges)
@@ -0,0 +1,29 @@
+from django.test import RequestFactory, TestCase
+from mock import patch
+
+from manage_sections.middleware import CourseInstanceIdentityMapMiddleware
+from manage_sections.utils import get_course_instance
+
+
+class CourseInstanceIdentityMapMiddlewareTest(TestCase):
+    longMessage = True
+
+    @patch('manage_sections.utils.CourseInstance.objects.get')
+    def test_lookups_shared_within_request(self, mock_get):
+        def view(request):
+            return [get_course_instance(305841) for _ in range(3)]
+        middleware = CourseInstanceIdentityMapMiddleware(view)
+
+        first_request = middleware(RequestFactory().get('/fake-path'))
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertTrue(all(ci is first_request[0] for ci in first_request))
+
+        # a new request gets a new map
+        middleware(RequestFactory().get('/fake-path'))
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch('manage_sections.utils.CourseInstance.objects.get')
+    def test_no_sharing_outside_a_request(self, mock_get):
+        get_course_instance(305841)
+        get_course_instance(305841)
+        self.assertEqual(mock_get.call_count, 2)
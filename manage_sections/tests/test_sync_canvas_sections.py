@@ -1,18 +1,24 @@
+from io import StringIO
+
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.management import call_command
 from django.test import TestCase
 from icommons_common.models import Section, SectionMember
-from icommons_common.tests.test_mock_helpers import set_disappearing_side_effect
 from mock import ANY, Mock, call, patch
 
+from manage_sections.management.commands import sync_canvas_sections
 from manage_sections.management.commands.sync_canvas_sections import (
     Command,
     add_user_list_to_section,
-    create_or_update_section,
+    create_or_update_sections,
     get_account_list_from_canvas,
     get_canvas_sections_list,
-    get_enrollments_from_canvas_section,
+    get_enrollments_from_canvas_course,
+    init_process_worker,
     remove_sections_from_cm,
+    sync_course,
 )
+from manage_sections.models import SectionSyncWatermark
 
 
 class CourseInstanceStub:
@@ -52,15 +58,31 @@ class CommandsTestSyncCanvasSections(TestCase):
                                 {'id': '', 'sis_course_id': 44, 'sis_section_id': 444, 'name': '',},
                                 {'not_id': 5, 'sis_course_id': 44, 'sis_section_id': 555, }]
 
-    @patch('manage_sections.management.commands.sync_canvas_sections.get_all_list_data')
-    def test_get_enrollments_from_canvas_section(self, sdk_mock):
-        """
-        tests that the method get_enrollments_from_canvas_section returns
-        the correct list of sis_user_id's
-        """
-        sdk_mock.return_value = self.canvas_enrollments
-        canvas_enrollments = get_enrollments_from_canvas_section(self.canvas_section_id)
-        self.assertEqual(canvas_enrollments, ['11111111', '22222222', '33333333'])
+    @patch('manage_sections.management.commands.sync_canvas_sections.client.get')
+    @patch('manage_sections.management.commands.sync_canvas_sections.enrollments.list_enrollments_courses')
+    def test_get_enrollments_from_canvas_course(self, list_enrollments_mock, client_get_mock):
+        """
+        tests that the method get_enrollments_from_canvas_course follows the
+        pages of the course's enrollments and groups the sis_user_id's by
+        canvas section id
+        """
+        for enrollment in self.canvas_enrollments:
+            enrollment['course_section_id'] = self.canvas_section_id
+        other_section_enrollment = {'user': {'sis_user_id': '11111111'}, 'course_section_id': 7777}
+        first_page = Mock(links={'next': {'url': 'https://canvas/next-page'}})
+        first_page.json.return_value = self.canvas_enrollments[:3]
+        last_page = Mock(links={})
+        last_page.json.return_value = self.canvas_enrollments[3:] + [other_section_enrollment]
+        list_enrollments_mock.return_value = first_page
+        client_get_mock.return_value = last_page
+
+        canvas_enrollments = get_enrollments_from_canvas_course(self.canvas_course_id)
+        self.assertEqual(canvas_enrollments, {
+            self.canvas_section_id: {'11111111', '22222222', '33333333'},
+            7777: {'11111111'},
+        })
+        list_enrollments_mock.assert_called_once_with(ANY, self.canvas_course_id, per_page=ANY)
+        client_get_mock.assert_called_once_with(ANY, 'https://canvas/next-page')
 
     @patch('manage_sections.management.commands.sync_canvas_sections.get_all_list_data')
     def test_get_canvas_sections_list(self, filter_mock):
@@ -70,7 +92,7 @@ class CommandsTestSyncCanvasSections(TestCase):
         """
         filter_mock.return_value = self.canvas_sections
         sections_list = get_canvas_sections_list(self.canvas_course_id)
-        self.assertEqual(sections_list, [1, 2, 3])
+        self.assertEqual(sections_list, {1: 'sec_one', 2: 'sec_two', 3: 'sec_three'})
 
     @patch('manage_sections.management.commands.sync_canvas_sections.get_all_list_data')
     def test_get_account_list_from_canvas(self, filter_mock):
@@ -85,47 +107,60 @@ class CommandsTestSyncCanvasSections(TestCase):
 
     @patch('manage_sections.management.commands.sync_canvas_sections.Section')
     @patch('manage_sections.management.commands.sync_canvas_sections.logger')
-    def test_create_or_update_section_assert_save_called(self, logger_mock,
-                                                         section_mock):
+    def test_create_or_update_sections_assert_bulk_update_called(self, logger_mock,
+                                                                section_mock):
         """
-        Test that save is called when the course exists, and create isn't.
+        Test that only the renamed sections are bulk updated when the sections
+        exist, and nothing is created.
         """
         course_instance_mock = Mock(name="course_instance")
         create_mock = section_mock.objects.bulk_create
-        get_mock = section_mock.objects.get
-        mock_section = Mock(spec=Section())
-        save_mock = mock_section.save
-        get_mock.return_value = mock_section
+        update_mock = section_mock.objects.bulk_update
+        renamed_section = Mock(spec=Section(), canvas_section_id=1239, section_id=11)
+        renamed_section.name = 'old name'
+        same_section = Mock(spec=Section(), canvas_section_id=1240, section_id=12)
+        same_section.name = 'same name'
+        section_mock.objects.filter.return_value = [renamed_section, same_section]
 
         sis_course_id = 3030303
-        canvas_section_id = 1239
-        section_name = 'test section'
-        create_or_update_section(course_instance_mock, sis_course_id,
-                                 canvas_section_id, section_name)
+        section_ids = create_or_update_sections(course_instance_mock, sis_course_id,
+                                                {1239: 'test section', 1240: 'same name'})
 
+        self.assertEqual(section_ids, {1239: 11, 1240: 12})
+        self.assertEqual(section_mock.objects.filter.call_count, 1)
         self.assertEqual(create_mock.call_count, 0)
-        self.assertEqual(save_mock.call_count, 1)
-
+        update_mock.assert_called_once_with([renamed_section], ['name'])
+        self.assertEqual(renamed_section.name, 'test section')
+        self.assertEqual(renamed_section.save.call_count, 0)
 
     @patch('manage_sections.management.commands.sync_canvas_sections.Section')
     @patch('manage_sections.management.commands.sync_canvas_sections.logger')
-    def test_create_or_update_section_assert_create_called_when_objectdoesnotexist_occurs(self, logger_mock, section_mock):
+    def test_create_or_update_sections_assert_bulk_create_called_for_missing_sections(self, logger_mock,
+                                                                                     section_mock):
         """
-        Test that create is called when the course does not exist.  When the 
-        course does not exist the get call with throw an ObjectDoesNotExist
-        exception. We set this as a side_effect of the get mock. 
+        Test that the sections that don't exist are created in a single
+        bulk_create, and re-selected in a single query when the backend can't
+        return their generated ids.
         """
-        get_mock = section_mock.objects.get
+        course_instance_mock = Mock(name="course_instance")
         create_mock = section_mock.objects.bulk_create
-        set_disappearing_side_effect(get_mock, ObjectDoesNotExist)
+        update_mock = section_mock.objects.bulk_update
+        section_mock.side_effect = lambda **kwargs: Mock(section_id=None, **kwargs)
+        section_mock.objects.filter.side_effect = [
+            [],
+            [Mock(canvas_section_id=1239, section_id=21), Mock(canvas_section_id=1240, section_id=22)],
+        ]
 
-        course_instance_mock = Mock(name="course_instance")
         sis_course_id = 3030303
-        canvas_section_id = 1239
-        section_name = 'test section'
-        create_or_update_section(course_instance_mock, sis_course_id,
-                                 canvas_section_id, section_name)
+        section_ids = create_or_update_sections(course_instance_mock, sis_course_id,
+                                                {1239: 'test section', 1240: 'other section'})
+
+        self.assertEqual(section_ids, {1239: 21, 1240: 22})
         self.assertEqual(create_mock.call_count, 1)
+        (new_sections,), _ = create_mock.call_args
+        self.assertEqual(sorted(s.canvas_section_id for s in new_sections), [1239, 1240])
+        self.assertEqual(section_mock.objects.filter.call_count, 2)
+        self.assertEqual(update_mock.call_count, 0)
 
     @patch('manage_sections.management.commands.sync_canvas_sections.logger')
     @patch('manage_sections.management.commands.sync_canvas_sections.remove_all_users_from_section')
@@ -152,16 +187,16 @@ class CommandsTestSyncCanvasSections(TestCase):
         logger_mock.info.assert_called_once_with(
             'section with canvas_section_id <ANY> does not exist')
 
+    @patch('manage_sections.management.commands.sync_canvas_sections.SectionSyncWatermark')
     @patch('manage_sections.management.commands.sync_canvas_sections.add_user_list_to_section')
     @patch('manage_sections.management.commands.sync_canvas_sections.remove_user_list_from_section')
     @patch('manage_sections.management.commands.sync_canvas_sections.logger')
-    @patch('manage_sections.management.commands.sync_canvas_sections.create_or_update_section')
+    @patch('manage_sections.management.commands.sync_canvas_sections.create_or_update_sections')
     @patch('manage_sections.management.commands.sync_canvas_sections.SectionMember.objects.get')
     @patch('manage_sections.management.commands.sync_canvas_sections.SectionMember.objects.create')
-    @patch('manage_sections.management.commands.sync_canvas_sections.get_canvas_section')
     @patch('manage_sections.management.commands.sync_canvas_sections.SectionMember.objects.filter')
     @patch('manage_sections.management.commands.sync_canvas_sections.get_enrollments_from_cm_section')
-    @patch('manage_sections.management.commands.sync_canvas_sections.get_enrollments_from_canvas_section')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_enrollments_from_canvas_course')
     @patch('manage_sections.management.commands.sync_canvas_sections.Section.objects.create')
     @patch('manage_sections.management.commands.sync_canvas_sections.Section.objects.get')
     @patch('manage_sections.management.commands.sync_canvas_sections.get_cm_sections_list')
@@ -171,11 +206,11 @@ class CommandsTestSyncCanvasSections(TestCase):
     @patch('manage_sections.management.commands.sync_canvas_sections.get_account_list_from_canvas')
     def test_logic_in_main_body_of_command(self, get_account_list_mock, get_course_list_mock, course_instance_mock,
         get_canvas_sections_mock, get_cm_sections_list_mock, get_cm_section_mock, 
-        create_cm_section_mock, get_enrollments_from_canvas_section_mock, 
+        create_cm_section_mock, get_enrollments_from_canvas_course_mock, 
         get_enrollments_from_cm_section_mock, get_cm_section_members_mock, 
-        get_canvas_section_mock, create_section_member_mock, 
-        get_section_member_mock, create_or_update_section_mock, logger_mock, 
-        remove_user_list_from_section_mock, add_user_list_to_section_mock):
+        create_section_member_mock, 
+        get_section_member_mock, create_or_update_sections_mock, logger_mock, 
+        remove_user_list_from_section_mock, add_user_list_to_section_mock, watermark_mock):
         """
         First, I realize this is a large test but since it's testing the main body of the command and I would 
         have to repeat a lot of this code for each sub test, I've combind them. This test the logic of the main
@@ -188,18 +223,15 @@ class CommandsTestSyncCanvasSections(TestCase):
         get_course_list_mock.return_value = course_list
         ci = Mock(name="course_instance")
         course_instance_mock.return_value = ci
-        get_canvas_sections_mock.return_value = [789]
-        canvas_section = Mock(name="Canvas section")
-        canvas_section.get.return_value = 'test section'
-        get_canvas_section_mock.return_value = canvas_section
+        get_canvas_sections_mock.return_value = {789: 'test section'}
         get_cm_sections_list_mock.return_value = [123, 456, 789]
         create_cm_section_mock = Mock(name="new section")
-        create_or_update_section_mock.return_value = 790
+        create_or_update_sections_mock.return_value = {789: 790}
 
         """
         the user with id 5 is new and missing from the course manager list and should be added 
         """
-        get_enrollments_from_canvas_section_mock.return_value = [1, 2, 3, 5]
+        get_enrollments_from_canvas_course_mock.return_value = {789: {1, 2, 3, 5}}
 
         """
         the user with id 4 is missing from canvas and should be removed
@@ -207,9 +239,17 @@ class CommandsTestSyncCanvasSections(TestCase):
         get_enrollments_from_cm_section_mock.return_value = [1, 2, 3, 4]
         get_cm_section_members_mock = []
 
+        """
+        the pool's worker thread has its own DB connection, outside of the test's
+        transaction, so the watermark table is mocked here (it's tested against the
+        DB in test_unchanged_course_skipped_unless_full)
+        """
+        watermark_mock.objects.filter.return_value.exists.return_value = False
+
         cmd = Command()
-        opts = {} 
-        cmd.handle_noargs(**opts)
+        # a single worker syncs the courses in the order they're listed
+        opts = {'workers': 1, 'executor': 'thread'}
+        cmd.handle(**opts)
 
         account_mock_calls = [call(a) for a in account_list]
 
@@ -239,38 +279,43 @@ class CommandsTestSyncCanvasSections(TestCase):
         get_cm_sections_list_mock.assert_called_with(ci)
 
         """
-        assert that create_or_update_section is called with the course_instance object from the 
-        course list, the course_instance_id of the course_instance object, the canvas_section_id, and
-        the section name.
+        assert that create_or_update_sections is called with the course_instance object from the 
+        course list, the course_instance_id of the course_instance object, and the name of each
+        canvas_section_id.
         """
-        create_calls = [call(ci, c['sis_course_id'], 789, 'test section')
+        create_calls = [call(ci, c['sis_course_id'], {789: 'test section'})
                             for c in course_list]
-        create_or_update_section_mock.assert_has_calls(create_calls)
+        create_or_update_sections_mock.assert_has_calls(create_calls)
         
         """
-        assert that get_enrollments_from_canvas_section is called with the canvas_section_id
-        from the course_instance object
+        assert that get_enrollments_from_canvas_course is called once for each canvas course
         """
-        get_enrollments_from_canvas_section_mock.assert_called_with(789)
+        self.assertEqual(get_enrollments_from_canvas_course_mock.mock_calls,
+                         [call(c['id']) for c in course_list])
 
         """
         assert that get_enrollments_from_cm_section is called with the canvas_section_id
-        returned from create_or_update_section
+        returned from create_or_update_sections
         """
         get_enrollments_from_cm_section_mock.assert_called_with(790)
 
         """
         assert the remove_user_list_from_section call is called with the user to remove and the
-        canvas_section_id returned from create_or_update_section
+        canvas_section_id returned from create_or_update_sections
         """
         remove_user_list_from_section_mock.assert_called_with(set([4]), 790)
 
         """
         assert the add_user_list_to_section call is called with the user to add and the
-        canvas_section_id returned from create_or_update_section
+        canvas_section_id returned from create_or_update_sections
         """
         add_user_list_to_section_mock.assert_called_with(set([5]), 790)
 
+        """
+        assert that the watermark of each synced course is recorded
+        """
+        self.assertEqual(watermark_mock.objects.update_or_create.call_count, len(course_list))
+
     @patch('manage_sections.management.commands.sync_canvas_sections.SectionMember.objects.bulk_create')
     def test_add_user_list_to_section(self, object_create_mock):
         """
@@ -299,3 +344,84 @@ class CommandsTestSyncCanvasSections(TestCase):
         calls = [call(sm_expected_params)]
         object_create_mock.has_calls(calls, any_order=True)
 
+    @patch('manage_sections.management.commands.sync_canvas_sections.sync_course')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_course_list_from_canvas')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_account_list_from_canvas')
+    def test_courses_synced_by_worker_pool(self, get_account_list_mock, get_course_list_mock,
+                                           sync_course_mock):
+        """
+        test that every course of every account is synced by the worker pool, that a
+        course that fails doesn't stop the others, and that throughput is reported
+        """
+        get_account_list_mock.return_value = [1, 2]
+        get_course_list_mock.side_effect = lambda account_id: [
+            {'id': account_id * 100 + i, 'sis_course_id': str(i)} for i in range(10)]
+
+        def sync_course(course, full=False):
+            if course['id'] == 105:
+                raise Exception('sync failed')
+            return 'skipped' if course['id'] % 2 else 'synced'
+        sync_course_mock.side_effect = sync_course
+
+        stdout = StringIO()
+        call_command('sync_canvas_sections', workers=4, stdout=stdout)
+
+        self.assertEqual(
+            sorted(c[0][0]['id'] for c in sync_course_mock.call_args_list),
+            list(range(100, 110)) + list(range(200, 210)))
+        report = stdout.getvalue()
+        self.assertIn('account 1: 10 courses', report)
+        self.assertIn('account 2: 10 courses', report)
+        self.assertIn('total: 20 courses', report)
+        self.assertIn('1 failed', report)
+
+    @patch('manage_sections.management.commands.sync_canvas_sections.connections')
+    @patch('manage_sections.management.commands.sync_canvas_sections.SessionInactivityExpirationRC')
+    def test_process_worker_gets_its_own_canvas_session(self, request_context_mock, connections_mock):
+        """
+        test that a worker process replaces the Canvas request context it inherits
+        from the parent, so the processes don't share keep-alive connections
+        """
+        inherited_context = sync_canvas_sections.SDK_CONTEXT
+        try:
+            init_process_worker()
+            self.assertIs(sync_canvas_sections.SDK_CONTEXT, request_context_mock.return_value)
+            self.assertIsNot(sync_canvas_sections.SDK_CONTEXT, inherited_context)
+            connections_mock.close_all.assert_called_once_with()
+        finally:
+            sync_canvas_sections.SDK_CONTEXT = inherited_context
+
+    @patch('manage_sections.management.commands.sync_canvas_sections.add_user_list_to_section')
+    @patch('manage_sections.management.commands.sync_canvas_sections.remove_user_list_from_section')
+    @patch('manage_sections.management.commands.sync_canvas_sections.create_or_update_sections')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_enrollments_from_cm_section')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_cm_sections_list')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_enrollments_from_canvas_course')
+    @patch('manage_sections.management.commands.sync_canvas_sections.get_canvas_sections_list')
+    @patch('manage_sections.management.commands.sync_canvas_sections.CourseInstance.objects.get')
+    def test_unchanged_course_skipped_unless_full(self, course_instance_mock, get_canvas_sections_mock,
+                                                  get_enrollments_from_canvas_course_mock,
+                                                  get_cm_sections_list_mock, get_enrollments_from_cm_section_mock,
+                                                  create_or_update_sections_mock, *args):
+        """
+        test that a course whose Canvas sections and members match the watermark of its
+        last sync doesn't touch the coursemanager tables, unless a full sync is asked for
+        """
+        course = {'sis_course_id': '89101113', 'id': 2347}
+        get_canvas_sections_mock.return_value = {789: 'test section'}
+        get_enrollments_from_canvas_course_mock.return_value = {789: {'1', '2'}}
+        get_cm_sections_list_mock.return_value = [789]
+        get_enrollments_from_cm_section_mock.return_value = ['1', '2']
+
+        self.assertEqual(sync_course(course), 'synced')
+        self.assertTrue(SectionSyncWatermark.objects.filter(canvas_course_id=2347).exists())
+        self.assertEqual(sync_course(course), 'unchanged')
+        self.assertEqual(create_or_update_sections_mock.call_count, 1)
+
+        self.assertEqual(sync_course(course, full=True), 'synced')
+        self.assertEqual(create_or_update_sections_mock.call_count, 2)
+
+        # a new member changes the fingerprint
+        get_enrollments_from_canvas_course_mock.return_value = {789: {'1', '2', '3'}}
+        self.assertEqual(sync_course(course), 'synced')
+        self.assertEqual(create_or_update_sections_mock.call_count, 3)
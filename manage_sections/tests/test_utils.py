@@ -1,12 +1,25 @@
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import RequestFactory
 from django.test import TestCase
 from django_auth_lti import const
-from mock import patch
+from icommons_common.models import CourseInstance
+from canvas_sdk.exceptions import CanvasAPIError
+from mock import ANY, DEFAULT, patch
 
 from manage_sections.utils import (
+    CACHE_KEY_COURSE_GENERATION,
+    CourseInstanceIdentityMap,
+    classify_sections,
+    delete_enrollments,
+    get_course,
+    get_course_enrollments,
+    invalidate_course,
+    is_editable_section,
     is_enrollment_section,
     is_credit_status_section,
     is_sis_section,
+    update_cached_course_enrollments,
     validate_course_id,
 )
 
@@ -15,8 +28,11 @@ class CourseInstanceStub:
     """
     Stub out a course instance object
     """
-    def __init__(self, is_enrollment_section=False):
+    def __init__(self, is_enrollment_section=False, course_instance_id=None,
+                 source=None):
         self.is_enrollment_section = is_enrollment_section
+        self.course_instance_id = course_instance_id
+        self.source = source
 
 
 class IsPrimaryUtilsTest(TestCase):
@@ -117,6 +133,250 @@ class IsPrimaryUtilsTest(TestCase):
         )
 
 
+@patch('manage_sections.utils.CourseInstance.objects.filter')
+class ClassifySectionsTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.course_instances = [
+            CourseInstanceStub(is_enrollment_section=True,
+                               course_instance_id=305841),
+            CourseInstanceStub(course_instance_id=305842, source='managecrs'),
+            CourseInstanceStub(course_instance_id=305843, source='fasfeed'),
+        ]
+
+    def test_single_query_for_all_sections(self, mock_filter):
+        mock_filter.return_value = self.course_instances
+        result = classify_sections(['305841', '305842', '305843', '305844',
+                                    'ext:305841_role_1', 'dog', None])
+        mock_filter.assert_called_once_with(
+            course_instance_id__in=[305841, 305842, 305843, 305844])
+
+        self.assertEqual(result['305841'], (True, True, False))
+        # manually-created sections aren't sis sections
+        self.assertEqual(result['305842'], (False, False, False))
+        self.assertEqual(result['305843'], (False, True, False))
+        # no such course instance
+        self.assertEqual(result['305844'], (False, False, False))
+        self.assertEqual(result['ext:305841_role_1'], (False, False, True))
+        self.assertEqual(result['dog'], (False, False, False))
+        self.assertEqual(result[None], (False, False, False))
+
+    def test_no_query_without_numeric_ids(self, mock_filter):
+        classify_sections(['ext:305841_role_1', 'dog', None])
+        self.assertFalse(mock_filter.called)
+
+    def test_non_ascii_digits_not_treated_as_ids(self, mock_filter):
+        # '²'.isdigit() is True, but int('²') raises ValueError
+        mock_filter.return_value = self.course_instances
+        result = classify_sections(['305841', '\u00b2', '30584\u00b2'])
+        mock_filter.assert_called_once_with(course_instance_id__in=[305841])
+        self.assertEqual(result['305841'], (True, True, False))
+        self.assertEqual(result['\u00b2'], (False, False, False))
+        self.assertEqual(result['30584\u00b2'], (False, False, False))
+
+    def test_is_editable_section(self, mock_filter):
+        mock_filter.return_value = self.course_instances
+        self.assertFalse(is_editable_section('305841'))
+        self.assertTrue(is_editable_section('305842'))
+        self.assertFalse(is_editable_section({'sis_section_id': 'ext:1_role_1'}))
+        self.assertTrue(is_editable_section({'sis_section_id': 'dog'}))
+        self.assertFalse(is_editable_section({'sis_section_id': None}))
+
+
+@patch('manage_sections.utils.CourseInstance.objects.filter')
+@patch('manage_sections.utils.CourseInstance.objects.get')
+class CourseInstanceIdentityMapTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.identity_map = CourseInstanceIdentityMap()
+
+    def test_row_loaded_once(self, mock_get, mock_filter):
+        mock_get.return_value = CourseInstanceStub(course_instance_id=305841)
+        first = self.identity_map.get('305841')
+        second = self.identity_map.get(305841)
+        self.assertIs(first, second)
+        mock_get.assert_called_once_with(course_instance_id=305841)
+        self.assertEqual(self.identity_map.duplicates_avoided, 1)
+
+    def test_missing_row_remembered(self, mock_get, mock_filter):
+        mock_get.side_effect = CourseInstance.DoesNotExist
+        for _ in range(2):
+            with self.assertRaises(CourseInstance.DoesNotExist):
+                self.identity_map.get(305841)
+        self.assertEqual(mock_get.call_count, 1)
+
+    def test_get_many_only_loads_new_rows(self, mock_get, mock_filter):
+        mock_filter.return_value = [
+            CourseInstanceStub(course_instance_id=305841)]
+        self.assertEqual(list(self.identity_map.get_many([305841, 305842])),
+                         [305841])
+        mock_filter.return_value = [
+            CourseInstanceStub(course_instance_id=305843)]
+        result = self.identity_map.get_many([305841, 305842, 305843])
+        self.assertEqual(sorted(result), [305841, 305843])
+        mock_filter.assert_called_with(course_instance_id__in=[305843])
+        self.assertEqual(self.identity_map.duplicates_avoided, 2)
+        # and single lookups are served from the map too
+        self.identity_map.get(305841)
+        self.assertFalse(mock_get.called)
+
+
+@patch.multiple('manage_sections.utils',
+                canvas_api_helper_courses=DEFAULT,
+                canvas_api_helper_enrollments=DEFAULT,
+                canvas_api_helper_sections=DEFAULT)
+@patch('manage_sections.utils.time.sleep')
+@patch('manage_sections.utils.canvas_api_enrollments.conclude_enrollment')
+class DeleteEnrollmentsTest(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.course_id = 1234
+        self.enrollments = [{'id': i, 'course_section_id': 5678}
+                            for i in range(1, 21)]
+
+    def test_all_deleted(self, mock_conclude, mock_sleep, **kwargs):
+        mock_conclude.side_effect = lambda ctx, course_id, id, task: id
+        deleted, is_empty = delete_enrollments(self.enrollments, self.course_id)
+        self.assertEqual(deleted, list(range(1, 21)))
+        self.assertTrue(is_empty)
+        # caches flushed once for the whole batch
+        kwargs['canvas_api_helper_sections'].delete_section_cache\
+            .assert_called_once_with(5678)
+        kwargs['canvas_api_helper_enrollments'].delete_cache\
+            .assert_called_once_with(self.course_id)
+
+    def test_empty_list(self, mock_conclude, mock_sleep, **kwargs):
+        self.assertEqual(delete_enrollments([], self.course_id), ([], True))
+        self.assertFalse(mock_conclude.called)
+
+    def test_failure_leaves_section_not_empty(self, mock_conclude, mock_sleep,
+                                              **kwargs):
+        def conclude(ctx, course_id, id, task):
+            if id == 3:
+                raise CanvasAPIError(status_code=500)
+            return id
+        mock_conclude.side_effect = conclude
+        deleted, is_empty = delete_enrollments(self.enrollments, self.course_id)
+        self.assertFalse(is_empty)
+        self.assertNotIn(3, deleted)
+        self.assertFalse(mock_sleep.called)
+
+    def test_missing_id_stops_deletion(self, mock_conclude, mock_sleep,
+                                       **kwargs):
+        mock_conclude.side_effect = lambda ctx, course_id, id, task: id
+        self.enrollments[2] = {'course_section_id': 5678}
+        deleted, is_empty = delete_enrollments(self.enrollments, self.course_id)
+        self.assertEqual(deleted, [1, 2])
+        self.assertFalse(is_empty)
+
+    def test_rate_limited_deletes_retried(self, mock_conclude, mock_sleep,
+                                          **kwargs):
+        attempts = {}
+
+        def conclude(ctx, course_id, id, task):
+            attempts[id] = attempts.get(id, 0) + 1
+            if id == 5 and attempts[id] < 3:
+                raise CanvasAPIError(status_code=429)
+            return id
+        mock_conclude.side_effect = conclude
+        deleted, is_empty = delete_enrollments(self.enrollments, self.course_id)
+        self.assertTrue(is_empty)
+        self.assertEqual(len(deleted), 20)
+        # backoff doubles between retries
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [1, 2])
+
+
+
+@patch('manage_sections.utils.canvas_api_helper_enrollments.get_enrollments')
+class CachedCourseEnrollmentsTest(TestCase):
+    longMessage = True
+    canvas_course_id = 1234
+
+    def setUp(self):
+        self.user = {'id': 42, 'name': 'Ann Adams', 'sortable_name': 'Adams, Ann'}
+        self.enrollments = [
+            {'id': 1, 'course_section_id': 10, 'user_id': 42, 'user': self.user},
+            {'id': 2, 'course_section_id': 11, 'user_id': 43,
+             'user': {'id': 43, 'name': 'Bo Baker'}},
+        ]
+        patcher = patch('manage_sections.utils.cache', LocMemCache('enrollments', {}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_enrollments_fetched_once(self, mock_get_enrollments):
+        mock_get_enrollments.return_value = self.enrollments
+        get_course_enrollments(self.canvas_course_id)
+        self.assertEqual(get_course_enrollments(self.canvas_course_id), self.enrollments)
+        mock_get_enrollments.assert_called_once_with(self.canvas_course_id)
+
+    def test_cached_enrollments_patched_in_place(self, mock_get_enrollments):
+        mock_get_enrollments.return_value = self.enrollments
+        get_course_enrollments(self.canvas_course_id)
+        update_cached_course_enrollments(
+            self.canvas_course_id,
+            added=[{'id': 3, 'course_section_id': 12, 'user_id': 42}],
+            removed_ids=['2'])
+        enrollments = get_course_enrollments(self.canvas_course_id)
+        self.assertEqual([e['id'] for e in enrollments], [1, 3])
+        # the added enrollment gets the user from the user's other enrollment
+        self.assertEqual(enrollments[1]['user'], self.user)
+        mock_get_enrollments.assert_called_once_with(self.canvas_course_id)
+
+    def test_unknown_user_drops_cache(self, mock_get_enrollments):
+        mock_get_enrollments.return_value = self.enrollments
+        get_course_enrollments(self.canvas_course_id)
+        update_cached_course_enrollments(
+            self.canvas_course_id, added=[{'id': 3, 'user_id': 99}])
+        get_course_enrollments(self.canvas_course_id)
+        self.assertEqual(mock_get_enrollments.call_count, 2)
+
+
+
+@patch('manage_sections.utils.canvas_api_courses.get_single_course_courses')
+class CachedCourseTest(TestCase):
+    longMessage = True
+    canvas_course_id = 1234
+
+    def setUp(self):
+        patcher = patch('manage_sections.utils.cache', LocMemCache('courses', {}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_include_variants_cached_side_by_side(self, mock_get_course):
+        mock_get_course.return_value.json.side_effect = [
+            {'id': 1234}, {'id': 1234, 'total_students': 3}]
+        self.assertEqual(get_course(self.canvas_course_id), {'id': 1234})
+        self.assertEqual(get_course(self.canvas_course_id, include=['total_students']),
+                         {'id': 1234, 'total_students': 3})
+        # both variants are now served from the cache
+        get_course(self.canvas_course_id)
+        get_course(self.canvas_course_id, include=['total_students'])
+        self.assertEqual(mock_get_course.call_count, 2)
+
+    def test_invalidate_course_drops_every_variant(self, mock_get_course):
+        mock_get_course.return_value.json.return_value = {'id': 1234, 'total_students': 3}
+        get_course(self.canvas_course_id)
+        get_course(self.canvas_course_id, include=['total_students'])
+        invalidate_course(self.canvas_course_id)
+        get_course(self.canvas_course_id)
+        get_course(self.canvas_course_id, include=['total_students'])
+        self.assertEqual(mock_get_course.call_count, 4)
+
+    def test_generation_expires_with_course_cache(self, mock_get_course):
+        with patch('manage_sections.utils.cache.set') as mock_set:
+            invalidate_course(self.canvas_course_id)
+        mock_set.assert_called_once_with(
+            CACHE_KEY_COURSE_GENERATION.format(self.canvas_course_id), ANY,
+            settings.MANAGE_SECTIONS.get('COURSE_CACHE_TIMEOUT_SECS', 300))
+
+    def test_canvas_error_returns_none(self, mock_get_course):
+        mock_get_course.side_effect = CanvasAPIError(status_code=404)
+        self.assertIsNone(get_course(self.canvas_course_id))
+
+
 class ContextUtilsTest(TestCase):
     longMessage = True
 
@@ -1,5 +1,12 @@
 from unittest import TestCase
-from manage_sections.utils import unique_enrollments_not_in_section_filter
+from manage_sections.utils import role_key, unique_enrollments_not_in_section_filter
+
+
+def legacy_unique_enrollments_not_in_section_filter(section_id, enrollments):
+    """ unique_enrollments_not_in_section_filter as it was, in three passes """
+    section_set = {role_key(x) for x in enrollments if x['course_section_id'] == int(section_id)}
+    non_manual_enrollments = [enr for enr in enrollments if enr.get('source') != 'managecrs']
+    return list({role_key(x): x for x in non_manual_enrollments if role_key(x) not in section_set}.values())
 
 
 class UniqueEnrollmentsNotInSectionFilterUtilsTest(TestCase):
@@ -105,3 +112,18 @@ class UniqueEnrollmentsNotInSectionFilterUtilsTest(TestCase):
         res = unique_enrollments_not_in_section_filter(current_section_id, enrollments)
         # Order doesn't matter here, so use itemsEqual instead of listEqual
         self.assertEqual(res, [enrollments[1]], "Should allow for user to be present with different role")
+
+    def test_matches_legacy_filter_for_cross_listed_course(self):
+        """
+        Test that the result, including its order, is the same as the three-pass
+        filter it replaced, for a course whose users hold several roles across
+        sections, some of them manual
+        """
+        section_id = '17'
+        enrollments = [
+            dict(self.enroll(i // 3, role_id=i % 2, section_id=10 + i % 10),
+                 source='managecrs' if i % 5 == 0 else 'fasfeed')
+            for i in range(10000)
+        ]
+        res = unique_enrollments_not_in_section_filter(section_id, enrollments)
+        self.assertEqual(res, legacy_unique_enrollments_not_in_section_filter(section_id, enrollments))
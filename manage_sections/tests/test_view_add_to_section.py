@@ -4,7 +4,7 @@ import copy
 
 from django_auth_lti import const
 from manage_sections.views import add_to_section
-from mock import patch, ANY, DEFAULT, Mock
+from mock import patch, ANY, DEFAULT, MagicMock, Mock
 
 from canvas_sdk.exceptions import CanvasAPIError
 
@@ -38,6 +38,15 @@ class RequestStub:
         self.LTI['roles'] = roles
 
 @patch.multiple('lti_school_permissions.decorators', is_allowed=Mock(return_value=True))
+@patch.multiple('manage_sections.views',
+                canvas_api_helper_courses=DEFAULT,
+                canvas_api_helper_enrollments=DEFAULT,
+                canvas_api_helper_sections=DEFAULT)
+@patch('manage_sections.views.transaction.atomic', MagicMock())
+@patch('manage_sections.views.get_course_enrollments', Mock(return_value=[]))
+@patch('manage_sections.views._get_course_member_table')
+@patch('manage_sections.views.canvas_api_users.get_user_profile')
+@patch('manage_sections.views.user_role_index')
 class SectionAddToSectionViewTest(unittest.TestCase):
     """
     Test cases for add to section
@@ -47,6 +56,7 @@ class SectionAddToSectionViewTest(unittest.TestCase):
     def setUp(self):
         self.add_to_section_stub_body = {
             "section_id": 1694,
+            "sis_section_id": "305841",
             "users_to_add": [
                 {
                     "enrollment_user_id": "79610",
@@ -72,19 +82,20 @@ class SectionAddToSectionViewTest(unittest.TestCase):
     @patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections')
     @patch('manage_sections.views.logger.error')
     def test_add_to_section_success_on_enroll_user_sections_returning_200(self, logger_replacement,
-                                                                          add_to_section_replacement):
+                                                                          add_to_section_replacement, *args, **kwargs):
         """ Assert that when SDK method returns success, then remove_section returns correct status code """
         request = self.add_to_section_stub()
+        add_to_section_replacement.return_value.json.return_value = {'id': 1, 'user_id': 104779}
         response = add_to_section(request)
-        add_to_section_replacement.return_value.status_code = 200
         self.assertEqual(response.status_code, 200)
 
     @patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections')
-    def test_add_to_section_makes_sdk_call_with_correct_params(self, add_to_section_replacement):
+    def test_add_to_section_makes_sdk_call_with_correct_params(self, add_to_section_replacement, *args, **kwargs):
         """
         Assert that the enrollments.enroll_user_sections SDK method is being called with the expected parameters
         """
         request = self.add_to_section_stub()
+        add_to_section_replacement.return_value.json.return_value = {'id': 1}
         add_to_section(request)
         user_to_add = self.add_to_section_stub_body['users_to_add'][0]
         add_to_section_replacement.assert_any_call(
@@ -98,7 +109,7 @@ class SectionAddToSectionViewTest(unittest.TestCase):
 
     @patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections')
     @patch('manage_sections.views.logger.error')
-    def test_add_to_section_raises_exception_on_missing_section_id(self, log_replacement, add_to_section_replacement):
+    def test_add_to_section_raises_exception_on_missing_section_id(self, log_replacement, add_to_section_replacement, *args, **kwargs):
         """ Assert that add_to_section returns a 500 response on missing section id   """
         request = self.add_to_section_stub()
         request_body = copy.deepcopy(self.add_to_section_stub_body)
@@ -111,12 +122,13 @@ class SectionAddToSectionViewTest(unittest.TestCase):
     @patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections')
     @patch('manage_sections.views.logger.error')
     def test_add_to_section_raises_exception_on_missing_enrollment_id(self, log_replacement,
-                                                                      add_to_section_replacement):
+                                                                      add_to_section_replacement, *args, **kwargs):
         """ Assert that add_to_section returns a 500 response when the enrollment_user_id is missing """
         request = self.add_to_section_stub()
         request_body = copy.deepcopy(self.add_to_section_stub_body)
         del request_body['users_to_add'][0]['enrollment_user_id']
         request.body = json.dumps(request_body)
+        add_to_section_replacement.return_value.json.return_value = {'id': 1}
         response = add_to_section(request)
         assert log_replacement.called
         self.assertEqual(len(json.loads(response.content)['failed']), 1)
@@ -124,7 +136,7 @@ class SectionAddToSectionViewTest(unittest.TestCase):
     @patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections')
     @patch('manage_sections.views.logger.error')
     def test_add_to_section_logs_exception_on_failure_status_code(
-            self, log_replacement, add_to_section_replacement):
+            self, log_replacement, add_to_section_replacement, *args, **kwargs):
         """ Assert that logger is logging an exception when return from backend
         is status code 4XX """
         request = self.add_to_section_stub()
@@ -132,3 +144,69 @@ class SectionAddToSectionViewTest(unittest.TestCase):
         response = add_to_section(request)
         assert log_replacement.called
         self.assertEqual(len(json.loads(response.content)['failed']), 2)
+
+    def test_distinct_roles_resolved_once(self, mock_user_role_index, *args, **kwargs):
+        """ Each distinct role in the request is looked up once, however many users have it """
+        with patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections') as mock_enroll:
+            mock_enroll.return_value.json.return_value = {'id': 1}
+            add_to_section(self.add_to_section_stub())
+        mock_user_role_index.get_by_canvas_role_id.assert_called_once_with('2')
+
+    def test_huids_from_course_enrollments_skip_profile_lookup(self, mock_user_role_index, mock_get_user_profile,
+                                                               mock_get_table, *args, **kwargs):
+        """
+        The HUIDs come from the course's enrollments, and Canvas is only asked for
+        the ones that aren't there; a posted sis_user_id is never trusted
+        """
+        self.add_to_section_stub_body['users_to_add'][0]['sis_user_id'] = '99999999'
+        course_enrollments = [{'id': 7, 'user_id': 79610, 'user': {'id': 79610, 'sis_user_id': '12345678'}}]
+        mock_get_user_profile.return_value.json.return_value = {'sis_user_id': '87654321'}
+        with patch('manage_sections.views.get_course_enrollments', return_value=course_enrollments), \
+                patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections') as mock_enroll:
+            mock_enroll.return_value.json.return_value = {'id': 1}
+            add_to_section(self.add_to_section_stub())
+        mock_get_user_profile.assert_called_once_with(ANY, '104779')
+        table = mock_get_table.return_value
+        self.assertEqual(
+            [c[1]['user_id'] for c in table.call_args_list], ['12345678', '87654321'])
+
+    def test_user_without_canvas_id_rejected(self, mock_user_role_index, mock_get_user_profile,
+                                             mock_get_table, *args, **kwargs):
+        """
+        A user without an enrollment_user_id is reported as failed, without a
+        profile lookup, a DB row or a Canvas enrollment
+        """
+        del self.add_to_section_stub_body['users_to_add'][0]['enrollment_user_id']
+        mock_get_user_profile.return_value.json.return_value = {'sis_user_id': '87654321'}
+        with patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections') as mock_enroll:
+            mock_enroll.return_value.json.return_value = {'id': 1}
+            response = add_to_section(self.add_to_section_stub())
+        mock_get_user_profile.assert_called_once_with(ANY, '104779')
+        self.assertEqual(mock_enroll.call_count, 1)
+        table = mock_get_table.return_value
+        self.assertEqual([c[1]['user_id'] for c in table.call_args_list], ['87654321'])
+        content = json.loads(response.content)
+        self.assertEqual(content['added'], 1)
+        self.assertEqual(len(content['failed']), 1)
+
+    def test_db_rows_bulk_created_per_table(self, mock_user_role_index, mock_get_user_profile,
+                                            mock_get_table, *args, **kwargs):
+        """ The DB rows are written with one bulk_create per table """
+        with patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections') as mock_enroll:
+            mock_enroll.return_value.json.return_value = {'id': 1}
+            response = add_to_section(self.add_to_section_stub())
+        table = mock_get_table.return_value
+        table.objects.bulk_create.assert_called_once_with([table.return_value] * 2)
+        self.assertEqual(response.status_code, 200)
+
+    @patch('manage_sections.views.update_cached_course_enrollments')
+    @patch('manage_sections.views.canvas_api_enrollments.enroll_user_sections')
+    def test_added_enrollments_returned_and_cached(self, mock_enroll, mock_update_cache, *args, **kwargs):
+        """ The new Canvas enrollments are returned and patched into the cached course enrollments """
+        new_enrollment = {'id': 1, 'user_id': 104779, 'course_section_id': 1694}
+        mock_enroll.return_value.json.side_effect = [new_enrollment, CanvasAPIError()]
+        response = add_to_section(self.add_to_section_stub())
+        content = json.loads(response.content)
+        self.assertEqual(content['added'], 1)
+        self.assertEqual(content['enrollments'], [new_enrollment])
+        mock_update_cache.assert_called_once_with('12345', added=[new_enrollment])
@@ -80,7 +80,7 @@ class GetBadgeInfoForUsersTests(unittest.TestCase):
         self.assertDictEqual(result_for_empty_list, {})
 
     @patch('manage_sections.views.logger.warn')
-    @patch('manage_sections.views.Person.objects.filter')
+    @patch('manage_sections.views.get_role_types_for_univ_ids')
     def test_non_matching_input(self, mock_person, mock_logger_warn):
         """
         If input list contains info that doesn't match the Person lookup,
@@ -88,29 +88,29 @@ class GetBadgeInfoForUsersTests(unittest.TestCase):
         a default badge label for any user_ids that do not have a valid
         role_type_cd, and log a warning.
         """
-        mock_person.return_value.values_list.return_value = self.person_object_values
+        mock_person.return_value = dict(self.person_object_values)
         result = _get_badge_info_for_users(self.bad_input)
         self.assertDictEqual(result, self.expected_results_for_bad_input)
         self.assertTrue(mock_logger_warn.called)
 
     @patch('manage_sections.views.logger.warn')
-    @patch('manage_sections.views.Person.objects.filter')
+    @patch('manage_sections.views.get_role_types_for_univ_ids')
     def test_matching_input(self, mock_person, mock_logger_warn):
         """
         If input contains one-to-one matches for Person lookup, the function
         should return a comprehensive mapping of input IDs to badge labels.
         """
-        mock_person.return_value.values_list.return_value = self.person_object_values
+        mock_person.return_value = dict(self.person_object_values)
         result = _get_badge_info_for_users(self.user_id_input_list)
         self.assertDictEqual(result, self.expected_results)
         self.assertFalse(mock_logger_warn.called)
 
-    @patch('manage_sections.views.Person.objects.filter')
+    @patch('manage_sections.views.get_role_types_for_univ_ids')
     def test_db_error_raises_exception(self, mock_person):
         """
         If Person lookup fails due to database issue,
         the function will raise the exception up the stack.
         """
-        mock_person.return_value.values_list.side_effect = Exception
+        mock_person.side_effect = Exception
         with self.assertRaises(Exception):
             _get_badge_info_for_users(self.user_id_input_list)
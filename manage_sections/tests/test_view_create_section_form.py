@@ -4,10 +4,21 @@ from django.test import RequestFactory
 from django_auth_lti import const
 from mock import patch, DEFAULT, Mock
 
+from manage_sections.utils import SectionClassification
 from manage_sections.views import create_section_form
 
 
-@patch.multiple('manage_sections.views', render=DEFAULT)
+def classify_all_as(is_enrollment_section=False, is_sis_section=False):
+    """ Stand-in for classify_sections that gives every section the same type """
+    def classify_sections(sis_section_ids):
+        return {sis_section_id: SectionClassification(
+                    is_enrollment_section, is_sis_section, False)
+                for sis_section_id in sis_section_ids}
+    return classify_sections
+
+
+@patch.multiple('manage_sections.views', render=DEFAULT,
+                get_course=Mock(return_value={'total_students': 3}))
 @patch.multiple('lti_school_permissions.decorators', is_allowed=Mock(return_value=True))
 class CreateSectionFormTest(unittest.TestCase):
     """
@@ -52,16 +63,14 @@ class CreateSectionFormTest(unittest.TestCase):
             'enrollments': []
         }]
 
-    @patch('manage_sections.views.is_sis_section')
-    @patch('manage_sections.views.is_enrollment_section')
+    @patch('manage_sections.views.classify_sections')
     @patch('manage_sections.views.canvas_api_helper_sections.get_sections')
-    def test_section_form_view_template_on_success(self, get_section_replacement, is_enrollment_section_mock, is_sis_mock,
+    def test_section_form_view_template_on_success(self, get_section_replacement, classify_sections_mock,
                                                    render):
         """ Create Section Form View should render form page upon success"""
         request = self.request
         get_section_replacement.return_value = self.sections
-        is_enrollment_section_mock.return_value = False
-        is_sis_mock.return_value = False
+        classify_sections_mock.side_effect = classify_all_as()
         response = create_section_form(request)
         section_list = sorted(self.sections, key=lambda x: x['name'].lower())
         render.assert_called_with(request, 'manage_sections/create_section_form.html', {
@@ -92,32 +101,28 @@ class CreateSectionFormTest(unittest.TestCase):
             'sisenrollmentsections': self.sections_current_prefix_match
         })
 
-    @patch('manage_sections.views.is_sis_section')
-    @patch('manage_sections.views.is_enrollment_section')
+    @patch('manage_sections.views.classify_sections')
     @patch('manage_sections.views.canvas_api_helper_sections.get_sections')
-    def test_section_form_view_template_on_success_when_primary_match(self, get_section_replacement, is_enrollment_section_mock,
-                                                                      is_sis_mock, render):
+    def test_section_form_view_template_on_success_when_primary_match(self, get_section_replacement, classify_sections_mock,
+                                                                      render):
         """ Create Section Form View should return success when numeric"""
         request = self.request
         get_section_replacement.return_value = self.sections
-        is_enrollment_section_mock.return_value = True
-        is_sis_mock.return_value = False
+        classify_sections_mock.side_effect = classify_all_as(is_enrollment_section=True)
         response = create_section_form(request)
         render.assert_called_with(request, 'manage_sections/create_section_form.html', {
             'sections': [],
             'sisenrollmentsections': self.sections
         })
 
-    @patch('manage_sections.views.is_sis_section')
-    @patch('manage_sections.views.is_enrollment_section')
+    @patch('manage_sections.views.classify_sections')
     @patch('manage_sections.views.canvas_api_helper_sections.get_sections')
-    def test_section_form_view_template_on_success_when_registrar_match(self, get_section_replacement, is_enrollment_section_mock,
-                                                                        is_sis_mock, render):
+    def test_section_form_view_template_on_success_when_registrar_match(self, get_section_replacement, classify_sections_mock,
+                                                                        render):
         """ Create Section Form View should return success when numeric"""
         request = self.request
         get_section_replacement.return_value = self.sections
-        is_enrollment_section_mock.return_value = False
-        is_sis_mock.return_value = True
+        classify_sections_mock.side_effect = classify_all_as(is_sis_section=True)
         response = create_section_form(request)
         section_list = sorted(self.sections, key=lambda x: x['name'].lower())
         self.assertIn('registrar_section_flag', get_section_replacement.return_value[0])
@@ -127,16 +132,14 @@ class CreateSectionFormTest(unittest.TestCase):
             'sisenrollmentsections': []
         })
 
-    @patch('manage_sections.views.is_sis_section')
-    @patch('manage_sections.views.is_enrollment_section')
+    @patch('manage_sections.views.classify_sections')
     @patch('manage_sections.views.canvas_api_helper_sections.get_sections')
-    def test_section_form_view_template_on_success_when_non_sis_match(self, get_section_replacement, is_enrollment_section_mock,
-                                                                      is_sis_mock, render):
+    def test_section_form_view_template_on_success_when_non_sis_match(self, get_section_replacement, classify_sections_mock,
+                                                                      render):
         """ Create Section Form View should return success when no sis"""
         request = self.request
         get_section_replacement.return_value = self.sections
-        is_enrollment_section_mock.return_value = False
-        is_sis_mock.return_value = False
+        classify_sections_mock.side_effect = classify_all_as()
         response = create_section_form(request)
         section_list = sorted(self.sections, key=lambda x: x['name'].lower())
         render.assert_called_with(request, 'manage_sections/create_section_form.html', {
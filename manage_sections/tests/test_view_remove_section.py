@@ -1,10 +1,16 @@
+import json
+import os
 import unittest
 
+from canvas_sdk.exceptions import CanvasAPIError
+from django.conf import settings
 from django.test import RequestFactory
 from django_auth_lti import const
-from mock import patch, Mock, DEFAULT
+from mock import patch, ANY, Mock, DEFAULT
+from rq import Retry
 
-from manage_sections.views import remove_section
+from manage_sections.jobs import RemoveSectionError
+from manage_sections.views import remove_section, remove_section_status
 
 
 # Basic stub for the user object that is sent as part of a Django request
@@ -127,3 +133,129 @@ class RemoveSectionsTest(unittest.TestCase):
         get_section_replacement.return_value = None
         response = remove_section(request, request.section_id)
         self.assertEqual(response.status_code, 500)
+
+
+@patch.multiple('lti_school_permissions.decorators', is_allowed=Mock(return_value=True))
+@patch('manage_sections.views.is_editable_section', Mock(return_value=True))
+@patch('manage_sections.views.canvas_api_enrollments.list_enrollments_sections')
+@patch('manage_sections.views.canvas_api_helper_sections.get_section')
+@patch('manage_sections.views.jobs.remove_section')
+@patch('manage_sections.views.django_rq.get_queue')
+class RemoveSectionJobModeTest(unittest.TestCase):
+    longMessage = True
+
+    def get_request(self):
+        req = RequestStub()
+        req.method = 'POST'
+        req.LTI['custom_canvas_course_id'] = '111'
+        return req
+
+    @staticmethod
+    def section_enrollments_page(count, more_pages=False):
+        response = Mock(links={'next': {'url': 'next'}} if more_pages else {})
+        response.json.return_value = [{'id': i, 'course_section_id': 371} for i in range(count)]
+        return response
+
+    def test_small_section_is_removed_inline(self, mock_get_queue,
+                                             mock_remove_section,
+                                             mock_get_section,
+                                             mock_list_enrollments_sections):
+        mock_get_section.return_value = {'id': 371}
+        mock_list_enrollments_sections.return_value = self.section_enrollments_page(3)
+        mock_remove_section.return_value = {'id': 371}
+        response = remove_section(self.get_request(), '123', 371)
+        self.assertEqual(response.status_code, 200)
+        # one page of the section's enrollments, not the course's
+        mock_list_enrollments_sections.assert_called_once_with(ANY, 371, per_page=51)
+        mock_remove_section.assert_called_once_with('111', '123', 371)
+        mock_get_queue.assert_not_called()
+
+    @patch('manage_sections.views.reverse', Mock(return_value='/status'))
+    def test_large_section_is_queued_with_retries(self, mock_get_queue,
+                                                  mock_remove_section,
+                                                  mock_get_section,
+                                                  mock_list_enrollments_sections):
+        mock_get_section.return_value = {'id': 371}
+        mock_list_enrollments_sections.return_value = self.section_enrollments_page(51)
+        mock_get_queue.return_value.enqueue.return_value = Mock(id='job-1')
+        response = remove_section(self.get_request(), '123', 371)
+        self.assertEqual(response.status_code, 202)
+        mock_remove_section.assert_not_called()
+        args, kwargs = mock_get_queue.return_value.enqueue.call_args
+        self.assertEqual(args, ('manage_sections.jobs.remove_section',
+                                '111', '123', 371))
+        self.assertEqual(kwargs['meta']['canvas_course_id'], '111')
+        self.assertIsInstance(kwargs['retry'], Retry)
+        self.assertGreater(kwargs['retry'].max, 0)
+        # delayed retries wait in the scheduled job registry until a worker
+        # running rq's scheduler requeues them, so they need one
+        with open(os.path.join(settings.BASE_DIR, 'Procfile')) as procfile:
+            worker = [line for line in procfile if line.startswith('worker:')][0]
+        if any(kwargs['retry'].intervals):
+            self.assertIn('--with-scheduler', worker)
+
+    @patch('manage_sections.views.reverse', Mock(return_value='/status'))
+    def test_section_is_queued_when_enrollments_unavailable(self, mock_get_queue,
+                                                            mock_remove_section,
+                                                            mock_get_section,
+                                                            mock_list_enrollments_sections):
+        mock_get_section.return_value = {'id': 371}
+        mock_list_enrollments_sections.side_effect = CanvasAPIError()
+        mock_get_queue.return_value.enqueue.return_value = Mock(id='job-1')
+        response = remove_section(self.get_request(), '123', 371)
+        self.assertEqual(response.status_code, 202)
+        mock_remove_section.assert_not_called()
+
+    @patch('manage_sections.views.reverse', Mock(return_value='/status'))
+    def test_section_with_more_pages_is_queued(self, mock_get_queue,
+                                               mock_remove_section,
+                                               mock_get_section,
+                                               mock_list_enrollments_sections):
+        mock_get_section.return_value = {'id': 371}
+        mock_list_enrollments_sections.return_value = self.section_enrollments_page(3, more_pages=True)
+        mock_get_queue.return_value.enqueue.return_value = Mock(id='job-1')
+        response = remove_section(self.get_request(), '123', 371)
+        self.assertEqual(response.status_code, 202)
+
+    def test_failed_inline_removal_returns_error(self, mock_get_queue,
+                                                 mock_remove_section,
+                                                 mock_get_section,
+                                                 mock_list_enrollments_sections):
+        mock_get_section.return_value = {'id': 371}
+        mock_list_enrollments_sections.return_value = self.section_enrollments_page(3)
+        mock_remove_section.side_effect = RemoveSectionError('failed')
+        response = remove_section(self.get_request(), '123', 371)
+        self.assertEqual(response.status_code, 500)
+
+
+@patch.multiple('lti_school_permissions.decorators', is_allowed=Mock(return_value=True))
+@patch('manage_sections.views.django_rq.get_queue')
+class RemoveSectionStatusTest(unittest.TestCase):
+    longMessage = True
+
+    def get_request(self):
+        req = RequestStub()
+        req.LTI['custom_canvas_course_id'] = '111'
+        return req
+
+    def get_job(self, status):
+        job = Mock(id='job-1', meta={'canvas_course_id': '111', 'section_id': 371,
+                                     'stage': 'delete_canvas_enrollments'})
+        job.get_status.return_value = status
+        return job
+
+    def test_failed_job_reported_without_requeue(self, mock_get_queue):
+        job = self.get_job('failed')
+        mock_get_queue.return_value.fetch_job.return_value = job
+        response = remove_section_status(self.get_request(), 'job-1')
+        self.assertEqual(response.status_code, 200)
+        # the status view is read-only; retrying is up to rq
+        job.requeue.assert_not_called()
+        self.assertEqual(json.loads(response.content)['status'], 'failed')
+
+    def test_other_courses_job_not_found(self, mock_get_queue):
+        job = self.get_job('started')
+        job.meta['canvas_course_id'] = '222'
+        mock_get_queue.return_value.fetch_job.return_value = job
+        response = remove_section_status(self.get_request(), 'job-1')
+        self.assertEqual(response.status_code, 404)
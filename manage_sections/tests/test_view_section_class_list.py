@@ -4,17 +4,17 @@ from django.test import RequestFactory
 from django_auth_lti import const
 from mock import patch, ANY, DEFAULT, Mock, MagicMock
 
-from manage_sections.views import section_class_list
+from manage_sections.views import section_class_list_data
 from .test_utils import return_unmodified_input
 
 
-@patch.multiple('manage_sections.views.canvas_api_helper_enrollments', get_enrollments=DEFAULT)
+@patch.multiple('manage_sections.views', get_course_enrollments=DEFAULT)
 @patch.multiple('manage_sections.views.canvas_api_helper_sections', get_section=DEFAULT)
 @patch.multiple('lti_school_permissions.decorators', is_allowed=Mock(return_value=True))
 @patch.multiple('manage_sections.views.canvas_api_helper_enrollments', add_role_labels_to_enrollments=DEFAULT)
 @patch.multiple(
     'manage_sections.views',
-    render=DEFAULT,
+    _letter_range_buckets_response=DEFAULT,
     SDK_CONTEXT=DEFAULT,
     is_editable_section=DEFAULT,
 )
@@ -36,31 +36,34 @@ class SectionClassListViewTest(TestCase):
         }
 
     @patch('manage_sections.views.unique_enrollments_not_in_section_filter')
-    def test_view_rendered_on_success(self, mock_filter, add_role_labels_to_enrollments, render, **kwargs):
+    def test_view_responds_on_success(self, mock_filter, add_role_labels_to_enrollments,
+                                      _letter_range_buckets_response, **kwargs):
         """
-        Test that view renders expected template on success
+        Test that view returns the letter range buckets response on success
         """
         add_role_labels_to_enrollments.side_effect = return_unmodified_input
-        section_class_list(self.request, self.section_id)
-        render.assert_called_with(self.request, 'manage_sections/_section_classlist.html', ANY)
+        response = section_class_list_data(self.request, self.section_id)
+        _letter_range_buckets_response.assert_called_once_with(self.request, ANY, allow_edit=ANY)
+        self.assertIs(response, _letter_range_buckets_response.return_value)
 
     @patch('manage_sections.views._add_badge_label_name_to_enrollments')
     def test_enrollments_sorted_on_success(self, mock_filter, add_role_labels_to_enrollments, **kwargs):
         """
-        Test that enrollments list is sorted before being passed to render
+        Test that enrollments list is sorted before being bucketed
         """
         add_role_labels_to_enrollments.side_effect = return_unmodified_input
         enrollments_list_mock = MagicMock(name='enrollments', spec=list)
         mock_filter.return_value = enrollments_list_mock
-        section_class_list(self.request, self.section_id)
+        section_class_list_data(self.request, self.section_id)
         # sorting uses a lambda function as key, so just check that it was called
         enrollments_list_mock.sort.assert_called_once_with(key=ANY)
 
     @patch('manage_sections.views._add_badge_label_name_to_enrollments')
     @patch('manage_sections.views.unique_enrollments_not_in_section_filter')
-    def test_enrollments_rendered_on_success(self, mock_filter, badge_filter, add_role_labels_to_enrollments, render, **kwargs):
+    def test_enrollments_bucketed_on_success(self, mock_filter, badge_filter, add_role_labels_to_enrollments,
+                                             _letter_range_buckets_response, **kwargs):
         """
-        Test that sorted enrollments list is passed on to the rendered template
+        Test that sorted enrollments list is passed on to be bucketed
         """
         add_role_labels_to_enrollments.side_effect = return_unmodified_input
         mock_enrollment_1 = {'user': {'sortable_name': 'e'}}
@@ -72,9 +75,6 @@ class SectionClassListViewTest(TestCase):
         sorted_enrollments = [
             mock_enrollment_1, mock_enrollment_2, mock_enrollment_3
         ]
-        section_class_list(self.request, self.section_id)
-        render.assert_called_with(
-            self.request,
-            'manage_sections/_section_classlist.html',
-            {'enrollments': sorted_enrollments, 'allow_edit': ANY, 'section_id': ANY}
-        )
+        section_class_list_data(self.request, self.section_id)
+        _letter_range_buckets_response.assert_called_with(
+            self.request, sorted_enrollments, allow_edit=ANY)
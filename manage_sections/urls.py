@@ -8,9 +8,10 @@ urlpatterns = [
     path('edit_section/<str:sis_section_id>/<int:section_id>', views.edit_section, name='edit_section'),
     path('section_details/<str:sis_section_id>/<int:section_id>', views.section_details, name='section_details'),
     path('remove_section/<str:sis_section_id>/<int:section_id>', views.remove_section, name='remove_section'),
+    path('remove_section_status/<str:job_id>', views.remove_section_status, name='remove_section_status'),
     path('remove_from_section', views.remove_from_section, name='remove_from_section'),
-    re_path(r'^sections/(?P<section_id>\d+)/classlist$', views.section_class_list, name='section_class_list'),
-    path('section_user_list/<int:section_id>', views.section_user_list, name='section_user_list'),
+    re_path(r'^sections/(?P<section_id>\d+)/classlist/data$', views.section_class_list_data, name='section_class_list_data'),
+    path('section_user_list/<int:section_id>/data', views.section_user_list_data, name='section_user_list_data'),
     path('add_to_section', views.add_to_section, name='add_to_section'),
     path('monitor', views.MonitorResponseView.as_view()),
 ]
@@ -1,15 +1,22 @@
+import contextvars
 import functools
 import logging
 import re
+import threading
+import time
 import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from canvas_api.helpers import courses as canvas_api_helper_courses
 from canvas_api.helpers import enrollments as canvas_api_helper_enrollments
 from canvas_api.helpers import sections as canvas_api_helper_sections
 from canvas_sdk.exceptions import CanvasAPIError
+from canvas_sdk.methods import courses as canvas_api_courses
 from canvas_sdk.methods import enrollments as canvas_api_enrollments
 from canvas_sdk.methods import sections
 from django.conf import settings
+from django.core.cache import caches
 from icommons_common.canvas_api.helpers import \
     courses as canvas_api_helper_courses
 from icommons_common.canvas_api.helpers import \
@@ -21,9 +28,107 @@ from icommons_common.models import CourseInstance
 
 logger = logging.getLogger(__name__)
 
+cache = caches['default']
+
+CACHE_KEY_COURSE = 'manage-sections-course-{}-{}-{}'
+CACHE_KEY_COURSE_GENERATION = 'manage-sections-course-generation-{}'
+CACHE_KEY_COURSE_ENROLLMENTS = 'manage-sections-course-enrollments-{}'
+
 # Set up the request context that will be used for canvas API calls
 SDK_CONTEXT = SessionInactivityExpirationRC(**settings.CANVAS_SDK_SETTINGS)
 
+# Oracle allows at most 1000 expressions in an IN list
+COURSE_INSTANCE_LOOKUP_CHUNK_SIZE = 999
+
+
+# the identity map for the current request, set by CourseInstanceIdentityMapMiddleware
+_course_instance_identity_map = contextvars.ContextVar(
+    'course_instance_identity_map', default=None)
+
+
+class CourseInstanceIdentityMap(object):
+    """
+    Request-local identity map for CourseInstance reads. Each row (including
+    a row that turns out not to exist) is loaded from the database at most
+    once; later lookups for the same course_instance_id get the same object
+    back, so changes made to it by one part of the request are seen by the
+    rest. duplicates_avoided counts the lookups served from the map.
+    """
+    def __init__(self):
+        self._instances = {}
+        self.duplicates_avoided = 0
+
+    def __len__(self):
+        return len(self._instances)
+
+    def get(self, course_instance_id):
+        """
+        Same contract as CourseInstance.objects.get(course_instance_id=...)
+        """
+        course_instance_id = int(course_instance_id)
+        if course_instance_id in self._instances:
+            self.duplicates_avoided += 1
+            ci = self._instances[course_instance_id]
+        else:
+            try:
+                ci = CourseInstance.objects.get(
+                    course_instance_id=course_instance_id)
+            except CourseInstance.DoesNotExist:
+                ci = None
+            self._instances[course_instance_id] = ci
+        if ci is None:
+            raise CourseInstance.DoesNotExist(
+                f'CourseInstance {course_instance_id} does not exist')
+        return ci
+
+    def get_many(self, course_instance_ids):
+        """
+        Returns a dict of course_instance_id to CourseInstance for the ids that
+        exist, loading any not already in the map with a single query (per
+        COURSE_INSTANCE_LOOKUP_CHUNK_SIZE ids)
+        """
+        course_instance_ids = {int(ci_id) for ci_id in course_instance_ids}
+        missing = sorted(course_instance_ids - set(self._instances))
+        self.duplicates_avoided += len(course_instance_ids) - len(missing)
+        for i in range(0, len(missing), COURSE_INSTANCE_LOOKUP_CHUNK_SIZE):
+            chunk = missing[i:i + COURSE_INSTANCE_LOOKUP_CHUNK_SIZE]
+            self._instances.update(dict.fromkeys(chunk))
+            for ci in CourseInstance.objects.filter(course_instance_id__in=chunk):
+                self._instances[ci.course_instance_id] = ci
+        return {ci_id: self._instances[ci_id] for ci_id in course_instance_ids
+                if self._instances[ci_id] is not None}
+
+
+def get_course_instance_identity_map():
+    """
+    Returns the identity map for the current request, or a new, unshared one
+    when there's no request (e.g. management commands and tests)
+    """
+    return _course_instance_identity_map.get() or CourseInstanceIdentityMap()
+
+
+def get_course_instance(course_instance_id):
+    return get_course_instance_identity_map().get(course_instance_id)
+
+
+def get_course_instances(course_instance_ids):
+    return get_course_instance_identity_map().get_many(course_instance_ids)
+
+
+class SectionClassification(namedtuple('SectionClassification', [
+        'is_enrollment_section', 'is_sis_section', 'is_credit_status_section'])):
+    """
+    The section type flags for one sis_section_id, as returned by
+    classify_sections. The flags have the same meaning as the
+    is_enrollment_section, is_sis_section and is_credit_status_section
+    helpers below.
+    """
+    __slots__ = ()
+
+    @property
+    def is_editable(self):
+        return not (self.is_sis_section or self.is_credit_status_section)
+
 
 def role_key(enrollment):
     """
@@ -38,14 +143,23 @@ def unique_enrollments_not_in_section_filter(section_id, enrollments):
     that are unique in terms of the 'role_key' defined above and whose 'role_key'
     is not already present in the given section.
     """
-    section_set = {role_key(x) for x in enrollments if x['course_section_id'] == int(section_id)}
-    # Use a temporary dictionary to get unique enrollments based on the "role_key".  Filter out any
-    # records where the role_key is present in the current section (by using the section_set above)
-
-    # Filter out enrollments in manually-created sections (source='managecrs')
-    non_manual_enrollments = [enr for enr in enrollments if enr.get('source') != 'managecrs']
+    section_id = int(section_id)
+    section_set = set()
+    # Unique enrollments based on the "role_key", built in the same pass as the
+    # section_set; a later enrollment with the same key replaces the earlier one
+    # but keeps its place. Enrollments in manually-created sections
+    # (source='managecrs') are left out, but still count toward the section_set.
+    unique_enrollments = {}
+    for enrollment in enrollments:
+        key = enrollment['user_id'], enrollment['role_id']
+        if enrollment['course_section_id'] == section_id:
+            section_set.add(key)
+        if enrollment.get('source') != 'managecrs':
+            unique_enrollments[key] = enrollment
 
-    return list({role_key(x): x for x in non_manual_enrollments if role_key(x) not in section_set}.values())
+    # Filter out any records where the role_key is present in the current section
+    return [enrollment for key, enrollment in unique_enrollments.items()
+            if key not in section_set]
 
 
 def get_section_by_id(section_id):
@@ -67,7 +181,7 @@ def is_enrollment_section(sis_section_id):
     if sis_section_id:
         if sis_section_id.isdigit():
             try:
-                return CourseInstance.objects.get(course_instance_id=int(sis_section_id)).is_enrollment_section
+                return get_course_instance(int(sis_section_id)).is_enrollment_section
             except (CourseInstance.DoesNotExist, CourseInstance.MultipleObjectsReturned, ValueError) as e:
                 return False
     return False
@@ -83,7 +197,7 @@ def is_sis_section(sis_section_id):
     if sis_section_id:
         if sis_section_id.isdigit():
             try:
-                ci = CourseInstance.objects.get(course_instance_id=int(sis_section_id))
+                ci = get_course_instance(int(sis_section_id))
                 if ci and ci.source != 'managecrs':
                     return True
             except (CourseInstance.DoesNotExist, CourseInstance.MultipleObjectsReturned, ValueError) as e:
@@ -105,6 +219,50 @@ def is_credit_status_section(sis_section_id):
     return False
 
 
+def _to_course_instance_id(sis_section_id):
+    """
+    Returns the sis_section_id as a course_instance_id, or None if it isn't
+    one. str.isdigit() is also true for digits that int() can't parse (such
+    as superscripts), so those are caught here rather than failing the
+    classification of every section.
+    """
+    if not (sis_section_id and sis_section_id.isdigit()):
+        return None
+    try:
+        return int(sis_section_id)
+    except ValueError:
+        return None
+
+
+def classify_sections(sis_section_ids):
+    """
+    Bulk version of is_enrollment_section, is_sis_section and
+    is_credit_status_section. The CourseInstance rows for all of the
+    digit-only sis_section_ids are fetched in a single query (per 999 ids),
+    rather than one query per section per check, and are shared with the rest
+    of the request through the CourseInstance identity map.
+    :param sis_section_ids: iterable of sis_section_ids (may include None)
+    :return: dict of sis_section_id to SectionClassification
+    """
+    course_instance_ids = {sis_section_id: _to_course_instance_id(sis_section_id)
+                           for sis_section_id in set(sis_section_ids)}
+    course_instances = get_course_instances(
+        course_instance_id for course_instance_id in course_instance_ids.values()
+        if course_instance_id is not None)
+
+    classifications = {}
+    for sis_section_id, course_instance_id in course_instance_ids.items():
+        ci = None
+        if course_instance_id is not None:
+            ci = course_instances.get(course_instance_id)
+        classifications[sis_section_id] = SectionClassification(
+            is_enrollment_section=bool(ci and ci.is_enrollment_section),
+            is_sis_section=bool(ci and ci.source != 'managecrs'),
+            is_credit_status_section=is_credit_status_section(sis_section_id),
+        )
+    return classifications
+
+
 @functools.singledispatch
 def is_editable_section(arg):
     raise NotImplementedError(f'Unsupported type: {type(arg)}')
@@ -119,10 +277,7 @@ def is_editable_section_str(section: str):
     """
     if not section:
         return False
-    if is_sis_section(section) or is_credit_status_section(section):
-        return False
-
-    return True
+    return classify_sections([section])[section].is_editable
 
 
 @is_editable_section.register
@@ -135,10 +290,7 @@ def is_editable_section_dict(section: dict):
     sis_section_id = section.get('sis_section_id')
     if not sis_section_id:
         return False
-    if is_sis_section(sis_section_id) or is_credit_status_section(sis_section_id):
-        return False
-
-    return True
+    return classify_sections([sis_section_id])[sis_section_id].is_editable
 
 
 def validate_course_id(section_canvas_course_id, request_canvas_course_id):
@@ -155,16 +307,104 @@ def validate_course_id(section_canvas_course_id, request_canvas_course_id):
     return False
 
 
+def get_course(canvas_course_id, include=()):
+    """
+    Returns the Canvas course, cached per combination of include parameters
+    so that e.g. the course with and without total_students can be cached
+    side by side, rather than one evicting the other. Returns None (after
+    logging) if Canvas can't return the course.
+    """
+    include = sorted(set(include))
+    generation = cache.get(CACHE_KEY_COURSE_GENERATION.format(canvas_course_id), 0)
+    key = CACHE_KEY_COURSE.format(canvas_course_id, generation, ','.join(include))
+    course = cache.get(key)
+    if course is None:
+        try:
+            course = canvas_api_courses.get_single_course_courses(
+                SDK_CONTEXT, canvas_course_id, include=include or None).json()
+        except CanvasAPIError:
+            logger.exception(f'Failed to retrieve Canvas course {canvas_course_id}')
+            return None
+        cache.set(key, course, settings.MANAGE_SECTIONS.get(
+            'COURSE_CACHE_TIMEOUT_SECS', 300))
+    return course
+
+
+def invalidate_course(canvas_course_id):
+    """
+    Drops every cached variant of the course, by moving the course on to a
+    new generation of cache keys. The generation only has to outlive the
+    variants cached under the generation it replaced, so it expires with
+    them; by the time get_course falls back to the default generation,
+    nothing cached under it is left.
+    """
+    cache.set(CACHE_KEY_COURSE_GENERATION.format(canvas_course_id),
+              uuid.uuid4().hex,
+              settings.MANAGE_SECTIONS.get('COURSE_CACHE_TIMEOUT_SECS', 300))
+
+
+def get_course_enrollments(canvas_course_id):
+    """
+    Returns the Canvas enrollments for the course, from a cache that the
+    section views keep up to date with update_cached_course_enrollments
+    rather than refetching the whole course after every change
+    """
+    key = CACHE_KEY_COURSE_ENROLLMENTS.format(canvas_course_id)
+    enrollments = cache.get(key)
+    if enrollments is None:
+        enrollments = canvas_api_helper_enrollments.get_enrollments(canvas_course_id)
+        cache.set(key, enrollments, settings.MANAGE_SECTIONS.get(
+            'COURSE_ENROLLMENTS_CACHE_TIMEOUT_SECS', 300))
+    return enrollments
+
+
+def update_cached_course_enrollments(canvas_course_id, added=(), removed_ids=()):
+    """
+    Patches the cached enrollments for the course, if there are any, by
+    dropping the enrollments with the given ids and appending the added ones.
+    Canvas doesn't include the user in the enrollment it returns when a user
+    is enrolled, so added enrollments without one get the user from another
+    of their enrollments in the course; if there isn't one, the cache is
+    dropped instead.
+    Concurrent updates of the same course can lose one another's changes, so
+    the cache timeout bounds how long the list can be wrong for.
+    """
+    key = CACHE_KEY_COURSE_ENROLLMENTS.format(canvas_course_id)
+    enrollments = cache.get(key)
+    if enrollments is None:
+        return
+    users = {e['user']['id']: e['user'] for e in enrollments if e.get('user')}
+    added = [dict(e, user=e.get('user') or users.get(e.get('user_id')))
+             for e in added]
+    if not all(e['user'] for e in added):
+        cache.delete(key)
+        return
+    removed_ids = {str(enrollment_id) for enrollment_id in removed_ids}
+    enrollments = [e for e in enrollments if str(e.get('id')) not in removed_ids]
+    enrollments.extend(added)
+    cache.set(key, enrollments, settings.MANAGE_SECTIONS.get(
+        'COURSE_ENROLLMENTS_CACHE_TIMEOUT_SECS', 300))
+
+
+def invalidate_course_enrollments(canvas_course_id):
+    cache.delete(CACHE_KEY_COURSE_ENROLLMENTS.format(canvas_course_id))
+
+
 def delete_enrollments(enrollments, course_id):
     """
-    Delete a list of enrollments via Canvas API.
+    Delete a list of enrollments via Canvas API, several at a time (up to
+    MANAGE_SECTIONS['DELETE_ENROLLMENTS_MAX_WORKERS']), backing off and
+    retrying when Canvas rate-limits us.
     Clears cache of section, enrollment, and
-    course data.
+    course data once all of the deletes are done.
 
     Returns a tuple `(deleted_enrollments, is_empty)`:
     - `deleted_enrollments` is a list of successful Canvas SDK responses
     - `is_empty` is a boolean indicating to the caller whether the section
     was successfully emptied (or was already empty)
+
+    As soon as one enrollment can't be deleted, no further deletes are
+    started; the ones already underway are allowed to finish.
     """
     is_empty = False
     deleted_enrollments = []
@@ -173,45 +413,89 @@ def delete_enrollments(enrollments, course_id):
         is_empty = True
         return (deleted_enrollments, is_empty)
 
+    # only enrollments up to the first one without an id are deleted
+    to_delete = []
     for enrollment in enrollments:
-        user_section_id = enrollment.get('id', '')
-        if not user_section_id:
+        if not enrollment.get('id', ''):
             logger.error(
                 f'Unexpected error while concluding enrollment for '
                 f'course_id:{course_id}; no user_section_id available '
                 f'for enrollment {enrollment}',
                 extra={
-                    'deleted_enrollments': deleted_enrollments,
                     'enrollment_causing_error': enrollment,
                     'enrollments_requested': enrollments,
                 }
             )
-            return (deleted_enrollments, is_empty)
-        response = None
+            break
+        to_delete.append(enrollment)
+    all_valid = len(to_delete) == len(enrollments)
+
+    stop = threading.Event()
+    max_workers = min(len(to_delete) or 1, settings.MANAGE_SECTIONS.get(
+        'DELETE_ENROLLMENTS_MAX_WORKERS', 5))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = list(executor.map(
+            functools.partial(_conclude_enrollment, course_id, stop),
+            to_delete))
+
+    deleted_enrollments = [r for r in responses if r is not None]
+    is_empty = all_valid and len(deleted_enrollments) == len(enrollments)
+
+    canvas_api_helper_courses.delete_cache(canvas_course_id=course_id)
+    invalidate_course(course_id)
+    canvas_api_helper_enrollments.delete_cache(course_id)
+    canvas_api_helper_sections.delete_cache(course_id)
+    update_cached_course_enrollments(course_id, removed_ids=[
+        e['id'] for e, r in zip(to_delete, responses) if r is not None])
+    for course_section_id in {e.get('course_section_id') for e in to_delete}:
+        if course_section_id:
+            canvas_api_helper_sections.delete_section_cache(course_section_id)
+
+    return (deleted_enrollments, is_empty)
+
+
+def _conclude_enrollment(course_id, stop, enrollment):
+    """
+    Deletes one enrollment for delete_enrollments, retrying with exponential
+    backoff if Canvas rate-limits the request. Returns the SDK response, or
+    None if the enrollment wasn't deleted (in which case `stop` is set so no
+    more deletes are started).
+    """
+    user_section_id = enrollment['id']
+    retries = settings.MANAGE_SECTIONS.get('CANVAS_RATE_LIMIT_RETRIES', 3)
+    backoff_secs = settings.MANAGE_SECTIONS.get('CANVAS_RATE_LIMIT_BACKOFF_SECS', 1)
+    for attempt in range(retries + 1):
+        if stop.is_set():
+            return None
         try:
-            response = canvas_api_enrollments.conclude_enrollment(
+            return canvas_api_enrollments.conclude_enrollment(
                 SDK_CONTEXT, course_id, user_section_id, 'delete'
             )
         except CanvasAPIError as e:
+            if _is_rate_limited(e) and attempt < retries:
+                delay = backoff_secs * 2 ** attempt
+                logger.warning(
+                    f'Canvas rate limit hit concluding enrollment '
+                    f'user_section_id:{user_section_id}, course_id:{course_id}; '
+                    f'retrying in {delay}s')
+                time.sleep(delay)
+                continue
             logger.exception(
                 f'Unexpected error while concluding enrollment for '
                 f'user_section_id:{user_section_id}, '
                 f'course_id:{course_id}',
                 extra={'canvas_api_error': getattr(e, 'error_json', None)},
             )
-            canvas_api_helper_sections.delete_cache(course_id)
-            return (deleted_enrollments, is_empty)
+            stop.set()
+            return None
 
-        canvas_api_helper_sections.delete_section_cache(user_section_id)
-        deleted_enrollments.append(response)
 
-    is_empty = True
-
-    canvas_api_helper_courses.delete_cache(canvas_course_id=course_id)
-    canvas_api_helper_enrollments.delete_cache(course_id)
-    canvas_api_helper_sections.delete_cache(course_id)
-
-    return (deleted_enrollments, is_empty)
+def _is_rate_limited(canvas_api_error):
+    # Canvas signals throttling with a 403 "Rate Limit Exceeded"; allow for a
+    # standard 429 as well
+    status_code = getattr(canvas_api_error, 'status_code', None)
+    return status_code == 429 or (
+        status_code == 403 and 'rate limit' in str(canvas_api_error).lower())
 
 
 def create_db_section(course_instance: CourseInstance, section_name: str):
@@ -1,8 +1,11 @@
+import functools
+import hashlib
 import json
 import logging
-import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+import django_rq
 from canvas_api.helpers import courses as canvas_api_helper_courses
 from canvas_api.helpers import enrollments as canvas_api_helper_enrollments
 from canvas_api.helpers import sections as canvas_api_helper_sections
@@ -11,22 +14,32 @@ from canvas_sdk.methods import enrollments as canvas_api_enrollments
 from canvas_sdk.methods import users as canvas_api_users
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db import router, transaction
 from django.http import JsonResponse
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.decorators.http import require_http_methods, require_safe
-from icommons_common.models import (CourseEnrollee, CourseGuest,
-                                    CourseInstance, CourseStaff, Person,
-                                    UserRole)
+from icommons_common.models import CourseEnrollee, CourseGuest, CourseStaff
 from icommons_common.monitor.views import BaseMonitorResponseView
 from lti_school_permissions.decorators import lti_permission_required
+from manage_people.utils import get_role_types_for_univ_ids, user_role_index
+from rq import Retry
 
-from .utils import (SDK_CONTEXT, create_db_section, delete_enrollments,
-                    is_credit_status_section, is_editable_section,
-                    is_enrollment_section, is_sis_section,
-                    unique_enrollments_not_in_section_filter)
+from . import jobs
+from .templatetags.manage_sections_tags import letter_range_bucketer
+from .utils import (SDK_CONTEXT, classify_sections, create_db_section,
+                    get_course, get_course_enrollments, get_course_instance,
+                    invalidate_course, is_editable_section,
+                    unique_enrollments_not_in_section_filter,
+                    update_cached_course_enrollments)
 
 logger = logging.getLogger(__name__)
 
+# the letter ranges the section roster pages are paginated by
+LETTER_RANGES = 'A-D,E-H,I-L,M-P,Q-S,T-Z'
+
 ENROLLMENT_TYPES = [
     'StudentEnrollment', 'TeacherEnrollment', 'TaEnrollment', 'DesignerEnrollment', 'ObserverEnrollment'
 ]
@@ -52,10 +65,7 @@ def _get_badge_info_for_users(user_id_list):
     if not user_id_list:
         return {}
 
-    people = Person.objects.raw(_get_people_in_list_query(user_id_list))
-    person_id_badge_mapping = {
-        p.univ_id: p.role_type_cd for p in people
-    }
+    person_id_badge_mapping = get_role_types_for_univ_ids(user_id_list)
 
     logger.debug("IDs found and their role types: %s" % person_id_badge_mapping)
 
@@ -125,21 +135,10 @@ def create_section_form(request):
         section_list = []  # Sections not fed from SIS
 
         # fetch total_students_size for the course
-        kwargs = {}
-        kwargs['include'] = 'total_students'
         start = time.time()
-        course = canvas_api_helper_courses.get_course(canvas_course_id, **kwargs)
+        course = get_course(canvas_course_id, include=['total_students'])
         logger.debug('Total time for get_course is ={} for course {}'.format(time.time() - start, canvas_course_id))
-        total_students_size = 0
-        if course:
-            if 'total_students' not in course:
-                logger.debug('total_students not in cached object, flushing and refetching object..')
-                # this is probably  a cached object without the count. Clear the cache object and re-fetch the course
-                canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
-                course = canvas_api_helper_courses.get_course(canvas_course_id, **kwargs)
-
-            if course and 'total_students' in course:
-                total_students_size = course['total_students']
+        total_students_size = (course or {}).get('total_students', 0)
 
         logger.debug('total_students_size={}'.format(total_students_size))
 
@@ -151,6 +150,12 @@ def create_section_form(request):
             )
             return render(request, 'manage_sections/error.html', status=500)
 
+        # classify all of the non-primary sections up front, in one query
+        primary_sis_section_ids = (course_instance_id, "ci:%s" % course_instance_id)
+        classifications = classify_sections(
+            section.get('sis_section_id') for section in canvas_sections
+            if section.get('sis_section_id') not in primary_sis_section_ids)
+
         for section in canvas_sections:
             if 'total_students' in section:
                 section['enrollment_count'] = section['total_students']
@@ -158,13 +163,16 @@ def create_section_form(request):
                 section['enrollment_count'] = 'n/a'
 
             sis_section_id = section.get('sis_section_id')
-            if sis_section_id == course_instance_id or sis_section_id == "ci:%s" % course_instance_id:
+            if sis_section_id in primary_sis_section_ids:
                 # this matches the current course instance id and placed first on the list
                 sis_enrollment_section_list.insert(0, section)
-            elif is_enrollment_section(sis_section_id) or is_credit_status_section(sis_section_id):
+                continue
+
+            classification = classifications[sis_section_id]
+            if classification.is_enrollment_section or classification.is_credit_status_section:
                 sis_enrollment_section_list.append(section)
             else:
-                if is_sis_section(sis_section_id):
+                if classification.is_sis_section:
                     section['registrar_section_flag'] = True
                 section_list.append(section)
 
@@ -195,7 +203,7 @@ def create_section(request):
 
     # get parent course instance
     try:
-        parent_course_instance = CourseInstance.objects.get(course_instance_id=course_instance_id)
+        parent_course_instance = get_course_instance(course_instance_id)
     except Exception as e:
         logger.exception(f'Exception in edit_section: {e}')
         return render(request, 'manage_sections/error.html', status=500)
@@ -237,7 +245,7 @@ def edit_section(request, sis_section_id, section_id):
 
     # grab the section from the db
     try:
-        section = CourseInstance.objects.get(course_instance_id=sis_section_id)
+        section = get_course_instance(sis_section_id)
     except Exception as e:
         logger.exception(f'Exception in edit_section: {e}')
         return render(request, 'manage_sections/error.html', status=500)
@@ -267,6 +275,7 @@ def edit_section(request, sis_section_id, section_id):
         course_section = None
     else:
         canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
+        invalidate_course(canvas_course_id)
         canvas_api_helper_enrollments.delete_cache(canvas_course_id)
 
     # Append section count to course_section object so the badge will appear
@@ -299,21 +308,30 @@ def section_details(request, section_id, sis_section_id):
 
 @login_required
 @lti_permission_required('manage_sections')
-@require_http_methods(['GET'])
-def section_user_list(request, section_id):
+@require_safe
+def section_user_list_data(request, section_id):
+    """
+    Returns the section's enrollments as JSON, grouped by letter range. See
+    _letter_range_buckets_response.
+    """
     canvas_course_id = request.LTI['custom_canvas_course_id']
+    section, enrollments = _get_section_user_list(canvas_course_id, section_id)
+    return _letter_range_buckets_response(
+        request, enrollments, allow_edit=is_editable_section(section))
+
+
+def _get_section_user_list(canvas_course_id, section_id):
+    """
+    Returns the section and its (badged, role-labeled and sorted)
+    enrollments, less any test student enrollments
+    """
     section = canvas_api_helper_sections.get_section(canvas_course_id, section_id)
     enrollments_raw = _filter_student_view_enrollments(section['enrollments'])
     enrollments_badged = _add_badge_label_name_to_enrollments(enrollments_raw)
     enrollments = canvas_api_helper_enrollments.add_role_labels_to_enrollments(
         enrollments_badged)
     enrollments.sort(key=lambda x: x['user']['sortable_name'])
-    return render(request, 'manage_sections/_section_userlist.html', {
-        'allow_edit': is_editable_section(section),
-        'enroll_count': len(enrollments),
-        'enrollments': enrollments,
-        'section_id': section_id
-    })
+    return section, enrollments
 
 
 @login_required
@@ -335,55 +353,108 @@ def remove_section(request, sis_section_id, section_id):
             status=422
         )
 
-    # grab the section from the db
+    # sections with many enrollments are handed off to an rq worker, since
+    # emptying them means a Canvas delete per enrollment; the page polls
+    # remove_section_status until the job is done
+    if _is_large_section(section_id):
+        # the job records the stage it's on, so a retry picks up where the
+        # failed attempt left off. rq also retries a job abandoned by a worker
+        # that died, when it cleans up the started job registry. Retries are
+        # requeued straight away (interval 0): delayed ones would wait in the
+        # scheduled job registry for a worker started --with-scheduler.
+        max_retries = settings.MANAGE_SECTIONS.get('REMOVE_SECTION_JOB_MAX_RETRIES', 3)
+        job = django_rq.get_queue('default').enqueue(
+            'manage_sections.jobs.remove_section',
+            canvas_course_id, sis_section_id, section_id,
+            meta={'canvas_course_id': str(canvas_course_id),
+                  'section_id': section_id},
+            job_timeout=settings.MANAGE_SECTIONS.get('REMOVE_SECTION_JOB_TIMEOUT_SECS', 1800),
+            result_ttl=settings.MANAGE_SECTIONS.get('REMOVE_SECTION_JOB_RESULT_TTL_SECS', 3600),
+            retry=Retry(max=max_retries, interval=0),
+        )
+        logger.info(f'Queued job {job.id} to remove section {section_id} from course {canvas_course_id}')
+        return JsonResponse({
+            'job_id': job.id,
+            'status_url': reverse('manage_sections:remove_section_status', args=[job.id]),
+        }, status=202)
+
     try:
-        db_section = CourseInstance.objects.get(course_instance_id=sis_section_id)
-        db_section.deleted = 1
-        db_section.sync_to_canvas = 0
-        db_section.save()
-    except Exception as e:
-        logger.exception(f'Error retrieving section {sis_section_id} for deletion: {e}')
-        return render(request, 'manage_sections/error.html', status=500)
+        canvas_section = jobs.remove_section(canvas_course_id, sis_section_id, section_id)
+    except jobs.RemoveSectionError as e:
+        return JsonResponse({'message': e.message}, status=500)
+    return JsonResponse(canvas_section)
 
-    # Now check/delete enrollments
-    for table in (CourseEnrollee, CourseGuest, CourseStaff):
-        try:
-            enrollments = table.objects.filter(course_instance_id=sis_section_id).delete()
-        except Exception as e:
-            message = f'Error retrieving enrollments for section {sis_section_id} for deletion: {e}'
-            logger.error(message)
-            return JsonResponse({'message': message}, status=500)
-
-    enrollments = canvas_api_enrollments.list_enrollments_sections(SDK_CONTEXT, section_id).json()
-    if len(enrollments) > 0:
-        # delete enrollments before deleting section
-        responses, is_empty = delete_enrollments(enrollments, canvas_course_id)
-        if not is_empty:
-            return JsonResponse({
-                'message': f'Issue clearing enrollments prior to deletion. Unable to delete section {section_id} from course {canvas_course_id}'},
-                status=500
-            )
 
-    canvas_section = canvas_api_helper_sections.delete_section(canvas_course_id, section_id)
-    return JsonResponse(canvas_section)
+def _is_large_section(section_id):
+    """
+    Whether the section has more enrollments than
+    ASYNC_REMOVE_SECTION_THRESHOLD. Only the first page of the section's
+    enrollments is fetched, sized just past the threshold (or as large as
+    Canvas allows), so a section that fills it, has more pages, or can't be
+    listed counts as large.
+    """
+    threshold = settings.MANAGE_SECTIONS.get('ASYNC_REMOVE_SECTION_THRESHOLD', 50)
+    try:
+        response = canvas_api_enrollments.list_enrollments_sections(
+            SDK_CONTEXT, section_id, per_page=min(threshold + 1, 100))
+        enrollments = response.json()
+    except CanvasAPIError as e:
+        logger.warning(f'Failed to list the enrollments of section {section_id}: {e}')
+        return True
+    return len(enrollments) > threshold or 'next' in response.links
+
+
+@login_required
+@lti_permission_required('manage_sections')
+@require_safe
+def remove_section_status(request, job_id):
+    """
+    Returns the progress of a queued remove_section job, and the deleted
+    section once it's done
+    """
+    canvas_course_id = request.LTI['custom_canvas_course_id']
+
+    job = django_rq.get_queue('default').fetch_job(job_id)
+    # only report on jobs that were queued for the course in this LTI session
+    if job is None or job.meta.get('canvas_course_id') != str(canvas_course_id):
+        return JsonResponse({'message': 'Job not found'}, status=404)
+
+    return JsonResponse({
+        'status': job.get_status(),
+        'stage': job.meta.get('stage', jobs.REMOVE_SECTION_STAGES[0]),
+        'deleted_enrollments': job.meta.get('deleted_enrollments', 0),
+        'section': job.meta.get('section'),
+    })
 
 
 @login_required
 @lti_permission_required('manage_sections')
 @require_safe
-def section_class_list(request, section_id):
+def section_class_list_data(request, section_id):
     """
-    Return a sorted set of enrollments that represent unique combinations of user and role.  Only user/role
-    combinations that are not enrolled in the current section are considered.  This view assumes that the
-    actual section that the resulting unique enrollments are part of doesn't matter, since this view is used
-    to represent the user/role combinations that can be added to the section list.
+    Returns the unique user/role combinations in the course that are not
+    enrolled in the section as JSON, grouped by letter range. This view
+    assumes that the actual section that the resulting unique enrollments are
+    part of doesn't matter, since it is used to represent the user/role
+    combinations that can be added to the section. See
+    _letter_range_buckets_response.
     """
     canvas_course_id = request.LTI['custom_canvas_course_id']
+    section, enrollments = _get_section_class_list(canvas_course_id, section_id)
+    return _letter_range_buckets_response(
+        request, enrollments, allow_edit=is_editable_section(section))
+
+
+def _get_section_class_list(canvas_course_id, section_id):
+    """
+    Returns the section and the (badged, role-labeled and sorted) unique
+    user/role enrollments in the course that aren't in the section
+    """
     section = canvas_api_helper_sections.get_section(canvas_course_id, section_id)
 
     # Fetch enrollments for the course
     course_enrollments = [
-        e for e in canvas_api_helper_enrollments.get_enrollments(canvas_course_id)
+        e for e in get_course_enrollments(canvas_course_id)
         if e['type'] in ENROLLMENT_TYPES
     ]
 
@@ -398,12 +469,7 @@ def section_class_list(request, section_id):
         enrollments_badged)
 
     enrollments.sort(key=lambda x: x['user']['sortable_name'])
-
-    return render(request, 'manage_sections/_section_classlist.html', {
-        'enrollments': enrollments,
-        'section_id': section_id,
-        'allow_edit': is_editable_section(section)
-    })
+    return section, enrollments
 
 
 @login_required
@@ -421,73 +487,95 @@ def add_to_section(request):
         logger.exception(message)
         return JsonResponse({'success': False, 'message': message}, status=500)
 
-    # Map Canvas role to DB role
-    for user in users_to_add:
-        # The user is a student, but we have 5 roles that map to 90 in the DB, so
-        # select the one designated purely as Student
-        try:
-            if user['enrollment_role_id'] == '90':
-                db_role = UserRole.objects.get(role_id=0)
-            else:
-                db_role = UserRole.objects.get(canvas_role_id=user['enrollment_role_id'])
-        except Exception as e:
-            message = f"Failed to retrieve role {user['enrollment_role_id']} from DB: {e}"
-            logger.exception(message)
-            return JsonResponse({'success': False, 'message': message}, status=500)
-
-        # get the user's HUID from Canvas
-        try:
-            huid = canvas_api_users.get_user_profile(SDK_CONTEXT, user['enrollment_user_id']).json()['sis_user_id']
-        except Exception as e:
-            message = f"Failed to retrieve user {user['enrollment_user_id']} from Canvas: {e}"
-            logger.exception(message)
-            return JsonResponse({'success': False, 'message': message}, status=500)
+    max_workers = settings.MANAGE_SECTIONS.get('CANVAS_API_MAX_WORKERS', 5)
 
-        if db_role.staff == '1':
-            table = CourseStaff
-        elif db_role.student == '1':
-            table = CourseEnrollee
-        else:
-            table = CourseGuest
+    # users without a Canvas user id can't be enrolled, or have their HUID
+    # looked up, so they're reported as failed rather than added
+    failed_users = [user for user in users_to_add if not user.get('enrollment_user_id')]
+    if failed_users:
+        logger.error(f"Missing enrollment_user_id for {len(failed_users)} users to add to section {section_id}")
+    users_to_add = [user for user in users_to_add if user.get('enrollment_user_id')]
 
+    # Map Canvas roles to DB roles, once per distinct role
+    db_roles = {}
+    for enrollment_role_id in {user.get('enrollment_role_id') for user in users_to_add}:
         try:
-            enrollment = table(
-                course_instance_id=sis_section_id,
-                user_id = huid,
-                role = db_role,
-                source='managecrs'
-            )
-            enrollment.save()
+            db_roles[enrollment_role_id] = _get_db_role(enrollment_role_id)
         except Exception as e:
-            message = f"Failed to add user {user['enrollment_user_id']} to DB: {e}"
+            message = f"Failed to retrieve role {enrollment_role_id} from DB: {e}"
             logger.exception(message)
             return JsonResponse({'success': False, 'message': message}, status=500)
 
+    # get the users' HUIDs from their enrollments in the course (which the
+    # class list has usually just cached), never from the posted data, so the
+    # DB rows are for the same users that are enrolled in Canvas; Canvas only
+    # needs to be asked about the ones that aren't there
+    canvas_user_ids = list(dict.fromkeys(user['enrollment_user_id'] for user in users_to_add))
+    try:
+        course_enrollments = get_course_enrollments(canvas_course_id) or []
+    except Exception as e:
+        logger.warning(f"Failed to retrieve enrollments for course {canvas_course_id}: {e}")
+        course_enrollments = []
+    course_huids = {}
+    for enrollment in course_enrollments:
+        sis_user_id = (enrollment.get('user') or {}).get('sis_user_id')
+        if sis_user_id:
+            course_huids[str(enrollment.get('user_id'))] = sis_user_id
+    huids = {canvas_user_id: course_huids[str(canvas_user_id)] for canvas_user_id in canvas_user_ids
+             if str(canvas_user_id) in course_huids}
+    missing_huids = [canvas_user_id for canvas_user_id in canvas_user_ids if canvas_user_id not in huids]
+    if missing_huids:
+        with ThreadPoolExecutor(max_workers=min(len(missing_huids), max_workers)) as executor:
+            results = executor.map(_get_sis_user_id, missing_huids)
+            for canvas_user_id in missing_huids:
+                try:
+                    huids[canvas_user_id] = next(results)
+                except Exception as e:
+                    message = f"Failed to retrieve user {canvas_user_id} from Canvas: {e}"
+                    logger.exception(message)
+                    return JsonResponse({'success': False, 'message': message}, status=500)
+
+    # write all of the DB enrollments in one transaction
+    enrollments_by_table = {}
+    for user in users_to_add:
+        db_role = db_roles[user.get('enrollment_role_id')]
+        table = _get_course_member_table(db_role)
+        enrollments_by_table.setdefault(table, []).append(table(
+            course_instance_id=sis_section_id,
+            user_id=huids[user.get('enrollment_user_id')],
+            role=db_role,
+            source='managecrs'
+        ))
+    try:
+        with transaction.atomic(using=router.db_for_write(CourseEnrollee)):
+            for table, enrollments in enrollments_by_table.items():
+                table.objects.bulk_create(enrollments)
+    except Exception as e:
+        message = f"Failed to add users to section {sis_section_id} in DB: {e}"
+        logger.exception(message)
+        return JsonResponse({'success': False, 'message': message}, status=500)
+
     # Make a best-effort attempt to add the user to the section in Canvas.
     # If this fails, we'll proceed anyway knowing that the feed will
     # eventually add the user to the section
-    failed_users = []
-    for user in users_to_add:
-        try:
-            canvas_api_enrollments.enroll_user_sections(
-                SDK_CONTEXT,
-                section_id,
-                user['enrollment_user_id'],
-                enrollment_type=user['enrollment_type'],
-                enrollment_role_id=user['enrollment_role_id'],
-                enrollment_enrollment_state='active'
-            )
-        except (KeyError, CanvasAPIError):
-            logger.exception(f"Failed to add user to section {section_id} {json.dumps(user)}")
-            failed_users.append(user)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(users_to_add), max_workers))) as executor:
+        enrolled = list(executor.map(
+            functools.partial(_enroll_user_in_section, section_id), users_to_add))
+    failed_users += [user for user, enrollment in zip(users_to_add, enrolled) if not enrollment]
+    added_enrollments = [enrollment for enrollment in enrolled if enrollment]
     canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
+    invalidate_course(canvas_course_id)
     canvas_api_helper_enrollments.delete_cache(canvas_course_id)
     canvas_api_helper_sections.delete_cache(canvas_course_id)
     canvas_api_helper_sections.delete_section_cache(section_id)
+    # the class list reads the course enrollments from our own cache, which is
+    # patched rather than dropped so it doesn't have to be refetched
+    update_cached_course_enrollments(canvas_course_id, added=added_enrollments)
 
     return JsonResponse({
-        'added': len(users_to_add) - len(failed_users),
-        'failed': failed_users
+        'added': len(added_enrollments),
+        'failed': failed_users,
+        'enrollments': added_enrollments,
     })
 
 
@@ -512,23 +600,14 @@ def remove_from_section(request):
         logger.exception(message)
         return JsonResponse({'success': False, 'message': message}, status=500)
 
-    # There are 5 roles that map to 90 in the DB, so select the one designated purely as Student.
     try:
-        if role_id == '90':
-            db_role = UserRole.objects.get(role_id=0)
-        else:
-            db_role = UserRole.objects.get(canvas_role_id=role_id)
+        db_role = _get_db_role(role_id)
     except Exception as e:
         message = f"Failed to retrieve role {role_id} from DB: {e}"
         logger.exception(message)
         return JsonResponse({'success': False, 'message': message}, status=500)
 
-    if db_role.staff == '1':
-        table = CourseStaff
-    elif db_role.student == '1':
-        table = CourseEnrollee
-    else:
-        table = CourseGuest
+    table = _get_course_member_table(db_role)
 
     try:
         table.objects.get(course_instance_id=int(sis_section_id), user_id=huid, role=db_role).delete()
@@ -544,9 +623,11 @@ def remove_from_section(request):
             SDK_CONTEXT, canvas_course_id, user_section_id, 'delete'
         )
         canvas_api_helper_courses.delete_cache(canvas_course_id=canvas_course_id)
+        invalidate_course(canvas_course_id)
         canvas_api_helper_enrollments.delete_cache(canvas_course_id)
         canvas_api_helper_sections.delete_cache(canvas_course_id)
         canvas_api_helper_sections.delete_section_cache(section_id)
+        update_cached_course_enrollments(canvas_course_id, removed_ids=[user_section_id])
 
     except CanvasAPIError:
         message = f"Failed to remove user from section {user_section_id} in course {canvas_course_id}"
@@ -557,18 +638,119 @@ def remove_from_section(request):
     return JsonResponse(response.json())
 
 
-def _get_people_in_list_query(user_id_list=[]):
-    pat = re.compile(r'[^\w-]+', re.UNICODE)
-    clean_user_ids = ["'{}'".format(pat.sub('', i)) for i in user_id_list if len(pat.sub('', i)) <= 10]
-    if clean_user_ids:
-        # split clean_user_ids into chunks of 999 (https://www.geeksforgeeks.org/break-list-chunks-size-n-python/)
-        n = 999
-        chunks = [clean_user_ids[i * n:(i + 1) * n] for i in range((len(clean_user_ids) + n - 1) // n )]
-
-        # create the raw query with one of the chunks
-        raw_person_query = 'select * from people.v_huid_and_xid_people where univ_id in ({})'.format(','.join(chunks.pop()))
-        # if there are remaining chunks, add them to the where clause
-        for chunk in chunks:
-            raw_person_query += ' or univ_id in ({})'.format(','.join(chunk))
-        logger.debug(raw_person_query)
-        return raw_person_query
+def _get_db_role(canvas_role_id):
+    """
+    Maps a Canvas role id to its UserRole. There are 5 roles that map to 90
+    in the DB, so for 90 select the one designated purely as Student.
+    """
+    if canvas_role_id == '90':
+        db_role = user_role_index.get(0)
+        if db_role is None:
+            raise LookupError('no UserRole with role_id 0')
+        return db_role
+    return user_role_index.get_by_canvas_role_id(canvas_role_id)
+
+
+def _get_course_member_table(db_role):
+    if db_role.staff == '1':
+        return CourseStaff
+    elif db_role.student == '1':
+        return CourseEnrollee
+    return CourseGuest
+
+
+def _get_sis_user_id(canvas_user_id):
+    return canvas_api_users.get_user_profile(SDK_CONTEXT, canvas_user_id).json()['sis_user_id']
+
+
+def _enroll_user_in_section(section_id, user):
+    """
+    Adds the user to the Canvas section, returning the new Canvas enrollment,
+    or None (after logging) if that fails
+    """
+    try:
+        return canvas_api_enrollments.enroll_user_sections(
+            SDK_CONTEXT,
+            section_id,
+            user['enrollment_user_id'],
+            enrollment_type=user['enrollment_type'],
+            enrollment_role_id=user['enrollment_role_id'],
+            enrollment_enrollment_state='active'
+        ).json()
+    except (KeyError, CanvasAPIError):
+        logger.exception(f"Failed to add user to section {section_id} {json.dumps(user)}")
+        return None
+
+
+def _compact_enrollment(enrollment):
+    """
+    Returns just the fields of a Canvas enrollment that the section roster
+    pages use
+    """
+    user = enrollment['user']
+    return {
+        'id': enrollment.get('id'),
+        'course_id': enrollment.get('course_id'),
+        'course_section_id': enrollment.get('course_section_id'),
+        'sis_course_id': enrollment.get('sis_course_id'),
+        'role': enrollment.get('role'),
+        'role_id': enrollment.get('role_id'),
+        'role_label': enrollment.get('role_label'),
+        'type': enrollment.get('type'),
+        'badge_label_name': enrollment.get('badge_label_name'),
+        'user': {
+            'id': user.get('id'),
+            'sis_user_id': user.get('sis_user_id'),
+            'name': user.get('name'),
+            'sortable_name': user.get('sortable_name'),
+        },
+    }
+
+
+def _bucket_hash(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _letter_range_buckets_response(request, enrollments, **extra):
+    """
+    Returns a JsonResponse with (sorted) enrollments grouped into the roster
+    page's letter ranges, each with a hash of its contents. Enrollments
+    whose name doesn't fall in any range go in the '' bucket.
+
+    The response carries an ETag built from the bucket hashes, so an
+    unchanged roster costs the client a 304. A client that already has some
+    buckets can send their hashes as ?have=A-D:<hash>,E-H:<hash>; buckets it
+    already has are returned without their enrollments.
+    """
+    letter_ranges = LETTER_RANGES.split(',')
+    to_letter_range = letter_range_bucketer(LETTER_RANGES)
+    buckets = {letter_range: [] for letter_range in letter_ranges + ['']}
+    for enrollment in enrollments:
+        letter_range = to_letter_range(enrollment['user'].get('sortable_name')) or ''
+        buckets[letter_range].append(_compact_enrollment(enrollment))
+    hashes = {letter_range: _bucket_hash(records)
+              for letter_range, records in buckets.items()}
+
+    etag = quote_etag(_bucket_hash([extra, sorted(hashes.items())]))
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+
+    have = dict(
+        range_hash.rsplit(':', 1)
+        for range_hash in request.GET.get('have', '').split(',') if ':' in range_hash
+    )
+    response = JsonResponse(dict(extra, **{
+        'count': len(enrollments),
+        'letter_ranges': letter_ranges,
+        'buckets': [
+            dict({'range': letter_range, 'hash': hashes[letter_range],
+                  'count': len(records)},
+                 **({} if have.get(letter_range) == hashes[letter_range]
+                    else {'enrollments': records}))
+            for letter_range, records in buckets.items()
+        ],
+    }))
+    response['ETag'] = etag
+    return response